@@ -0,0 +1,256 @@
+# Copyright 2013 Pieter Rautenbach
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Check cycle benchmark: The client and server monitor checking a fake TeamCity server, at every combination of a number
+of build types, a number of changes per build and a round trip time. Every scenario reports the cycle latency, the
+requests and bytes per cycle, the CPU time per cycle and the peak RSS.
+
+Every scenario runs in a fresh interpreter, with the fake server in another, so that the CPU time and peak RSS are the
+client's own. The first cycle, with cold caches and connections, is reported apart from the others.
+
+Run with python -m whatsthatlight.benchmark.bench_cycles. The results are written as JSON to --output. With
+--baseline, they are compared with earlier results, and the exit status is non-zero on a regression.
+"""
+
+# System imports
+from __future__ import print_function
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import threading
+
+# Local imports
+from whatsthatlight import clients
+from whatsthatlight import monitors
+from whatsthatlight.benchmark import utils
+
+# Constants
+_DEFAULT_BUILD_TYPES = '10,100,1000'
+_DEFAULT_CHANGES = '0,20,200'
+_DEFAULT_RTTS = '0,0.002'
+_DEFAULT_CYCLES = 5
+_DEFAULT_TOLERANCE = 0.2
+_DEFAULT_OUTPUT = 'bench_cycles.json'
+_SCENARIO_OPTION = '--scenario'
+_USERNAME = 'user0'
+_PASSWORD = 'secret'
+# Lower is better for all of these
+_COMPARED_METRICS = ['cycle_p50', 'cycle_p95', 'requests_per_cycle', 'bytes_per_cycle', 'cpu_seconds_per_cycle',
+                     'peak_rss_bytes']
+_TIMEOUT_SECONDS = 3600
+
+
+class _RecordingTraceSink(object):
+    """
+    A trace sink that keeps the traces, and signals once enough checks were made. Cycles are measured by their traces,
+    so that the benchmark measures what the daemon's server monitor does.
+    """
+
+    def __init__(self, nr_of_traces):
+        """
+        Constructor.
+
+        :param nr_of_traces: The number of traces after which to signal.
+        """
+        self.traces = []
+        self.event = threading.Event()
+        self._nr_of_traces = nr_of_traces
+
+    def write(self, trace):
+        """
+        Keep a trace.
+
+        :param trace: A CycleTrace.
+        """
+        self.traces.append(trace.to_dict())
+        if len(self.traces) >= self._nr_of_traces:
+            self.event.set()
+
+
+def _get_name(scenario):
+    """
+    Get a scenario's name.
+
+    :param scenario: A dictionary of the scenario's build types, changes and round trip time.
+    :return: The name.
+    """
+    return 'build_types={0},changes={1},rtt_ms={2:g},mode={3}'.format(scenario['build_types'],
+                                                                      scenario['changes'],
+                                                                      1000 * scenario['rtt'],
+                                                                      scenario['mode'])
+
+
+def start_fake_server(build_types, changes, rtt, seed=0):
+    """
+    Start a fake TeamCity server in another interpreter.
+
+    :param build_types: The number of build types.
+    :param changes: The number of changes per build.
+    :param rtt: The round trip time, in seconds, by which every response is delayed.
+    :param seed: The seed of the data.
+    :return: A tuple of the process, to terminate, and the server's URL.
+    """
+    process = subprocess.Popen([sys.executable, '-m', 'whatsthatlight.fake_teamcity',
+                                '--port', '0',
+                                '--seed', str(seed),
+                                '--build-types', str(build_types),
+                                '--projects', str(max(1, build_types // 10)),
+                                '--changes', str(changes),
+                                '--latency', str(rtt)],
+                               stdout=subprocess.PIPE)
+    # Serving on <url>; press Ctrl-C to stop
+    line = process.stdout.readline()
+    if not line:
+        raise RuntimeError('The fake TeamCity server did not start')
+    return process, line.split()[2].rstrip(';')
+
+
+def run_scenario(scenario):
+    """
+    Run a scenario in this interpreter.
+
+    :param scenario: A dictionary of the scenario's build types, changes, round trip time, mode and cycles.
+    :return: A dictionary of the scenario's results.
+    """
+    (process, server_url) = start_fake_server(scenario['build_types'], scenario['changes'], scenario['rtt'])
+    try:
+        client = clients.TeamCityClient(server_url=server_url, username=_USERNAME, password=_PASSWORD)
+        server_monitor = monitors.ServerMonitor(client=client, polling_interval=0)
+        if scenario['mode'] == 'index':
+            server_monitor.set_index_handler(lambda _index: None)
+        else:
+            server_monitor.set_handler(lambda _any_builds_running, _any_build_failures: None)
+        trace_sink = _RecordingTraceSink(scenario['cycles'] + 1)
+        server_monitor.set_trace_sink(trace_sink)
+        (user_seconds, system_seconds) = os.times()[:2]
+        server_monitor.start()
+        finished = trace_sink.event.wait(_TIMEOUT_SECONDS)
+        server_monitor.stop()
+        cpu_seconds = sum(os.times()[:2]) - user_seconds - system_seconds
+    finally:
+        process.terminate()
+        process.wait()
+    if not finished:
+        raise RuntimeError('Timed out')
+    traces = trace_sink.traces
+    errors = [trace['error'] for trace in traces if trace['error']]
+    if errors:
+        raise RuntimeError('Checks failed: {0}'.format(errors[0]))
+    (first_trace, warm_traces) = (traces[0], traces[1:])
+    summary = utils.summarise([trace['duration'] for trace in warm_traces])
+    return {'name': _get_name(scenario),
+            'scenario': scenario,
+            'cycles': len(warm_traces),
+            'first_cycle': first_trace['duration'],
+            'cycle_min': summary['min'],
+            'cycle_mean': summary['mean'],
+            'cycle_p50': summary['p50'],
+            'cycle_p95': summary['p95'],
+            'cycle_p99': summary['p99'],
+            'cycle_max': summary['max'],
+            'requests_per_cycle': sum(trace['nr_of_requests'] for trace in warm_traces) / float(len(warm_traces)),
+            'bytes_per_cycle': sum(trace['nr_of_bytes'] for trace in warm_traces) / float(len(warm_traces)),
+            # Including the first cycle, as there is no telling it apart
+            'cpu_seconds_per_cycle': cpu_seconds / len(traces),
+            # Kilobytes on Linux
+            'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+
+def measure(scenario):
+    """
+    Run a scenario in a fresh interpreter.
+
+    :param scenario: A dictionary of the scenario's build types, changes, round trip time, mode and cycles.
+    :return: A dictionary of the scenario's results.
+    """
+    output = subprocess.check_output([sys.executable, '-m', 'whatsthatlight.benchmark.bench_cycles',
+                                      _SCENARIO_OPTION, json.dumps(scenario)])
+    return json.loads(output.splitlines()[-1])
+
+
+def _parse_list(text, parse):
+    """
+    Parse a comma-separated list.
+
+    :param text: The list.
+    :param parse: A function to parse every item.
+    :return: A list.
+    """
+    return [parse(item) for item in text.split(',') if item]
+
+
+def main():
+    """
+    Run the benchmark, print a summary, write the results and exit with a non-zero status on a regression.
+    """
+    parser = argparse.ArgumentParser(description='Check cycle benchmark.')
+    parser.add_argument('--build-types', default=_DEFAULT_BUILD_TYPES, help='The numbers of build types, e.g. 10,10000.')
+    parser.add_argument('--changes', default=_DEFAULT_CHANGES, help='The numbers of changes per build, e.g. 0,200.')
+    parser.add_argument('--rtts', default=_DEFAULT_RTTS, help='The round trip times in seconds, e.g. 0,0.05.')
+    parser.add_argument('--mode', choices=['user', 'index'], default='user',
+                        help='Check for one user, as a single device does, or index all users, as named devices do.')
+    parser.add_argument('--cycles', type=int, default=_DEFAULT_CYCLES, help='The number of cycles after the first.')
+    parser.add_argument('--output', default=_DEFAULT_OUTPUT, help='The file to write the results to, as JSON.')
+    parser.add_argument('--baseline', help='Results to compare with, as written to --output before.')
+    parser.add_argument('--tolerance', type=float, default=_DEFAULT_TOLERANCE,
+                        help='The fraction by which a metric may exceed its baseline.')
+    parser.add_argument(_SCENARIO_OPTION, help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+    logging.basicConfig()
+    if arguments.scenario:
+        print(json.dumps(run_scenario(json.loads(arguments.scenario))))
+        return
+    print('{0:<48} {1:>9} {2:>9} {3:>9} {4:>9} {5:>12} {6:>9} {7:>8}'.format('scenario', 'first ms', 'p50 ms', 'p95 ms',
+                                                                             'requests', 'bytes', 'cpu ms', 'rss MB'))
+    results = []
+    for build_types in _parse_list(arguments.build_types, int):
+        for changes in _parse_list(arguments.changes, int):
+            for rtt in _parse_list(arguments.rtts, float):
+                result = measure({'build_types': build_types,
+                                  'changes': changes,
+                                  'rtt': rtt,
+                                  'mode': arguments.mode,
+                                  'cycles': arguments.cycles})
+                results.append(result)
+                print('{0:<48} {1:>9.1f} {2:>9.1f} {3:>9.1f} {4:>9.0f} {5:>12.0f} {6:>9.1f} {7:>8.1f}'.format(
+                    result['name'],
+                    1000 * result['first_cycle'],
+                    1000 * result['cycle_p50'],
+                    1000 * result['cycle_p95'],
+                    result['requests_per_cycle'],
+                    result['bytes_per_cycle'],
+                    1000 * result['cpu_seconds_per_cycle'],
+                    result['peak_rss_bytes'] / 1048576.0))
+    with open(arguments.output, 'w') as output_file:
+        json.dump({'python': sys.version.split()[0], 'results': results}, output_file, indent=2, sort_keys=True)
+    regressions = []
+    if arguments.baseline:
+        with open(arguments.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = utils.find_regressions(dict((result['name'], result) for result in results),
+                                             dict((result['name'], result) for result in baseline['results']),
+                                             _COMPARED_METRICS,
+                                             arguments.tolerance)
+    for regression in regressions:
+        print(regression, file=sys.stderr)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+# Copyright 2013 Pieter Rautenbach
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Detection latency benchmark: The time from a build's state changing on the build server to the light showing it. A
+fake TeamCity server's builds are flipped between failing and passing at known instants, while the real controller,
+server monitor, device monitor and device worker run against an in-memory device that records every write.
+
+The fake server runs in this interpreter, so that the flips and the writes are timed by the same clock. Every flip is
+made after a random delay, so that flips land at every phase of the polling cycle, as real builds finishing do.
+
+Run with python -m whatsthatlight.benchmark.bench_detection. The results are written as JSON to --output. With
+--baseline, they are compared with earlier results, and the exit status is non-zero on a regression.
+"""
+
+# System imports
+from __future__ import print_function
+import argparse
+import json
+import logging
+import random
+import sys
+import threading
+import time
+
+# Local imports
+from whatsthatlight import clients
+from whatsthatlight import controllers
+from whatsthatlight import devices
+from whatsthatlight import fake_teamcity
+from whatsthatlight import monitors
+from whatsthatlight.benchmark import utils
+
+# Constants
+_DEFAULT_POLLING_INTERVALS = '0.1,0.5,1'
+_DEFAULT_RTTS = '0,0.002'
+_DEFAULT_BUILD_TYPES = 100
+_DEFAULT_FLIPS = 20
+_DEFAULT_DEVICE_POLLING_INTERVAL = 1.0
+_DEFAULT_TOLERANCE = 0.2
+_DEFAULT_OUTPUT = 'bench_detection.json'
+# Not one of the fake server's users, so that only the flipped builds are this user's
+_USERNAME = 'benchmark'
+_PASSWORD = 'secret'
+_PASSING_STATE = (False, False)
+_FAILING_STATE = (False, True)
+# A flip not shown within this many polling intervals, or the minimum timeout, is counted as missed
+_TIMEOUT_INTERVALS = 10
+_MIN_TIMEOUT_SECONDS = 10.0
+# Lower is better for all of these
+_COMPARED_METRICS = ['detection_p50', 'detection_p95', 'missed']
+
+
+class RecordingDevice(devices.BaseDevice):
+    """
+    An in-memory device that records the time and build state of every write, and lets a caller wait for a state.
+    """
+
+    def __init__(self):
+        """
+        Constructor.
+        """
+        super(RecordingDevice, self).__init__(vendor_id=0, product_id=0, hidapi=_NullHidApi())
+        self._is_open = False
+        self._condition = threading.Condition()
+        self._writes = []
+
+    def get_vendor_id(self):
+        """
+        Get the vendor ID of the device.
+        """
+        return self._vendor_id
+
+    def get_product_id(self):
+        """
+        Get the product ID of the device.
+        """
+        return self._product_id
+
+    def open(self):
+        """
+        Open the device for communication.
+        """
+        self._is_open = True
+
+    def is_open(self):
+        """
+        Check whether the device is open for communication.
+        """
+        return self._is_open
+
+    def probe(self):
+        """
+        Check whether the device is present, which it always is.
+        """
+        return True
+
+    def send(self, any_builds_running, any_build_failures):
+        """
+        Record the build information.
+
+        :param any_builds_running: True if any builds running. None if unknown or undefined.
+        :param any_build_failures: True if any builds failing or failed. None if unknown or undefined.
+        """
+        with self._condition:
+            self._writes.append((time.time(), (any_builds_running, any_build_failures)))
+            self._condition.notify_all()
+
+    def off(self):
+        """
+        Switch off the LED.
+        """
+
+    def close(self):
+        """
+        Close the device for communication.
+        """
+        self._is_open = False
+
+    def wait_for(self, build_state, since, timeout):
+        """
+        Wait for the first write of a build state at or after a time.
+
+        :param build_state: A tuple of (any_builds_running, any_build_failures).
+        :param since: The time from which writes count.
+        :param timeout: The maximum time to wait, in seconds.
+        :return: The time of the write, or None if timed out.
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                for (written_at, written_state) in self._writes:
+                    if written_at >= since and written_state == build_state:
+                        return written_at
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+
+    def get_nr_of_writes(self):
+        """
+        Get the number of writes recorded.
+
+        :return: The number of writes.
+        """
+        with self._condition:
+            return len(self._writes)
+
+
+class _NullHidApi(object):
+    """
+    A stand-in for the HID API module, as the recording device never touches one.
+    """
+
+    @staticmethod
+    def device():
+        """
+        Create a device.
+
+        :return: None.
+        """
+        return None
+
+
+def _get_name(scenario):
+    """
+    Get a scenario's name.
+
+    :param scenario: A dictionary of the scenario's polling interval and round trip time.
+    :return: The name.
+    """
+    return 'polling_interval={0:g},rtt_ms={1:g}'.format(scenario['polling_interval'], 1000 * scenario['rtt'])
+
+
+def run_scenario(scenario):
+    """
+    Run a scenario: Start the controller against a fake server, flip a build between failing and passing, and time
+    each flip until the device shows it.
+
+    :param scenario: A dictionary of the scenario's polling interval, round trip time, build types, flips, device
+                     polling interval, persistent handle, keep-alive interval and seed.
+    :return: A dictionary of the scenario's results.
+    """
+    rng = random.Random(scenario['seed'])
+    data = fake_teamcity.FakeTeamCityData(seed=scenario['seed'],
+                                          nr_of_projects=max(1, scenario['build_types'] // 10),
+                                          nr_of_build_types=scenario['build_types'],
+                                          failure_rate=0.0,
+                                          running_rate=0.0)
+    build_type_id = data.build_types[0]['id']
+    server = fake_teamcity.FakeTeamCityServer(data=data, latency=scenario['rtt'])
+    server.start()
+    client = clients.TeamCityClient(server_url=server.get_url(), username=_USERNAME, password=_PASSWORD)
+    device = RecordingDevice()
+    device_worker = devices.DeviceWorker(device=device)
+    device_monitor = monitors.create_device_monitor(device=device_worker,
+                                                    backend='polling',
+                                                    polling_interval=scenario['device_polling_interval'],
+                                                    probe_by_enumeration=scenario['persistent'])
+    server_monitor = monitors.ServerMonitor(client=client, polling_interval=scenario['polling_interval'])
+    controller = controllers.Controller(device=device_worker,
+                                        device_monitor=device_monitor,
+                                        server_monitor=server_monitor,
+                                        persistent=scenario['persistent'],
+                                        keep_alive_interval=scenario['keep_alive_interval'])
+    timeout = max(_MIN_TIMEOUT_SECONDS, _TIMEOUT_INTERVALS * scenario['polling_interval'])
+    latencies = []
+    missed = 0
+    device_worker.start()
+    controller.start()
+    try:
+        # The light must show the passing state before the first flip
+        if device.wait_for(_PASSING_STATE, 0, timeout) is None:
+            raise RuntimeError('The light never showed the initial build state')
+        server.reset_request_counts()
+        for flip in range(scenario['flips']):
+            time.sleep(rng.uniform(0, scenario['polling_interval']))
+            (status, build_state) = ('FAILURE', _FAILING_STATE) if flip % 2 == 0 else ('SUCCESS', _PASSING_STATE)
+            flipped_at = time.time()
+            data.add_build(build_type_id, status, username=_USERNAME)
+            written_at = device.wait_for(build_state, flipped_at, timeout)
+            if written_at is None:
+                missed += 1
+                # Wait for the light to catch up, so that the next flip is timed from a known state
+                device.wait_for(build_state, flipped_at, timeout)
+            else:
+                latencies.append(written_at - flipped_at)
+        nr_of_requests = sum(server.get_request_counts().values())
+    finally:
+        controller.stop()
+        device_worker.stop()
+        server.stop()
+    if not latencies:
+        raise RuntimeError('No flip was shown')
+    summary = utils.summarise(latencies)
+    return {'name': _get_name(scenario),
+            'scenario': scenario,
+            'flips': scenario['flips'],
+            'missed': missed,
+            'detection_min': summary['min'],
+            'detection_mean': summary['mean'],
+            'detection_p50': summary['p50'],
+            'detection_p95': summary['p95'],
+            'detection_p99': summary['p99'],
+            'detection_max': summary['max'],
+            'requests_per_flip': nr_of_requests / float(scenario['flips']),
+            'writes': device.get_nr_of_writes()}
+
+
+def _parse_list(text, parse):
+    """
+    Parse a comma-separated list.
+
+    :param text: The list.
+    :param parse: A function to parse every item.
+    :return: A list.
+    """
+    return [parse(item) for item in text.split(',') if item]
+
+
+def main():
+    """
+    Run the benchmark, print a summary, write the results and exit with a non-zero status on a regression.
+    """
+    parser = argparse.ArgumentParser(description='Detection latency benchmark.')
+    parser.add_argument('--polling-intervals', default=_DEFAULT_POLLING_INTERVALS,
+                        help='The server polling intervals in seconds, e.g. 1,5.')
+    parser.add_argument('--rtts', default=_DEFAULT_RTTS, help='The round trip times in seconds, e.g. 0,0.05.')
+    parser.add_argument('--build-types', type=int, default=_DEFAULT_BUILD_TYPES, help='The number of build types.')
+    parser.add_argument('--flips', type=int, default=_DEFAULT_FLIPS, help='The number of build state flips to time.')
+    parser.add_argument('--device-polling-interval', type=float, default=_DEFAULT_DEVICE_POLLING_INTERVAL,
+                        help='The device monitor\'s polling interval in seconds.')
+    parser.add_argument('--persistent', action='store_true', help='Keep the device open, instead of per write.')
+    parser.add_argument('--keep-alive-interval', type=float,
+                        help='The interval in seconds after which an unchanged build state is written again.')
+    parser.add_argument('--seed', type=int, default=0, help='The seed of the data and the flip delays.')
+    parser.add_argument('--output', default=_DEFAULT_OUTPUT, help='The file to write the results to, as JSON.')
+    parser.add_argument('--baseline', help='Results to compare with, as written to --output before.')
+    parser.add_argument('--tolerance', type=float, default=_DEFAULT_TOLERANCE,
+                        help='The fraction by which a metric may exceed its baseline.')
+    arguments = parser.parse_args()
+    logging.basicConfig()
+    print('{0:<32} {1:>6} {2:>9} {3:>9} {4:>9} {5:>9} {6:>9}'.format('scenario', 'missed', 'min ms', 'p50 ms',
+                                                                     'p95 ms', 'max ms', 'requests'))
+    results = []
+    for polling_interval in _parse_list(arguments.polling_intervals, float):
+        for rtt in _parse_list(arguments.rtts, float):
+            result = run_scenario({'polling_interval': polling_interval,
+                                   'rtt': rtt,
+                                   'build_types': arguments.build_types,
+                                   'flips': arguments.flips,
+                                   'device_polling_interval': arguments.device_polling_interval,
+                                   'persistent': arguments.persistent,
+                                   'keep_alive_interval': arguments.keep_alive_interval,
+                                   'seed': arguments.seed})
+            results.append(result)
+            print('{0:<32} {1:>6} {2:>9.1f} {3:>9.1f} {4:>9.1f} {5:>9.1f} {6:>9.1f}'.format(
+                result['name'],
+                result['missed'],
+                1000 * result['detection_min'],
+                1000 * result['detection_p50'],
+                1000 * result['detection_p95'],
+                1000 * result['detection_max'],
+                result['requests_per_flip']))
+    with open(arguments.output, 'w') as output_file:
+        json.dump({'python': sys.version.split()[0], 'results': results}, output_file, indent=2, sort_keys=True)
+    regressions = []
+    if arguments.baseline:
+        with open(arguments.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = utils.find_regressions(dict((result['name'], result) for result in results),
+                                             dict((result['name'], result) for result in baseline['results']),
+                                             _COMPARED_METRICS,
+                                             arguments.tolerance)
+    for regression in regressions:
+        print(regression, file=sys.stderr)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
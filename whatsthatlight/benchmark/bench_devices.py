@@ -0,0 +1,190 @@
+# Copyright 2013 Pieter Rautenbach
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Device write latency benchmark: Opening, sending and closing per update, versus a persistent handle.
+
+Run with python -m whatsthatlight.benchmark.bench_devices. Without --hid-module, a simulated device is used.
+"""
+
+# System imports
+from __future__ import print_function
+import argparse
+import importlib
+import timeit
+
+# Local imports
+from whatsthatlight import devices
+from whatsthatlight.benchmark import utils
+
+# Constants
+_DEFAULT_ITERATIONS = 200
+_DEFAULT_VENDOR_ID = 0x27b8
+_DEFAULT_PRODUCT_ID = 0x01ed
+# Rough USB round trip costs for the simulated device, in seconds
+_SIMULATED_OPEN_SECONDS = 0.004
+_SIMULATED_WRITE_SECONDS = 0.001
+_SIMULATED_CLOSE_SECONDS = 0.002
+_STATES = [(True, False), (False, True), (False, False), (None, None)]
+
+
+class SimulatedHidApi(object):
+    """
+    A stand-in for the HID API module, which simulates the cost of USB round trips.
+    """
+
+    def __init__(self,
+                 open_seconds=_SIMULATED_OPEN_SECONDS,
+                 write_seconds=_SIMULATED_WRITE_SECONDS,
+                 close_seconds=_SIMULATED_CLOSE_SECONDS):
+        """
+        Constructor.
+
+        :param open_seconds: The time an open takes.
+        :param write_seconds: The time a write takes.
+        :param close_seconds: The time a close takes.
+        """
+        self.open_seconds = open_seconds
+        self.write_seconds = write_seconds
+        self.close_seconds = close_seconds
+
+    def device(self):
+        """
+        Create a device.
+
+        :return: A simulated device.
+        """
+        return _SimulatedHidDevice(self)
+
+    @staticmethod
+    def enumerate(vendor_id=0, product_id=0):
+        """
+        Enumerate devices.
+
+        :param vendor_id: The device's VID.
+        :param product_id: The device's PID.
+        :return: A list with one simulated device.
+        """
+        return [{'path': 'simulated', 'vendor_id': vendor_id, 'product_id': product_id}]
+
+
+class _SimulatedHidDevice(object):
+    """
+    A simulated HID device.
+    """
+
+    def __init__(self, hidapi):
+        """
+        Constructor.
+
+        :param hidapi: The simulated HID API, with the costs.
+        """
+        self._hidapi = hidapi
+
+    def open(self, _vendor_id, _product_id):
+        """
+        Open the device.
+        """
+        _busy_wait(self._hidapi.open_seconds)
+
+    def open_path(self, _path):
+        """
+        Open the device by path.
+        """
+        _busy_wait(self._hidapi.open_seconds)
+
+    def write(self, data):
+        """
+        Write to the device.
+
+        :param data: Binary data.
+        :return: The number of bytes written.
+        """
+        _busy_wait(self._hidapi.write_seconds)
+        return len(data)
+
+    def close(self):
+        """
+        Close the device.
+        """
+        _busy_wait(self._hidapi.close_seconds)
+
+
+def _busy_wait(seconds):
+    """
+    Wait without sleeping, as sleeps are too coarse for these durations.
+
+    :param seconds: The time to wait.
+    """
+    end = timeit.default_timer() + seconds
+    while timeit.default_timer() < end:
+        pass
+
+
+def measure(device, persistent, iterations):
+    """
+    Measure the latency of state updates.
+
+    :param device: A device.
+    :param persistent: Whether to keep the device open, instead of opening and closing it for every update.
+    :param iterations: The number of updates.
+    :return: A list of latencies in seconds.
+    """
+    latencies = []
+    if persistent:
+        device.open()
+    for iteration in range(iterations):
+        (any_builds_running, any_build_failures) = _STATES[iteration % len(_STATES)]
+        start = timeit.default_timer()
+        if persistent:
+            device.send(any_builds_running, any_build_failures)
+        else:
+            device.open()
+            device.send(any_builds_running, any_build_failures)
+            device.close()
+        latencies.append(timeit.default_timer() - start)
+    if persistent:
+        device.off()
+        device.close()
+    return latencies
+
+
+def main():
+    """
+    Run the benchmark and print a summary.
+    """
+    parser = argparse.ArgumentParser(description='Device write latency benchmark.')
+    parser.add_argument('--hid-module', help='The HID API module of an actual device, e.g. hid. Simulated if omitted.')
+    parser.add_argument('--vid', type=lambda value: int(value, 0), default=_DEFAULT_VENDOR_ID, help='The vendor ID.')
+    parser.add_argument('--pid', type=lambda value: int(value, 0), default=_DEFAULT_PRODUCT_ID, help='The product ID.')
+    parser.add_argument('--iterations', type=int, default=_DEFAULT_ITERATIONS, help='The number of updates per mode.')
+    arguments = parser.parse_args()
+    hidapi = importlib.import_module(arguments.hid_module) if arguments.hid_module else SimulatedHidApi()
+    print('{0:<12} {1:>9} {2:>9} {3:>9} {4:>9} {5:>9}'.format('mode', 'min ms', 'mean ms', 'p50 ms', 'p95 ms', 'max ms'))
+    for (mode, persistent) in (('per-update', False), ('persistent', True)):
+        device = devices.HidApiDevice(vendor_id=arguments.vid,
+                                      product_id=arguments.pid,
+                                      hidapi=hidapi,
+                                      persistent=persistent)
+        summary = utils.summarise(measure(device, persistent, arguments.iterations))
+        print('{0:<12} {1:>9.3f} {2:>9.3f} {3:>9.3f} {4:>9.3f} {5:>9.3f}'.format(mode,
+                                                                                 1000 * summary['min'],
+                                                                                 1000 * summary['mean'],
+                                                                                 1000 * summary['p50'],
+                                                                                 1000 * summary['p95'],
+                                                                                 1000 * summary['max']))
+
+
+if __name__ == '__main__':
+    main()
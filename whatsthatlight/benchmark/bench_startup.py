@@ -0,0 +1,105 @@
+# Copyright 2013 Pieter Rautenbach
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Startup time benchmark: The time a fresh interpreter takes to import the application's modules and create the client,
+and a check that modules deferred off the startup path aren't imported during it.
+
+Run with python -m whatsthatlight.benchmark.bench_startup. Exits with a non-zero status on a regression: a module
+that should be deferred was imported, or the median exceeded --max-ms.
+"""
+
+# System imports
+from __future__ import print_function
+import argparse
+import json
+import subprocess
+import sys
+import timeit
+
+# Local imports
+from whatsthatlight.benchmark import utils
+
+# Constants
+_DEFAULT_ITERATIONS = 10
+# Modules that are slow to import, and are only imported once needed, off the startup path
+_DEFERRED_MODULES = ['requests', 'ctypes', 'tempfile']
+# Run in a fresh interpreter, which prints the import time and the deferred modules that were imported as JSON
+_STARTUP_SCRIPT = '''
+import json
+import sys
+import timeit
+start = timeit.default_timer()
+from whatsthatlight import clients
+from whatsthatlight import config
+from whatsthatlight import config_utils
+from whatsthatlight import controllers
+from whatsthatlight import devices
+client = clients.TeamCityClient(server_url='http://localhost:8111/', username='admin', password='admin')
+seconds = timeit.default_timer() - start
+print(json.dumps({{'seconds': seconds, 'imported': [name for name in {0!r} if sys.modules.get(name)]}}))
+'''.format(_DEFERRED_MODULES)
+
+
+def measure(iterations):
+    """
+    Measure startup, each time in a fresh interpreter.
+
+    :param iterations: The number of interpreters to start.
+    :return: A tuple of a list of the startup times in seconds, a list of the interpreters' total run times in seconds,
+             and the set of deferred modules that were imported.
+    """
+    startup_times = []
+    run_times = []
+    imported = set()
+    for _ in range(iterations):
+        start = timeit.default_timer()
+        output = subprocess.check_output([sys.executable, '-c', _STARTUP_SCRIPT])
+        run_times.append(timeit.default_timer() - start)
+        result = json.loads(output.splitlines()[-1])
+        startup_times.append(result['seconds'])
+        imported.update(result['imported'])
+    return startup_times, run_times, imported
+
+
+def main():
+    """
+    Run the benchmark, print a summary and exit with a non-zero status on a regression.
+    """
+    parser = argparse.ArgumentParser(description='Startup time benchmark.')
+    parser.add_argument('--iterations', type=int, default=_DEFAULT_ITERATIONS, help='The number of interpreters.')
+    parser.add_argument('--max-ms', type=float, help='Fail if the median startup time exceeds this, in milliseconds.')
+    arguments = parser.parse_args()
+    (startup_times, run_times, imported) = measure(arguments.iterations)
+    print('{0:<12} {1:>9} {2:>9} {3:>9} {4:>9} {5:>9}'.format('phase', 'min ms', 'mean ms', 'p50 ms', 'p95 ms', 'max ms'))
+    for (phase, times) in (('imports', startup_times), ('interpreter', run_times)):
+        summary = utils.summarise(times)
+        print('{0:<12} {1:>9.3f} {2:>9.3f} {3:>9.3f} {4:>9.3f} {5:>9.3f}'.format(phase,
+                                                                                 1000 * summary['min'],
+                                                                                 1000 * summary['mean'],
+                                                                                 1000 * summary['p50'],
+                                                                                 1000 * summary['p95'],
+                                                                                 1000 * summary['max']))
+    regressions = []
+    if imported:
+        regressions.append('Deferred modules imported at startup: {0}'.format(', '.join(sorted(imported))))
+    if arguments.max_ms is not None and 1000 * utils.percentile(startup_times, 0.5) > arguments.max_ms:
+        regressions.append('Median startup time exceeds {0} ms'.format(arguments.max_ms))
+    for regression in regressions:
+        print(regression, file=sys.stderr)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# Copyright 2013 Pieter Rautenbach
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark utilities.
+"""
+
+# System imports
+import math
+
+
+def percentile(values, fraction):
+    """
+    Get a percentile of values, by the nearest-rank method.
+
+    :param values: A non-empty list of numbers.
+    :param fraction: The percentile as a fraction, e.g. 0.95.
+    :return: The value at the percentile.
+    """
+    ordered = sorted(values)
+    rank = int(math.ceil(fraction * len(ordered))) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+
+def summarise(values):
+    """
+    Summarise a list of measurements.
+
+    :param values: A non-empty list of numbers.
+    :return: A dictionary of the count, minimum, mean, median, 95th and 99th percentiles, and maximum.
+    """
+    return {'count': len(values),
+            'min': min(values),
+            'mean': sum(values) / float(len(values)),
+            'p50': percentile(values, 0.5),
+            'p95': percentile(values, 0.95),
+            'p99': percentile(values, 0.99),
+            'max': max(values)}
+
+
+def find_regressions(results, baseline, metrics, tolerance):
+    """
+    Compare results with a baseline, for metrics that got worse by more than a tolerance. Lower is better for every
+    metric.
+
+    :param results: A dictionary of result dictionaries, by name, e.g. of a scenario.
+    :param baseline: A dictionary of the baseline's result dictionaries, by name. Names without a baseline are skipped.
+    :param metrics: The keys of the metrics to compare.
+    :param tolerance: The fraction by which a metric may exceed its baseline, e.g. 0.2.
+    :return: A list of descriptions of the regressions.
+    """
+    regressions = []
+    for (name, result) in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for metric in metrics:
+            (value, baseline_value) = (result.get(metric), baseline[name].get(metric))
+            if value is None or baseline_value is None:
+                continue
+            if value > baseline_value * (1 + tolerance):
+                regressions.append('{0}: {1} is {2:.6g}, the baseline is {3:.6g}'.format(name,
+                                                                                         metric,
+                                                                                         value,
+                                                                                         baseline_value))
+    return regressions
@@ -18,11 +18,10 @@ Various build server clients.
 
 # System imports
 import abc
+import re
+import time
 import urlparse
 
-# Third-party imports
-import requests
-
 
 class BaseClient(object):
     """
@@ -30,6 +29,9 @@ class BaseClient(object):
     """
     __metaclass__ = abc.ABCMeta
 
+    # The status of an instrumented request that received no response
+    ERROR_STATUS = 'error'
+
     def __init__(self, server_url, username, password):
         """
         Constructor.
@@ -42,11 +44,16 @@ class BaseClient(object):
         self._username = username
         self._password = password
         self._session = None
+        self._running_progress = None
+        self._trace = None
+        self._request_hook = None
 
     def connect(self):
         """
         Connect to the API.
         """
+        # Imported when connecting, as it is slow to import and the server monitor connects on its own thread
+        import requests
         self._session = requests.Session()
         self._session.auth = (self._username, self._password)
         self._session.headers.update({
@@ -59,6 +66,62 @@ class BaseClient(object):
         """
         self._session = None
 
+    def reconfigure(self, server_url, username, password):
+        """
+        Change the server and credentials while connected. The session, and so its open connections, is kept.
+
+        :param server_url: The base URL to the build server's API.
+        :param username: The username for the API, which is also the user for which the API is checked.
+        :param password: The password for the provided username.
+        """
+        self._server_url = server_url
+        self._username = username
+        self._password = password
+        if self._session:
+            self._session.auth = (self._username, self._password)
+
+    def set_trace(self, trace):
+        """
+        Set the trace to record the next check in, for clients that can.
+
+        :param trace: A CycleTrace, or None to stop tracing.
+        """
+        self._trace = trace
+
+    def set_request_hook(self, request_hook):
+        """
+        Set a hook to instrument every request with, for clients that can. The hook is called on the thread that
+        checks the server, so it must be quick. It must have these methods:
+
+        observe_request(endpoint, kind, status, nr_of_bytes, first_byte_seconds, total_seconds, decode_seconds), where
+        endpoint is the resource with IDs normalised, e.g. /builds/id:{id}, status is the HTTP status, or ERROR_STATUS if
+        no response was received, first_byte_seconds is the time until the response's headers were received (including
+        connecting, for a new connection), total_seconds is the time until the body was received, and decode_seconds is
+        the time decoding the JSON took. Failed requests and responses that aren't JSON are observed too.
+
+        observe_cache(kind, hit), where kind is the kind of resource that was (on a miss) or wasn't (on a hit)
+        requested, for information that is cached.
+
+        :param request_hook: The hook, e.g. a metrics RequestMetrics, or None to stop instrumenting.
+        """
+        self._request_hook = request_hook
+
+    def get_server_url(self):
+        """
+        Get the base URL to the build server's API.
+
+        :return: The URL.
+        """
+        return self._server_url
+
+    def get_username(self):
+        """
+        Get the user for which the API is checked.
+
+        :return: The username.
+        """
+        return self._username
+
     @abc.abstractmethod  # pragma: no cover
     def any_builds_running(self):
         """
@@ -75,12 +138,71 @@ class BaseClient(object):
         :return: True if there are one or more builds have failed or are failing.
         """
 
+    def get_running_progress(self):
+        """
+        Get the progress of the running build found by the last check, for clients that report it.
+
+        :return: The progress as a fraction, or None if unknown or no builds are running.
+        """
+        return self._running_progress
+
+    def create_index(self):
+        """
+        Check the builds once and index them by the users they affect. By default, only this client's user is indexed;
+        clients that can check for all users at once override this.
+
+        :return: A BuildIndex.
+        """
+        index = BuildIndex(self._username)
+        if self.any_builds_running():
+            index.add_running_build(None, [self._username], self.get_running_progress())
+        if self.any_build_failures():
+            index.add_failed_build(None, [self._username])
+        return index
+
 
 class TeamCityClient(BaseClient):
     """
     A TeamCity API client.
     """
 
+    def __init__(self, server_url, username, password):
+        """
+        Constructor.
+
+        :param server_url: The base URL to the build server's API.
+        :param username: The username for the API, which is also the user for which the API is checked.
+        :param password: The password for the provided username.
+        """
+        super(TeamCityClient, self).__init__(server_url, username, password)
+        self._rules = None
+        # The users affected by a build never change, so they are kept by build ID for as long as the build is found
+        self._affected_usernames = {}
+        # Normalising a resource is slow compared to instrumenting its request, and most resources are requested every
+        # check, so their endpoints and kinds are kept, up to a limit
+        self._endpoints = {}
+
+    def reconfigure(self, server_url, username, password):
+        """
+        Change the server and credentials while connected. The session and cached build information are kept, unless
+        the server changed.
+
+        :param server_url: The base URL to the build server's API.
+        :param username: The username for the API, which is also the user for which the API is checked.
+        :param password: The password for the provided username.
+        """
+        if server_url != self._server_url:
+            self._affected_usernames = {}
+        super(TeamCityClient, self).reconfigure(server_url, username, password)
+
+    def set_rules(self, rules):
+        """
+        Set the routing rules of the builds to check. Build types that are excluded are never requested.
+
+        :param rules: RoutingRules, or None to check all builds.
+        """
+        self._rules = rules
+
     # Attributes
     _COUNT_ATTRIBUTE = 'count'
     _HREF_ATTRIBUTE = 'href'
@@ -94,6 +216,12 @@ class TeamCityClient(BaseClient):
     _USERNAME_ATTRIBUTE = 'username'
     _CHANGES_ATTRIBUTE = 'changes'
     _CHANGE_ATTRIBUTE = 'change'
+    _PERCENTAGE_COMPLETE_ATTRIBUTE = 'percentageComplete'
+    _BUILD_TYPE_ID_ATTRIBUTE = 'buildTypeId'
+    _PROJECT_ID_ATTRIBUTE = 'projectId'
+    _TAGS_ATTRIBUTE = 'tags'
+    _TAG_ATTRIBUTE = 'tag'
+    _NAME_ATTRIBUTE = 'name'
 
     # Resources
     _RUNNING_BUILDS_RESOURCE = '/httpAuth/app/rest/builds/?locator=personal:false,canceled:false,running:true'
@@ -101,6 +229,48 @@ class TeamCityClient(BaseClient):
     _BUILD_TYPE_RESOURCE_TEMPLATE = ('/httpAuth/app/rest/builds/?locator=buildType:{build_type_id},status:FAILURE,personal:false,'
                                      'canceled:false,running:any,sinceBuild:status:SUCCESS')
 
+    # Resource IDs, normalised in endpoints
+    _ID_PATTERN = re.compile(r'\b(id|buildType):[^,)/?&]+')
+    _ID_REPLACEMENT = r'\1:{id}'
+    _MAX_NR_OF_ENDPOINTS = 1024
+
+    # Resource kinds
+    BUILD_TYPES_KIND = 'buildTypes'
+    BUILDS_KIND = 'builds'
+    BUILD_DETAIL_KIND = 'build detail'
+    CHANGES_KIND = 'changes'
+    OTHER_KIND = 'other'
+
+    @classmethod
+    def get_endpoint(cls, resource):
+        """
+        Get the endpoint of a resource: the resource with the IDs of build types, builds, changes and so on normalised,
+        so that requests can be grouped.
+
+        :param resource: The HTTP resource.
+        :return: The endpoint, e.g. /httpAuth/app/rest/builds/id:{id} for /httpAuth/app/rest/builds/id:1234.
+        """
+        return cls._ID_PATTERN.sub(cls._ID_REPLACEMENT, resource)
+
+    @classmethod
+    def get_resource_kind(cls, resource):
+        """
+        Get the kind of a resource, to tell apart the requests of a check.
+
+        :param resource: The HTTP resource, or its endpoint.
+        :return: One of the build types, builds, build detail, changes (including change details) or other kinds.
+        """
+        path = resource.split('?', 1)[0].rstrip('/')
+        if path.endswith('/buildTypes'):
+            return cls.BUILD_TYPES_KIND
+        elif path.endswith('/builds'):
+            return cls.BUILDS_KIND
+        elif '/builds/' in path:
+            return cls.BUILD_DETAIL_KIND
+        elif '/changes' in path:
+            return cls.CHANGES_KIND
+        return cls.OTHER_KIND
+
     def _get_resource(self, resource):
         """
         Get a resource on the API.
@@ -109,7 +279,78 @@ class TeamCityClient(BaseClient):
         :return: A dictionary of JSON.
         """
         url = urlparse.urljoin(self._server_url, resource)
-        return self._session.get(url).json()
+        trace = self._trace
+        request_hook = self._request_hook
+        if trace is None and request_hook is None:
+            return self._session.get(url).json()
+        started_at = time.time()
+        (response, received_at, decoded_at) = (None, None, None)
+        try:
+            response = self._session.get(url)
+            received_at = time.time()
+            data = response.json()
+            decoded_at = time.time()
+            return data
+        finally:
+            # Also failed requests and responses that aren't JSON, e.g. an error page
+            self._observe_request(resource, started_at, response, received_at, decoded_at)
+
+    def _observe_request(self, resource, started_at, response, received_at, decoded_at):
+        """
+        Observe a request with the request hook and trace, if set.
+
+        :param resource: The HTTP resource.
+        :param started_at: The time the request was made.
+        :param response: The response, or None if none was received.
+        :param received_at: The time the response was received, or None if it wasn't.
+        :param decoded_at: The time the response was decoded, or None if it couldn't be.
+        """
+        finished_at = time.time()
+        (endpoint, kind) = self._get_endpoint_and_kind(resource)
+        if response is None:
+            (status, nr_of_bytes) = (self.ERROR_STATUS, 0)
+            seconds = first_byte_seconds = finished_at - started_at
+            decode_seconds = 0.0
+        else:
+            (status, nr_of_bytes) = (response.status_code, len(response.content))
+            seconds = received_at - started_at
+            # The time until the response's headers were parsed
+            first_byte_seconds = response.elapsed.total_seconds()
+            decode_seconds = (decoded_at or finished_at) - received_at
+        request_hook = self._request_hook
+        if request_hook is not None:
+            request_hook.observe_request(endpoint,
+                                         kind,
+                                         status,
+                                         nr_of_bytes,
+                                         first_byte_seconds,
+                                         seconds,
+                                         decode_seconds)
+        trace = self._trace
+        if trace is not None:
+            trace.add_request(kind,
+                              resource,
+                              seconds,
+                              nr_of_bytes,
+                              endpoint=endpoint,
+                              status=status,
+                              first_byte_seconds=first_byte_seconds,
+                              decode_seconds=decode_seconds)
+
+    def _get_endpoint_and_kind(self, resource):
+        """
+        Get the endpoint and kind of a resource, from those kept if it was requested before.
+
+        :param resource: The HTTP resource.
+        :return: A tuple of the endpoint and the kind.
+        """
+        endpoint_and_kind = self._endpoints.get(resource)
+        if endpoint_and_kind is None:
+            if len(self._endpoints) >= self._MAX_NR_OF_ENDPOINTS:
+                self._endpoints.clear()
+            endpoint = self.get_endpoint(resource)
+            endpoint_and_kind = self._endpoints[resource] = (endpoint, self.get_resource_kind(endpoint))
+        return endpoint_and_kind
 
     def _get_running_builds(self):
         """
@@ -134,10 +375,17 @@ class TeamCityClient(BaseClient):
         if self._COUNT_ATTRIBUTE in build_types and build_types[self._COUNT_ATTRIBUTE] > 0:
             for build_type in build_types[self._BUILD_TYPE_ATTRIBUTE]:
                 build_type_id = build_type[self._ID_ATTRIBUTE]
+                if self._rules and not self._rules.matches_build_type(build_type_id,
+                                                                      build_type.get(self._PROJECT_ID_ATTRIBUTE)):
+                    continue
                 build_type_resource = self._BUILD_TYPE_RESOURCE_TEMPLATE.format(build_type_id=build_type_id)
+                started_at = time.time()
                 failed_builds = self._get_resource(build_type_resource)
-                if self._COUNT_ATTRIBUTE in failed_builds and failed_builds[self._COUNT_ATTRIBUTE] > 0:
+                nr_of_failed_builds = failed_builds.get(self._COUNT_ATTRIBUTE, 0)
+                if nr_of_failed_builds > 0:
                     builds.extend(failed_builds[self._BUILD_ATTRIBUTE])
+                if self._trace is not None:
+                    self._trace.add_build_type(build_type_id, time.time() - started_at, nr_of_failed_builds)
         return builds
 
     def _is_triggered_by_user(self, build):
@@ -177,6 +425,26 @@ class TeamCityClient(BaseClient):
         """
         return self._user_is_contributor_to_build(build) or self._is_triggered_by_user(build)
 
+    def _find_affected_build(self, builds):
+        """
+        Iterate over builds and return the details of the first build affected by the user.
+
+        :param builds: A list of builds.
+        :return: The build JSON, or None if no build is affected by the user.
+        """
+        for build in builds:
+            started_at = time.time()
+            build_details = self._get_resource(build[self._HREF_ATTRIBUTE])
+            is_affected = ((not self._rules or self._rules.matches_build(*self._get_build_routing(build_details))) and
+                           self._is_affected_by_user(build_details))
+            if self._trace is not None:
+                self._trace.add_build(build.get(self._ID_ATTRIBUTE),
+                                      build_details.get(self._BUILD_TYPE_ID_ATTRIBUTE),
+                                      time.time() - started_at)
+            if is_affected:
+                return build_details
+        return None
+
     def _any_builds_helper(self, builds):
         """
         Iterate over builds returned by the callable method and return True if any build is affected by the user.
@@ -184,19 +452,21 @@ class TeamCityClient(BaseClient):
         :param builds: A list of builds.
         :return: True if a build is affected by the user.
         """
-        for build in builds:
-            build_details = self._get_resource(build[self._HREF_ATTRIBUTE])
-            if self._is_affected_by_user(build_details):
-                return True
-        return False
+        return self._find_affected_build(builds) is not None
 
     def any_builds_running(self):
         """
-        Checks whether any builds are running or not.
+        Checks whether any builds are running or not. The progress of the running build is kept, if reported.
 
         :return: True if there are one or more builds running.
         """
-        return self._any_builds_helper(self._get_running_builds())
+        self._running_progress = None
+        build = self._find_affected_build(self._get_running_builds())
+        if build is None:
+            return False
+        if self._PERCENTAGE_COMPLETE_ATTRIBUTE in build:
+            self._running_progress = build[self._PERCENTAGE_COMPLETE_ATTRIBUTE] / 100.0
+        return True
 
     def any_build_failures(self):
         """
@@ -205,3 +475,197 @@ class TeamCityClient(BaseClient):
         :return: True if there are one or more builds have failed or are failing.
         """
         return self._any_builds_helper(self._get_failed_builds())
+
+    def _get_build_routing(self, build):
+        """
+        Get what a build is routed by.
+
+        :param build: The build JSON.
+        :return: A (build_type_id, project_id, tags) tuple; the project ID is None if unknown.
+        """
+        build_type = build.get(self._BUILD_TYPE_ATTRIBUTE, {})
+        tags = build.get(self._TAGS_ATTRIBUTE, {}).get(self._TAG_ATTRIBUTE, [])
+        return (build.get(self._BUILD_TYPE_ID_ATTRIBUTE, build_type.get(self._ID_ATTRIBUTE)),
+                build_type.get(self._PROJECT_ID_ATTRIBUTE),
+                frozenset(tag[self._NAME_ATTRIBUTE] for tag in tags))
+
+    def _find_affected_usernames(self, build):
+        """
+        Find all users affected by a build: The user who triggered it, and the users who contributed changes to it.
+
+        :param build: The build JSON.
+        :return: A frozen set of usernames.
+        """
+        usernames = set()
+        trigger = build.get(self._TRIGGERED_ATTRIBUTE, {})
+        if trigger.get(self._TYPE_ATTRIBUTE) == self._TYPE_USER:
+            usernames.add(trigger[self._USER_ATTRIBUTE][self._USERNAME_ATTRIBUTE])
+        changes_resource = build[self._CHANGES_ATTRIBUTE]
+        changes = self._get_resource(changes_resource[self._HREF_ATTRIBUTE])
+        if self._COUNT_ATTRIBUTE in changes and changes[self._COUNT_ATTRIBUTE] > 0:
+            for change in changes[self._CHANGE_ATTRIBUTE]:
+                change_detail = self._get_resource(change[self._HREF_ATTRIBUTE])
+                if self._USER_ATTRIBUTE in change_detail:
+                    usernames.add(change_detail[self._USER_ATTRIBUTE][self._USERNAME_ATTRIBUTE])
+        return frozenset(usernames)
+
+    def _get_affected_usernames(self, build, build_details=None):
+        """
+        Get all users affected by a build, and what it is routed by, from the cache if the build was seen before.
+
+        :param build: The build JSON, as listed.
+        :param build_details: The build's details, if already requested.
+        :return: A tuple of a frozen set of usernames and a (build_type_id, project_id, tags) tuple.
+        """
+        build_id = build[self._ID_ATTRIBUTE]
+        if build_id not in self._affected_usernames:
+            if self._request_hook is not None:
+                self._request_hook.observe_cache(self.BUILD_DETAIL_KIND, False)
+            if self._trace is not None:
+                self._trace.add_cache_miss()
+            if build_details is None:
+                build_details = self._get_resource(build[self._HREF_ATTRIBUTE])
+            self._affected_usernames[build_id] = (self._find_affected_usernames(build_details),
+                                                  self._get_build_routing(build_details))
+        else:
+            if self._request_hook is not None:
+                self._request_hook.observe_cache(self.BUILD_DETAIL_KIND, True)
+            if self._trace is not None:
+                self._trace.add_cache_hit()
+        return self._affected_usernames[build_id]
+
+    def create_index(self):
+        """
+        Check all running and failed builds once and index them by every user they affect, so that the state of any
+        number of users is known from one check. Only the details of running builds (for their progress) and of builds
+        not seen before are requested.
+
+        :return: A BuildIndex.
+        """
+        index = BuildIndex(self._username)
+        build_ids = set()
+        for build in self._get_running_builds():
+            started_at = time.time()
+            build_details = self._get_resource(build[self._HREF_ATTRIBUTE])
+            progress = build_details.get(self._PERCENTAGE_COMPLETE_ATTRIBUTE)
+            (usernames, routing) = self._get_affected_usernames(build, build_details)
+            build_ids.add(build[self._ID_ATTRIBUTE])
+            if self._trace is not None:
+                self._trace.add_build(build[self._ID_ATTRIBUTE], routing[0], time.time() - started_at)
+            if self._rules and not self._rules.matches_build(*routing):
+                continue
+            index.add_running_build(build[self._ID_ATTRIBUTE],
+                                    usernames,
+                                    progress / 100.0 if progress is not None else None,
+                                    routing)
+        for build in self._get_failed_builds():
+            started_at = time.time()
+            (usernames, routing) = self._get_affected_usernames(build)
+            build_ids.add(build[self._ID_ATTRIBUTE])
+            if self._trace is not None:
+                self._trace.add_build(build[self._ID_ATTRIBUTE], routing[0], time.time() - started_at)
+            if self._rules and not self._rules.matches_build(*routing):
+                continue
+            index.add_failed_build(build[self._ID_ATTRIBUTE], usernames, routing)
+        # Forget builds that are no longer running or failed
+        for build_id in set(self._affected_usernames) - build_ids:
+            del self._affected_usernames[build_id]
+        return index
+
+
+class BuildIndex(object):
+    """
+    The running and failed builds from one check of a build server, by the users they affect. Builds can be looked up
+    for routing rules, as long as it is known what the builds are routed by.
+    """
+
+    def __init__(self, username):
+        """
+        Constructor.
+
+        :param username: The user whose state is looked up if no username is given.
+        """
+        self._username = username
+        self._running_builds = {}
+        self._failed_builds = {}
+
+    def add_running_build(self, build_id, usernames, progress=None, routing=None):
+        """
+        Add a running build.
+
+        :param build_id: The build's ID.
+        :param usernames: The users affected by the build.
+        :param progress: The build's progress as a fraction, or None if unknown.
+        :param routing: A (build_type_id, project_id, tags) tuple, or None if unknown, in which case the build matches
+                        any routing rules.
+        """
+        for username in usernames:
+            self._running_builds.setdefault(username, []).append((build_id, progress, routing))
+
+    def add_failed_build(self, build_id, usernames, routing=None):
+        """
+        Add a failed build.
+
+        :param build_id: The build's ID.
+        :param usernames: The users affected by the build.
+        :param routing: A (build_type_id, project_id, tags) tuple, or None if unknown, in which case the build matches
+                        any routing rules.
+        """
+        for username in usernames:
+            self._failed_builds.setdefault(username, []).append((build_id, None, routing))
+
+    def any_builds_running(self, username=None, rules=None):
+        """
+        Checks whether any builds affected by a user are running.
+
+        :param username: The username. Defaults to the client's user.
+        :param rules: RoutingRules that the builds must match, or None.
+        :return: True if there are one or more builds running.
+        """
+        return bool(self._find_builds(self._running_builds, username, rules))
+
+    def any_build_failures(self, username=None, rules=None):
+        """
+        Checks whether any builds affected by a user have failed.
+
+        :param username: The username. Defaults to the client's user.
+        :param rules: RoutingRules that the builds must match, or None.
+        :return: True if there are one or more builds have failed or are failing.
+        """
+        return bool(self._find_builds(self._failed_builds, username, rules))
+
+    def get_running_progress(self, username=None, rules=None):
+        """
+        Get the progress of the first running build affected by a user.
+
+        :param username: The username. Defaults to the client's user.
+        :param rules: RoutingRules that the build must match, or None.
+        :return: The progress as a fraction, or None if unknown or no builds are running.
+        """
+        running_builds = self._find_builds(self._running_builds, username, rules)
+        return running_builds[0][1] if running_builds else None
+
+    def get_affected_builds(self, username=None, rules=None):
+        """
+        Get the IDs of the running and failed builds affected by a user.
+
+        :param username: The username. Defaults to the client's user.
+        :param rules: RoutingRules that the builds must match, or None.
+        :return: A tuple of lists of running and failed build IDs.
+        """
+        return ([build_id for (build_id, _, _) in self._find_builds(self._running_builds, username, rules)],
+                [build_id for (build_id, _, _) in self._find_builds(self._failed_builds, username, rules)])
+
+    def _find_builds(self, builds, username, rules):
+        """
+        Find the builds of a user that match routing rules.
+
+        :param builds: A dictionary of lists of (build_id, progress, routing) tuples by username.
+        :param username: The username. Defaults to the client's user.
+        :param rules: RoutingRules that the builds must match, or None.
+        :return: A list of (build_id, progress, routing) tuples.
+        """
+        user_builds = builds.get(username or self._username, [])
+        if rules is None:
+            return user_builds
+        return [build for build in user_builds if build[2] is None or rules.matches_build(*build[2])]
@@ -25,11 +25,85 @@ import ConfigParser as BuiltinConfigParser
 _DEFAULT_SECTION = 'DEFAULT'
 _DEVICE_SECTION = 'device'
 _SERVER_SECTION = 'server'
+# Sections of named devices, which override the device section
+_NAMED_DEVICE_SECTION_PREFIX = 'device:'
 # Default options
 # Generic (common/shared) options
 _NAMESPACE_OPTION = 'namespace'
 _CLASS_NAME_OPTION = 'class_name'
 _CONSTRUCTOR_ARGS_OPTION = 'args'
+_ROUTING_OPTION = 'routing'
+_POLLING_INTERVAL_OPTION = 'polling_interval'
+_STATE_FILE_OPTION = 'state_file'
+_STALE_AFTER_OPTION = 'stale_after'
+_TRACE_FILE_OPTION = 'trace_file'
+_METRICS_PORT_OPTION = 'metrics_port'
+_METRICS_HOST_OPTION = 'metrics_host'
+# Device options
+_MONITOR_OPTION = 'monitor'
+_HOTPLUG_SUBSYSTEM_OPTION = 'hotplug_subsystem'
+_PROBE_OPTION = 'probe'
+_MAX_POLLING_INTERVAL_OPTION = 'max_polling_interval'
+_PERSISTENT_OPTION = 'persistent'
+_KEEP_ALIVE_INTERVAL_OPTION = 'keep_alive_interval'
+_ANIMATIONS_OPTION = 'animations'
+_PATTERN_MEMORY_OPTION = 'pattern_memory'
+_ANIMATION_FRAME_RATE_OPTION = 'animation_frame_rate'
+_GAMMA_OPTION = 'gamma'
+_FADE_MILLIS_OPTION = 'fade_millis'
+_SERIAL_NUMBER_OPTION = 'serial_number'
+_USERNAME_OPTION = 'username'
+_WHITE_BALANCE_OPTION = 'white_balance'
+# Options that can be changed without a restart (colours are changed by their options, not by the args option)
+_RELOADABLE_DEVICE_OPTIONS = frozenset(['running_colour',
+                                        'success_colour',
+                                        'failure_colour',
+                                        'unknown_colour',
+                                        _GAMMA_OPTION,
+                                        _WHITE_BALANCE_OPTION,
+                                        _FADE_MILLIS_OPTION,
+                                        _ANIMATIONS_OPTION,
+                                        _PATTERN_MEMORY_OPTION,
+                                        _ANIMATION_FRAME_RATE_OPTION,
+                                        _KEEP_ALIVE_INTERVAL_OPTION,
+                                        _USERNAME_OPTION,
+                                        _ROUTING_OPTION])
+_RELOADABLE_SERVER_OPTIONS = frozenset(['server_url', 'username', 'password', _ROUTING_OPTION, _POLLING_INTERVAL_OPTION])
+# Default values
+_DEFAULT_MONITOR = 'polling'
+_DEFAULT_HOTPLUG_SUBSYSTEM = 'usb'
+# Option values
+_ENUMERATE_PROBE = 'enumerate'
+
+
+def get_device_names(config_parser):
+    """
+    Get the names of the devices that have their own [device:<name>] section.
+
+    :param config_parser: A configuration parser.
+    :returns: A list of names. Empty if only the device section is configured.
+    """
+    return [section[len(_NAMED_DEVICE_SECTION_PREFIX):] for section in config_parser.sections()
+            if section.startswith(_NAMED_DEVICE_SECTION_PREFIX)]
+
+
+def create_device_config_parser(config_parser, name):
+    """
+    Create a configuration parser for a named device, in which the device's own section overrides the options of the
+    device section, so that the device can be read with the same getters.
+
+    :param config_parser: A configuration parser.
+    :param name: The device's name.
+    :returns: A configuration parser.
+    """
+    device_config_parser = ConfigParser()
+    for section in config_parser.sections():
+        device_config_parser.add_section(section)
+        for (option, value) in config_parser.items(section, raw=True):
+            device_config_parser.set(section, option, value)
+    for (option, value) in config_parser.items(_NAMED_DEVICE_SECTION_PREFIX + name, raw=True):
+        device_config_parser.set(_DEVICE_SECTION, option, value)
+    return device_config_parser
 
 
 def get_device_namespace(config_parser):
@@ -62,6 +136,186 @@ def get_device_args(config_parser):
     return ast.literal_eval(config_parser.get(_DEVICE_SECTION, _CONSTRUCTOR_ARGS_OPTION))
 
 
+def get_device_monitor(config_parser):
+    """
+    Get the device monitor backend.
+
+    :param config_parser: A configuration parser.
+    :returns: One of hotplug, polling or auto.
+    """
+    if not config_parser.has_option(_DEVICE_SECTION, _MONITOR_OPTION):
+        return _DEFAULT_MONITOR
+    return config_parser.get(_DEVICE_SECTION, _MONITOR_OPTION)
+
+
+def get_device_hotplug_subsystem(config_parser):
+    """
+    Get the kernel subsystem whose events the hotplug device monitor watches.
+
+    :param config_parser: A configuration parser.
+    :returns: Either usb (for any backend) or hidraw (for the hidraw backend of hidapi only).
+    """
+    if not config_parser.has_option(_DEVICE_SECTION, _HOTPLUG_SUBSYSTEM_OPTION):
+        return _DEFAULT_HOTPLUG_SUBSYSTEM
+    return config_parser.get(_DEVICE_SECTION, _HOTPLUG_SUBSYSTEM_OPTION)
+
+
+def get_device_probe_by_enumeration(config_parser):
+    """
+    Get whether the device's presence is checked by enumeration, instead of by opening it.
+
+    :param config_parser: A configuration parser.
+    :returns: True if the probe option is enumerate.
+    """
+    if not config_parser.has_option(_DEVICE_SECTION, _PROBE_OPTION):
+        return False
+    return config_parser.get(_DEVICE_SECTION, _PROBE_OPTION) == _ENUMERATE_PROBE
+
+
+def get_device_max_polling_interval(config_parser):
+    """
+    Get the maximum device polling interval, to which polling backs off while the device is absent.
+
+    :param config_parser: A configuration parser.
+    :returns: The interval in seconds, or None if not configured.
+    """
+    if not config_parser.has_option(_DEVICE_SECTION, _MAX_POLLING_INTERVAL_OPTION):
+        return None
+    return config_parser.getfloat(_DEVICE_SECTION, _MAX_POLLING_INTERVAL_OPTION)
+
+
+def get_device_persistent(config_parser):
+    """
+    Get whether the device handle is kept open between writes.
+
+    :param config_parser: A configuration parser.
+    :returns: True if persistent.
+    """
+    if not config_parser.has_option(_DEVICE_SECTION, _PERSISTENT_OPTION):
+        return False
+    return config_parser.getboolean(_DEVICE_SECTION, _PERSISTENT_OPTION)
+
+
+def get_device_keep_alive_interval(config_parser):
+    """
+    Get the interval after which an unchanged build state is written to the device again.
+
+    :param config_parser: A configuration parser.
+    :returns: The interval in seconds, or None if not configured.
+    """
+    if not config_parser.has_option(_DEVICE_SECTION, _KEEP_ALIVE_INTERVAL_OPTION):
+        return None
+    return config_parser.getfloat(_DEVICE_SECTION, _KEEP_ALIVE_INTERVAL_OPTION)
+
+
+def get_device_animations(config_parser):
+    """
+    Get the animations of states.
+
+    :param config_parser: A configuration parser.
+    :returns: A dictionary of (effect, period_millis[, colour]) tuples by state. Empty if not configured.
+    """
+    if not config_parser.has_option(_DEVICE_SECTION, _ANIMATIONS_OPTION):
+        return {}
+    return ast.literal_eval(config_parser.get(_DEVICE_SECTION, _ANIMATIONS_OPTION))
+
+
+def get_device_pattern_memory(config_parser):
+    """
+    Get whether the device can store and play patterns.
+
+    :param config_parser: A configuration parser.
+    :returns: True if it can (the default).
+    """
+    if not config_parser.has_option(_DEVICE_SECTION, _PATTERN_MEMORY_OPTION):
+        return True
+    return config_parser.getboolean(_DEVICE_SECTION, _PATTERN_MEMORY_OPTION)
+
+
+def get_device_animation_frame_rate(config_parser):
+    """
+    Get the frame rate of animations played from the host.
+
+    :param config_parser: A configuration parser.
+    :returns: The frame rate in frames per second, or None if not configured.
+    """
+    if not config_parser.has_option(_DEVICE_SECTION, _ANIMATION_FRAME_RATE_OPTION):
+        return None
+    return config_parser.getfloat(_DEVICE_SECTION, _ANIMATION_FRAME_RATE_OPTION)
+
+
+def get_device_gamma(config_parser):
+    """
+    Get the gamma exponent to calibrate colours with.
+
+    :param config_parser: A configuration parser.
+    :returns: The gamma exponent, or None if not configured.
+    """
+    if not config_parser.has_option(_DEVICE_SECTION, _GAMMA_OPTION):
+        return None
+    return config_parser.getfloat(_DEVICE_SECTION, _GAMMA_OPTION)
+
+
+def get_device_white_balance(config_parser):
+    """
+    Get the channel gains to calibrate colours with.
+
+    :param config_parser: A configuration parser.
+    :returns: An (R, G, B) tuple of gains, or None if not configured.
+    """
+    if not config_parser.has_option(_DEVICE_SECTION, _WHITE_BALANCE_OPTION):
+        return None
+    return ast.literal_eval(config_parser.get(_DEVICE_SECTION, _WHITE_BALANCE_OPTION))
+
+
+def get_device_fade_millis(config_parser):
+    """
+    Get the time the device takes to fade to a new colour.
+
+    :param config_parser: A configuration parser.
+    :returns: The fade time in milliseconds, or None if not configured.
+    """
+    if not config_parser.has_option(_DEVICE_SECTION, _FADE_MILLIS_OPTION):
+        return None
+    return config_parser.getint(_DEVICE_SECTION, _FADE_MILLIS_OPTION)
+
+
+def get_device_serial_number(config_parser):
+    """
+    Get the serial number of the device.
+
+    :param config_parser: A configuration parser.
+    :returns: The serial number, or None if not configured.
+    """
+    if not config_parser.has_option(_DEVICE_SECTION, _SERIAL_NUMBER_OPTION):
+        return None
+    return config_parser.get(_DEVICE_SECTION, _SERIAL_NUMBER_OPTION)
+
+
+def get_device_username(config_parser):
+    """
+    Get the user whose build state the device shows.
+
+    :param config_parser: A configuration parser.
+    :returns: The username, or None for the server's user.
+    """
+    if not config_parser.has_option(_DEVICE_SECTION, _USERNAME_OPTION):
+        return None
+    return config_parser.get(_DEVICE_SECTION, _USERNAME_OPTION)
+
+
+def get_device_routing(config_parser):
+    """
+    Get the routing rules of the builds the device shows.
+
+    :param config_parser: A configuration parser.
+    :returns: A dictionary with include and exclude lists of rules, or None if not configured.
+    """
+    if not config_parser.has_option(_DEVICE_SECTION, _ROUTING_OPTION):
+        return None
+    return ast.literal_eval(config_parser.get(_DEVICE_SECTION, _ROUTING_OPTION))
+
+
 def get_client_namespace(config_parser):
     """
     Get the client namespace.
@@ -92,6 +346,116 @@ def get_client_args(config_parser):
     return ast.literal_eval(config_parser.get(_SERVER_SECTION, _CONSTRUCTOR_ARGS_OPTION))
 
 
+def get_client_routing(config_parser):
+    """
+    Get the routing rules of the builds the client checks.
+
+    :param config_parser: A configuration parser.
+    :returns: A dictionary with include and exclude lists of rules, or None if not configured.
+    """
+    if not config_parser.has_option(_SERVER_SECTION, _ROUTING_OPTION):
+        return None
+    return ast.literal_eval(config_parser.get(_SERVER_SECTION, _ROUTING_OPTION))
+
+
+def get_client_polling_interval(config_parser):
+    """
+    Get the interval between checks of the build server.
+
+    :param config_parser: A configuration parser.
+    :returns: The interval in seconds, or None if not configured.
+    """
+    if not config_parser.has_option(_SERVER_SECTION, _POLLING_INTERVAL_OPTION):
+        return None
+    return config_parser.getfloat(_SERVER_SECTION, _POLLING_INTERVAL_OPTION)
+
+
+def get_client_state_file(config_parser):
+    """
+    Get the path to the file the last build state is persisted to.
+
+    :param config_parser: A configuration parser.
+    :returns: The path, or None if the build state is not persisted.
+    """
+    if not config_parser.has_option(_SERVER_SECTION, _STATE_FILE_OPTION):
+        return None
+    return config_parser.get(_SERVER_SECTION, _STATE_FILE_OPTION)
+
+
+def get_client_stale_after(config_parser):
+    """
+    Get the age after which a persisted build state is shown as stale.
+
+    :param config_parser: A configuration parser.
+    :returns: The age in seconds, or None if never stale.
+    """
+    if not config_parser.has_option(_SERVER_SECTION, _STALE_AFTER_OPTION):
+        return None
+    return config_parser.getfloat(_SERVER_SECTION, _STALE_AFTER_OPTION)
+
+
+def get_client_trace_file(config_parser):
+    """
+    Get the path to the file a trace of every check of the build server is written to.
+
+    :param config_parser: A configuration parser.
+    :returns: The path, or None if checks are not traced.
+    """
+    if not config_parser.has_option(_SERVER_SECTION, _TRACE_FILE_OPTION):
+        return None
+    return config_parser.get(_SERVER_SECTION, _TRACE_FILE_OPTION)
+
+
+def get_metrics_port(config_parser):
+    """
+    Get the port metrics are served on, over HTTP in the Prometheus text format.
+
+    :param config_parser: A configuration parser.
+    :returns: The port, or None if metrics are not served.
+    """
+    if not config_parser.has_option(_SERVER_SECTION, _METRICS_PORT_OPTION):
+        return None
+    return config_parser.getint(_SERVER_SECTION, _METRICS_PORT_OPTION)
+
+
+def get_metrics_host(config_parser):
+    """
+    Get the address metrics are served on.
+
+    :param config_parser: A configuration parser.
+    :returns: The address, or None to serve on all addresses.
+    """
+    if not config_parser.has_option(_SERVER_SECTION, _METRICS_HOST_OPTION):
+        return None
+    return config_parser.get(_SERVER_SECTION, _METRICS_HOST_OPTION)
+
+
+def is_server_section(section):
+    """
+    Check whether a section configures the build server.
+
+    :param section: The section.
+    :returns: True if it does.
+    """
+    return section == _SERVER_SECTION
+
+
+def is_reloadable(section, option):
+    """
+    Check whether a change to an option can be applied without a restart.
+
+    :param section: The option's section.
+    :param option: The option, or None if the whole section was added or removed.
+    :returns: True if reloadable.
+    """
+    if section == _DEVICE_SECTION or section.startswith(_NAMED_DEVICE_SECTION_PREFIX):
+        # Named devices can't be added or removed
+        return option in _RELOADABLE_DEVICE_OPTIONS
+    elif section == _SERVER_SECTION:
+        return option in _RELOADABLE_SERVER_OPTIONS
+    return False
+
+
 class ConfigParser(BuiltinConfigParser.SafeConfigParser):
     """
     An extension of the built-in SafeConfigParser.
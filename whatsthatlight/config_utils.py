@@ -18,13 +18,27 @@ Configuration helper utilities.
 
 # System imports
 import argparse
+import atexit
+import errno
 import importlib
 import logging
 import logging.config
 import os
+import select
+import struct
+import threading
+import time
 
 # Local imports
 from whatsthatlight import config
+from whatsthatlight import controllers
+from whatsthatlight import devices
+from whatsthatlight import log_handlers
+from whatsthatlight import metrics
+from whatsthatlight import monitors
+from whatsthatlight import profiling
+from whatsthatlight import routing
+from whatsthatlight import tracing
 
 
 def create_config_parser(config_path):
@@ -43,14 +57,33 @@ def create_config_parser(config_path):
 
 def create_logger(config_path):
     """
-    Create the logger.
+    Create the logger. The configured handlers write on a background thread, and are flushed at exit.
 
     :param config_path: The configuration file path.
     """
     logging.config.fileConfig(config_path)
+    atexit.register(log_handlers.enqueue_handlers().stop)
     return logging.getLogger('build_light')
 
 
+def get_log_directory():
+    """
+    Get the directory of the log file, e.g. to write diagnostics next to it.
+
+    :return: The directory of the first file logged to, or the system's temporary directory if none.
+    """
+    loggers = [logging.getLogger()] + [logger for logger in logging.Logger.manager.loggerDict.values()
+                                       if isinstance(logger, logging.Logger)]
+    for logger in loggers:
+        for handler in logger.handlers:
+            # Handlers may be behind a queue
+            handler = getattr(handler, 'target', handler)
+            if isinstance(handler, logging.FileHandler):
+                return os.path.dirname(handler.baseFilename)
+    import tempfile
+    return tempfile.gettempdir()
+
+
 def load_device(config_parser):
     """
     Load a device from config.
@@ -63,7 +96,189 @@ def load_device(config_parser):
     args_list = list(config.get_device_args(config_parser))
     args_list[2] = importlib.import_module(args_list[2])
     args = tuple(args_list)
-    return construct_class(namespace, class_name, args)
+    serial_number = config.get_device_serial_number(config_parser)
+    kwargs = {'serial_number': serial_number} if serial_number else {}
+    device = construct_class(namespace, class_name, args, kwargs)
+    _create_device_configurator(config_parser)(device)
+    return device
+
+
+def _create_device_configurator(config_parser, previous_config_parser=None):
+    """
+    Create a function that applies the configuration of a device beyond its constructor. Everything is read and
+    validated up front, so that applying it can't fail half-way.
+
+    :param config_parser: A parsed configuration.
+    :param previous_config_parser: The configuration the device was loaded with, when reloading, in which case the
+                                   colours are applied too.
+    :return: A function which accepts the device.
+    """
+    colours = tuple(config.get_device_args(config_parser)[3:7])
+    for colour in colours:
+        _check_colour(colour)
+    gamma = config.get_device_gamma(config_parser)
+    if gamma is not None and not gamma > 0:
+        raise UnsupportedConfigError('The gamma must be positive: {0}'.format(gamma))
+    white_balance = config.get_device_white_balance(config_parser)
+    if white_balance is not None and (len(white_balance) != 3 or
+                                      not all(0 <= gain <= 1 for gain in white_balance)):
+        raise UnsupportedConfigError('The white balance must be three gains between 0 and 1: {0}'.format(white_balance))
+    fade_millis = config.get_device_fade_millis(config_parser)
+    if fade_millis is not None and not 0 <= fade_millis <= devices.HidApiDevice.MAX_FADE_MILLIS:
+        raise UnsupportedConfigError('The fade time must be between 0 and {0}ms: {1}'.format(devices.HidApiDevice.MAX_FADE_MILLIS,
+                                                                                             fade_millis))
+    # The fade time is only set if configured now, or before
+    set_fade_millis = fade_millis is not None or bool(previous_config_parser and
+                                                      config.get_device_fade_millis(previous_config_parser) is not None)
+    animations = config.get_device_animations(config_parser)
+    patterns = dict((state, devices.Pattern.create(*animation)) for (state, animation) in animations.iteritems())
+    for pattern in patterns.itervalues():
+        for (colour, _) in pattern.steps:
+            if colour is not None:
+                _check_colour(colour)
+        if len(pattern.steps) > devices.HidApiDevice.MAX_PATTERN_LINES:
+            raise UnsupportedConfigError('A pattern can have at most {0} steps'.format(devices.HidApiDevice.MAX_PATTERN_LINES))
+    # Patterns are only set if configured now, or before
+    set_patterns = bool(animations or (previous_config_parser and config.get_device_animations(previous_config_parser)))
+    pattern_memory = config.get_device_pattern_memory(config_parser)
+    frame_rate = config.get_device_animation_frame_rate(config_parser)
+
+    def _configure(device):
+        """
+        Apply the configuration.
+
+        :param device: The device.
+        """
+        if previous_config_parser:
+            device.set_colours(*colours)
+        device.set_calibration(gamma, white_balance)
+        if set_fade_millis:
+            device.set_fade_millis(fade_millis)
+        if set_patterns:
+            device.set_patterns(patterns, pattern_memory, frame_rate)
+
+    return _configure
+
+
+def _check_colour(colour):
+    """
+    Check that a colour is an RGB colour tuple.
+
+    :param colour: The colour.
+    :raises UnsupportedConfigError: If it isn't.
+    """
+    if (not isinstance(colour, tuple) or len(colour) != 3 or
+            not all(isinstance(component, int) and 0 <= component <= 255 for component in colour)):
+        raise UnsupportedConfigError('A colour must be three components between 0 and 255: {0}'.format(colour))
+
+
+def load_device_config_parsers(config_parser):
+    """
+    Load the configuration of every device.
+
+    :param config_parser: A parsed configuration.
+    :return: A list of (name, config parser) tuples, one per [device:<name>] section. If there are none, the device
+             section is the only device, named None.
+    """
+    names = config.get_device_names(config_parser)
+    if not names:
+        return [(None, config_parser)]
+    return [(name, config.create_device_config_parser(config_parser, name)) for name in names]
+
+
+def load_device_routing_rules(config_parser):
+    """
+    Load the routing rules of the builds a device shows from config.
+
+    :param config_parser: A parsed configuration.
+    :return: RoutingRules, or None if all builds are shown.
+    """
+    return routing.RoutingRules.create(config.get_device_routing(config_parser))
+
+
+def load_device_monitor(config_parser, device):
+    """
+    Load a device monitor from config.
+
+    :param config_parser: A parsed configuration.
+    :param device: The device to monitor.
+    :return: A device monitor.
+    """
+    return monitors.create_device_monitor(device=device,
+                                          backend=config.get_device_monitor(config_parser),
+                                          hotplug_subsystem=config.get_device_hotplug_subsystem(config_parser),
+                                          probe_by_enumeration=config.get_device_probe_by_enumeration(config_parser),
+                                          max_polling_interval=config.get_device_max_polling_interval(config_parser))
+
+
+def load_server_monitor(config_parser, client):
+    """
+    Load a server monitor from config.
+
+    :param config_parser: A parsed configuration.
+    :param client: The build server client to monitor with.
+    :return: A server monitor.
+    """
+    polling_interval = config.get_client_polling_interval(config_parser)
+    if polling_interval is None:
+        return monitors.ServerMonitor(client=client)
+    return monitors.ServerMonitor(client=client, polling_interval=polling_interval)
+
+
+def load_state_store(config_parser, client, name=None):
+    """
+    Load the store of a device's last build state from config.
+
+    :param config_parser: A parsed configuration.
+    :param client: The build server client.
+    :param name: The device's name, if it is one of several, to persist its state to a file of its own.
+    :return: A StateStore, or None if the build state is not persisted.
+    """
+    path = config.get_client_state_file(config_parser)
+    if path is None:
+        return None
+    if name:
+        (root, extension) = os.path.splitext(path)
+        path = '{0}.{1}{2}'.format(root, name, extension)
+    return controllers.StateStore(path=path, client=client, username=config.get_device_username(config_parser))
+
+
+def load_trace_sink(config_parser):
+    """
+    Load the sink of traces of checks of the build server from config.
+
+    :param config_parser: A parsed configuration.
+    :return: A TraceSink, or None if checks are not traced.
+    """
+    path = config.get_client_trace_file(config_parser)
+    if path is None:
+        return None
+    return tracing.TraceSink(path=path)
+
+
+def load_metrics_server(config_parser, client, server_monitor, device_controllers, device_workers, device_names):
+    """
+    Load the metrics server from config, and instrument the application for it.
+
+    :param config_parser: A parsed configuration.
+    :param client: The build server client.
+    :param server_monitor: The server monitor.
+    :param device_controllers: The controllers of the devices.
+    :param device_workers: The device workers, one per controller.
+    :param device_names: The names of the devices, one per controller; None for a device without a name.
+    :return: A MetricsServer, or None if metrics are not served.
+    """
+    port = config.get_metrics_port(config_parser)
+    if port is None:
+        return None
+    registry = metrics.MetricsRegistry()
+    metrics.instrument(registry=registry,
+                       client=client,
+                       server_monitor=server_monitor,
+                       device_controllers=device_controllers,
+                       device_workers=device_workers,
+                       device_names=device_names)
+    return metrics.MetricsServer(registry=registry, port=port, host=config.get_metrics_host(config_parser) or '')
 
 
 def load_client(config_parser):
@@ -76,7 +291,11 @@ def load_client(config_parser):
     namespace = config.get_client_namespace(config_parser)
     class_name = config.get_client_class_name(config_parser)
     args = config.get_client_args(config_parser)
-    return construct_class(namespace, class_name, args)
+    client = construct_class(namespace, class_name, args)
+    rules = routing.RoutingRules.create(config.get_client_routing(config_parser))
+    if rules:
+        client.set_rules(rules)
+    return client
 
 
 def try_get_config_path(arguments, global_config_path, local_config_path):
@@ -111,19 +330,469 @@ def create_argument_parser(application_name, application_version):
     parser.add_argument('--config', help=('Path to the application\'s configuration file. Default search locations, '
                                           'if no configuration file is specified, are /etc/whatsthatlight/ and ./conf/ '
                                           '(in that order).'))
+    parser.add_argument('--watch-config', action='store_true',
+                        help='Reload the configuration file whenever it changes, as on SIGHUP.')
+    parser.add_argument(profiling.STARTUP_PROFILE_OPTION, action='store_true',
+                        help='Print the time taken by every phase of startup and every module imported to stderr.')
+    parser.add_argument('--profile-cycles', type=int, default=profiling.DEFAULT_NR_OF_PROFILED_CYCLES,
+                        help=('The number of checks of the build server to profile on SIGUSR1. The profile is written '
+                              'to the log directory. SIGUSR2 writes the stack of every thread there.'))
     return parser
 
 
-def construct_class(namespace, class_name, args):
+def construct_class(namespace, class_name, args, kwargs=None):
     """
     Helper function to dynamically construct a class from configuration.
 
     :param namespace: The namespace where the class resides.
     :param class_name: The class to construct.
+    :param args: The constructor's positional arguments.
+    :param kwargs: The constructor's keyword arguments, if any.
     """
     module = importlib.import_module(name=namespace)
     class_ = getattr(module, class_name)
-    return class_(*args)
+    return class_(*args, **(kwargs or {}))
+
+
+def diff_config(old_config_parser, new_config_parser):
+    """
+    Find the options that differ between two configurations. Options are compared before interpolation, so that a
+    changed option is only reported where it is set.
+
+    :param old_config_parser: A parsed configuration.
+    :param new_config_parser: Another parsed configuration.
+    :return: A set of (section, option) tuples. An added or removed section is reported with the option None.
+    """
+    old_sections = set(old_config_parser.sections())
+    new_sections = set(new_config_parser.sections())
+    changes = set((section, None) for section in old_sections ^ new_sections)
+    for section in old_sections & new_sections:
+        old_options = dict(old_config_parser.items(section, raw=True))
+        new_options = dict(new_config_parser.items(section, raw=True))
+        for option in set(old_options) | set(new_options):
+            if old_options.get(option) != new_options.get(option):
+                changes.add((section, option))
+    return changes
+
+
+class ConfigReloader(object):
+    """
+    Reloads the configuration of a running system incrementally: Only the components whose options changed are
+    reconfigured, and in place, so that the client's session and caches and the devices' handles survive a reload.
+    Changes that can't be applied in place (e.g. to a device's VID) are logged, and need a restart.
+    """
+
+    def __init__(self, config_parser, client, server_monitor, controller, device_controllers, device_workers):
+        """
+        Constructor.
+
+        :param config_parser: The configuration the system was loaded with.
+        :param client: The build server client.
+        :param server_monitor: The server monitor.
+        :param controller: The multi-device controller.
+        :param device_controllers: The controller of every device, in the order of load_device_config_parsers.
+        :param device_workers: The device worker of every device, in the same order.
+        """
+        self._logger = logging.getLogger()
+        self._config_parser = config_parser
+        self._client = client
+        self._server_monitor = server_monitor
+        self._controller = controller
+        self._device_controllers = device_controllers
+        self._device_workers = device_workers
+        self._device_names = [name for (name, _) in load_device_config_parsers(config_parser)]
+        self._lock = threading.Lock()
+
+    def get_config_parser(self):
+        """
+        Get the running configuration.
+
+        :return: A parsed configuration.
+        """
+        return self._config_parser
+
+    def reload(self, config_path):
+        """
+        Reload the configuration from file. A configuration that can't be read or is invalid is rejected as a whole,
+        and the running configuration is kept.
+
+        :param config_path: The configuration file path.
+        :return: True if any change was applied.
+        """
+        with self._lock:
+            # noinspection PyBroadException
+            # pylint: disable=broad-except
+            try:
+                config_parser = create_config_parser(config_path)
+                apply_changes = self._prepare(config_parser)
+            except Exception, error:
+                self._logger.error('Invalid configuration; keeping the running configuration: %s', error)
+                return False
+            # pylint: enable=broad-except
+            if not apply_changes:
+                return False
+            # Everything was validated, so this shouldn't fail, but a running light must survive it if it does
+            # noinspection PyBroadException
+            # pylint: disable=broad-except
+            try:
+                apply_changes()
+            except Exception, error:
+                self._logger.error('Could not apply the configuration; it may be partly applied: %s', error)
+                return False
+            # pylint: enable=broad-except
+            self._config_parser = config_parser
+            return True
+
+    def _prepare(self, config_parser):
+        """
+        Read and validate a new configuration, and create a function that applies its changes.
+
+        :param config_parser: The new parsed configuration.
+        :return: A parameterless function, or None if there are no changes to apply.
+        """
+        changes = diff_config(self._config_parser, config_parser)
+        if not changes:
+            self._logger.info('Configuration unchanged')
+            return None
+        restart_changes = sorted(change for change in changes if not config.is_reloadable(*change))
+        if restart_changes:
+            self._logger.warning('A restart is required to apply: %s',
+                                 ', '.join('{0}.{1}'.format(section, option or '*')
+                                           for (section, option) in restart_changes))
+        reload_changes = changes - set(restart_changes)
+        appliers = []
+        if any(config.is_server_section(section) for (section, _) in reload_changes):
+            appliers.append(self._prepare_client(config_parser))
+        if any(not config.is_server_section(section) for (section, _) in reload_changes):
+            appliers.append(self._prepare_devices(config_parser))
+        if not appliers:
+            return None
+
+        def _apply():
+            """
+            Apply the changes.
+            """
+            for applier in appliers:
+                applier()
+            self._logger.info('Applied: %s', ', '.join('{0}.{1}'.format(section, option)
+                                                       for (section, option) in sorted(reload_changes)))
+
+        return _apply
+
+    def _prepare_client(self, config_parser):
+        """
+        Prepare the client and server monitor's changes.
+
+        :param config_parser: The new parsed configuration.
+        :return: A parameterless function.
+        """
+        (server_url, username, password) = config.get_client_args(config_parser)[:3]
+        rules = routing.RoutingRules.create(config.get_client_routing(config_parser))
+        set_rules = bool(rules or config.get_client_routing(self._config_parser))
+        polling_interval = config.get_client_polling_interval(config_parser)
+
+        def _apply():
+            """
+            Apply the changes.
+            """
+            self._client.reconfigure(server_url, username, password)
+            if set_rules:
+                self._client.set_rules(rules)
+            if polling_interval is not None:
+                self._server_monitor.set_polling_interval(polling_interval)
+
+        return _apply
+
+    def _prepare_devices(self, config_parser):
+        """
+        Prepare the changes of every device.
+
+        :param config_parser: The new parsed configuration.
+        :return: A parameterless function.
+        """
+        old_device_config_parsers = dict(load_device_config_parsers(self._config_parser))
+        new_device_config_parsers = dict(load_device_config_parsers(config_parser))
+        if set(self._device_names) != set(new_device_config_parsers):
+            raise UnsupportedConfigError('Devices can\'t be added or removed without a restart: {0} -> {1}'.format(
+                sorted(self._device_names), sorted(new_device_config_parsers)))
+        configurators = []
+        keep_alive_intervals = []
+        usernames = []
+        rules = []
+        # Paired by name, in the order the devices were loaded in, which is the order of their controllers and workers
+        for name in self._device_names:
+            (old_device_config_parser, new_device_config_parser) = (old_device_config_parsers[name],
+                                                                    new_device_config_parsers[name])
+            configurators.append(_create_device_configurator(new_device_config_parser, old_device_config_parser))
+            keep_alive_intervals.append(config.get_device_keep_alive_interval(new_device_config_parser))
+            usernames.append(config.get_device_username(new_device_config_parser))
+            rules.append(load_device_routing_rules(new_device_config_parser))
+
+        def _apply():
+            """
+            Apply the changes.
+            """
+            for (configurator,
+                 keep_alive_interval,
+                 device_controller,
+                 device_worker) in zip(configurators, keep_alive_intervals, self._device_controllers, self._device_workers):
+                device_worker.run(configurator)
+                device_controller.set_keep_alive_interval(keep_alive_interval)
+            self._controller.set_routing(usernames, rules)
+            # Show the new colours and animations
+            self._controller.reload()
+
+        return _apply
+
+
+class ConfigWatcher(object):
+    """
+    Watches a configuration file and calls a handler once a burst of changes to it has settled, e.g. the several writes
+    and renames of an editor's save. On Linux, inotify wakes the watcher only when the file's directory changes, so it
+    costs nothing while idle; elsewhere, the file's modification time is polled.
+    """
+
+    def __init__(self, config_path, handler, event_source=None, debounce_interval=0.5, polling_interval=2):
+        """
+        Constructor.
+
+        :param config_path: The configuration file path.
+        :param handler: A parameterless function, e.g. a reloader's reload.
+        :param event_source: A source of file events, with the same interface as InotifyEventSource, or False to poll
+                             the modification time. Defaults to an InotifyEventSource if supported, otherwise False.
+        :param debounce_interval: The time in seconds without changes after which a burst of changes has settled.
+        :param polling_interval: The interval in seconds between checks of the modification time, if polled.
+        """
+        self._logger = logging.getLogger()
+        self._config_path = os.path.abspath(config_path)
+        self._handler = handler
+        if event_source is None and InotifyEventSource.is_supported():
+            event_source = InotifyEventSource()
+        self._event_source = event_source
+        self._debounce_interval = debounce_interval
+        self._polling_interval = polling_interval
+        self._polling_event = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """
+        Start watching.
+        """
+        self._logger.info('Config watcher starting')
+        if self._event_source:
+            self._event_source.open(os.path.dirname(self._config_path))
+            target = self._run_events
+        else:
+            target = self._run_polling
+        self._polling_event.clear()
+        self._running = True
+        self._thread = threading.Thread(target=target, name=self.__class__.__name__)
+        self._thread.daemon = True
+        self._thread.start()
+        self._logger.info('Config watcher started')
+
+    def stop(self):
+        """
+        Stop watching.
+        """
+        self._logger.info('Config watcher stopping')
+        self._running = False
+        self._polling_event.set()
+        if self._event_source:
+            self._event_source.interrupt()
+        self._thread.join()
+        if self._event_source:
+            self._event_source.close()
+        self._logger.info('Config watcher stopped')
+
+    def _notify(self):
+        """
+        Call the handler, which must not stop the watcher on an error.
+        """
+        self._logger.info('Configuration file changed')
+        # noinspection PyBroadException
+        # pylint: disable=broad-except
+        try:
+            self._handler()
+        except Exception, error:
+            self._logger.error('Could not handle the configuration change: %s', error)
+        # pylint: enable=broad-except
+
+    def _run_events(self):
+        """
+        Event thread.
+        """
+        name = os.path.basename(self._config_path)
+        while self._running:
+            names = self._event_source.wait()
+            if names is None:
+                break
+            if name not in names:
+                continue
+            # Wait for the burst to settle; only the file's own events extend it, not those of the rest of the directory
+            settled_at = time.time() + self._debounce_interval
+            while self._running:
+                names = self._event_source.wait(max(0, settled_at - time.time()))
+                if names is None:
+                    break
+                if name in names:
+                    settled_at = time.time() + self._debounce_interval
+                elif time.time() >= settled_at:
+                    break
+            if self._running:
+                self._notify()
+
+    def _get_modification(self):
+        """
+        Get the file's modification time and size, which change with its content.
+
+        :return: A (mtime, size) tuple, or None if the file doesn't exist (e.g. while being replaced).
+        """
+        try:
+            stat = os.stat(self._config_path)
+            return (stat.st_mtime, stat.st_size)
+        except OSError:
+            return None
+
+    def _run_polling(self):
+        """
+        Polling thread.
+        """
+        modification = self._get_modification()
+        while self._running:
+            self._polling_event.wait(self._polling_interval)
+            current_modification = self._get_modification()
+            if current_modification == modification:
+                continue
+            # Wait for the burst to settle
+            while self._running:
+                modification = current_modification
+                self._polling_event.wait(self._debounce_interval)
+                current_modification = self._get_modification()
+                if current_modification == modification:
+                    break
+            if self._running and modification is not None:
+                self._notify()
+
+
+class InotifyEventSource(object):
+    """
+    A source of file events in a directory, read from inotify (Linux only).
+    """
+
+    # Events of a file that was written, or replaced by a rename, as editors do
+    _IN_CLOSE_WRITE = 0x00000008
+    _IN_MOVED_TO = 0x00000080
+    _IN_CREATE = 0x00000100
+    _IN_DELETE = 0x00000200
+    _IN_NONBLOCK = os.O_NONBLOCK
+    _EVENT_HEADER = struct.Struct('iIII')
+    _BUFFER_SIZE = 16384
+
+    def __init__(self):
+        """
+        Constructor.
+        """
+        self._libc = None
+        self._fd = None
+        self._interrupt_reader = None
+        self._interrupt_writer = None
+
+    @staticmethod
+    def _load_libc():
+        """
+        Load the C library.
+
+        :return: The C library, or None if it doesn't provide inotify.
+        """
+        # Imported when needed, as it is slow to import and only used to watch the configuration
+        import ctypes
+        import ctypes.util
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        except OSError:
+            return None
+        return libc if hasattr(libc, 'inotify_init1') else None
+
+    @staticmethod
+    def is_supported():
+        """
+        Check whether inotify is supported on this platform.
+
+        :return: True if supported.
+        """
+        return InotifyEventSource._load_libc() is not None
+
+    def open(self, directory):
+        """
+        Start watching a directory.
+
+        :param directory: The directory's path.
+        """
+        import ctypes
+        self._libc = self._load_libc()
+        self._fd = self._libc.inotify_init1(self._IN_NONBLOCK)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'Could not initialise inotify')
+        mask = self._IN_CLOSE_WRITE | self._IN_MOVED_TO | self._IN_CREATE | self._IN_DELETE
+        if self._libc.inotify_add_watch(self._fd, directory, mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(error, 'Could not watch {0}'.format(directory))
+        (self._interrupt_reader, self._interrupt_writer) = os.pipe()
+
+    def wait(self, timeout=None):
+        """
+        Block until files change, the timeout expires or the wait is interrupted.
+
+        :param timeout: The timeout in seconds, or None to wait indefinitely.
+        :return: A set of the names of the changed files (empty on a timeout), or None if interrupted.
+        """
+        (readable, _, _) = select.select([self._fd, self._interrupt_reader], [], [], timeout)
+        if self._interrupt_reader in readable:
+            os.read(self._interrupt_reader, 1)
+            return None
+        if not readable:
+            return set()
+        try:
+            data = os.read(self._fd, self._BUFFER_SIZE)
+        except OSError, error:
+            if error.errno != errno.EAGAIN:
+                raise
+            return set()
+        return self.parse(data)
+
+    def interrupt(self):
+        """
+        Interrupt a blocking wait.
+        """
+        os.write(self._interrupt_writer, '\0')
+
+    def close(self):
+        """
+        Stop watching.
+        """
+        os.close(self._fd)
+        os.close(self._interrupt_reader)
+        os.close(self._interrupt_writer)
+
+    @classmethod
+    def parse(cls, data):
+        """
+        Parse inotify events.
+
+        :param data: The raw events, each an inotify_event struct followed by a null-padded name.
+        :return: A set of the names of the changed files.
+        """
+        names = set()
+        offset = 0
+        while offset + cls._EVENT_HEADER.size <= len(data):
+            (_, _, _, length) = cls._EVENT_HEADER.unpack_from(data, offset)
+            offset += cls._EVENT_HEADER.size
+            names.add(data[offset:offset + length].rstrip('\0'))
+            offset += length
+        return names
 
 
 class UnsupportedConfigError(Exception):
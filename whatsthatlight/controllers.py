@@ -17,36 +17,75 @@ Service controllers for controlling a device and client connection together.
 """
 
 # System imports
+import json
+import os
 import threading
 import logging
+import time
 
 
 class Controller(object):
     """
     Controller for controlling a device and client connection together.
+
+    Device discovery and the first check of the build server run concurrently when started, and the build state is
+    written as soon as both the device and the state are there. The time each startup phase completed is recorded.
     """
 
-    def __init__(self, device, device_monitor, server_monitor):
+    # Startup phases
+    DEVICE_ADDED_PHASE = 'device_added'
+    FIRST_CHECK_PHASE = 'first_check'
+    FIRST_LIGHT_PHASE = 'first_light'
+    FIRST_CHECKED_LIGHT_PHASE = 'first_checked_light'
+
+    def __init__(self, device, device_monitor, server_monitor=None, persistent=False, keep_alive_interval=None,
+                 state_store=None, stale_after=None):
         """
         Constructor.
 
         :param device: A device.
         :param device_monitor: A device monitor.
-        :param server_monitor: A server monitor.
+        :param server_monitor: A server monitor. If None, the build state must be updated by the caller, e.g. when one
+                               server monitor is shared by the controllers of several devices.
+        :param persistent: Whether to open the device once when it is added and keep it open until it is removed or the
+                           controller is stopped, instead of opening and closing it for every write. The device
+                           monitor must then not probe by opening the device, as an open device always looks present.
+        :param keep_alive_interval: An unchanged build state is only written again after this interval in seconds.
+                                    If None, an unchanged state is only written again when the device is reconnected.
+        :param state_store: A StateStore to persist the build state to, so that it can be shown as soon as the
+                            controller is started again, instead of the unknown state until the first check completes.
+        :param stale_after: A restored build state older than this age in seconds is shown as stale. If None, a
+                            restored state is never stale.
         """
         self._logger = logging.getLogger()
         self._device = device
         self._device_monitor = device_monitor
         self._server_monitor = server_monitor
+        self._persistent = persistent
+        self._keep_alive_interval = keep_alive_interval
         self._device_connected = False
         self._build_state = (None, None)
+        self._write_lock = threading.Lock()
+        self._written_state = None
+        self._written_at = None
+        self._nr_of_writes = 0
+        self._nr_of_skipped_writes = 0
+        self._state_store = state_store
+        self._stale_after = stale_after
+        self._started_at = None
+        self._restored = False
+        self._stale = False
+        self._state_saved = False
+        self._checked = False
+        self._phase_timings = {}
 
     def start(self):
         """
         Start the controller and dependencies.
         """
         self._logger.info('Controller starting')
-        event = threading.Event()
+        self._started_at = time.time()
+        self._restore_state()
 
         def _device_added_handler():
             """
@@ -55,12 +94,14 @@ class Controller(object):
             self._logger.info('Device added (vid=%0#6x, pid=%0#6x)',
                               self._device.get_vendor_id(),
                               self._device.get_product_id())
-            self._device.open()
-            (any_builds_running, any_build_failures) = self._build_state
-            self._device.send(any_builds_running, any_build_failures)
-            self._device.close()
+            if self._persistent:
+                self._device.open()
+            # The device lost its state while unplugged
+            self._device.reset()
+            self._record_phase(self.DEVICE_ADDED_PHASE)
+            # Connected before writing, so that a state checked meanwhile is written either here or by the update
             self._device_connected = True
-            event.set()
+            self._write_state(force=True)
 
         def _device_removed_handler():
             """
@@ -68,61 +109,509 @@ class Controller(object):
             """
             self._logger.info('Device removed')
             self._device_connected = False
-
-        def _server_handler(any_builds_running, any_build_failures):
-            """
-            Server handler.
-
-            :param any_builds_running: True if any builds running. None if unknown or undefined.
-            :param any_build_failures: True if any builds failing or failed. None if unknown or undefined.
-            """
-            last_build_state = self._build_state
-            self._build_state = (any_builds_running, any_build_failures)
-            if self._build_state != last_build_state:
-                self._logger.info('Build server state changed: Running: {0}->{1}; Failures: {2}->{3}'
-                                  .format(last_build_state[0],
-                                          any_builds_running,
-                                          last_build_state[1],
-                                          any_build_failures))
-            self._logger.debug('Build server state: any_builds_running={any_builds_running}, any_build_failures={any_build_failures}'
-                               .format(any_builds_running=any_builds_running,
-                                       any_build_failures=any_build_failures))
-            if self._device_connected:
-                # Warning: Abstraction bleeding: There can be only one open handle to the device
-                # at any given time. Because we're using the same device for polling and updating
-                # state, from two different contexts, we need to open the device only when we are
-                # going to write, and immediately close it thereafter. Now, because of the two
-                # polling loops (in the two monitors) there is of course the possibility of a
-                # race condition, where the two loops will coincide: The one loop will open the
-                # device, but before closing, the other loop will also open it. This will cause the
-                # hidapi to blow up.
-                # TODO: Fix possible race condition
-                self._logger.debug('Device connected; setting state')
-                self._device.open()
-                self._device.send(any_builds_running, any_build_failures)
-                self._device.close()
+            with self._write_lock:
+                self._written_state = None
+            if self._persistent:
+                try:
+                    self._device.close()
+                except IOError, error:
+                    self._logger.debug('Could not close the removed device: %s', error)
 
         # Set handlers
         self._device_monitor.set_added_handler(_device_added_handler)
         self._device_monitor.set_removed_handler(_device_removed_handler)
-        self._server_monitor.set_handler(_server_handler)
+        self._device.set_write_error_handler(self._write_failed)
+        if self._server_monitor:
+            self._server_monitor.set_handler(self.update)
+            self._server_monitor.set_progress_handler(self.update_progress)
 
-        # Synchronised start
-        event.clear()
+        # Both monitors work on their own threads, so the device is discovered while the server is checked
         self._device_monitor.start()
-        event.wait(1)
-        self._server_monitor.start()
+        if self._server_monitor:
+            self._server_monitor.start()
         self._logger.info('Controller started')
 
+    def update(self, any_builds_running, any_build_failures):
+        """
+        Update the build state, and write it to the device if connected. This is the server monitor's handler.
+
+        :param any_builds_running: True if any builds running. None if unknown or undefined.
+        :param any_build_failures: True if any builds failing or failed. None if unknown or undefined.
+        """
+        last_build_state = self._build_state
+        self._build_state = (any_builds_running, any_build_failures)
+        if not self._checked:
+            self._checked = True
+            self._record_phase(self.FIRST_CHECK_PHASE)
+            if self._restored:
+                self._confirm_state()
+        if self._build_state != last_build_state:
+            self._logger.info('Build server state changed: Running: %s->%s; Failures: %s->%s',
+                              last_build_state[0],
+                              any_builds_running,
+                              last_build_state[1],
+                              any_build_failures)
+        if self._build_state != last_build_state or not self._state_saved:
+            self._save_state()
+        # Lazy arguments, as this is logged on every check
+        self._logger.debug('Build server state: any_builds_running=%s, any_build_failures=%s',
+                           any_builds_running,
+                           any_build_failures)
+        if self._device_connected:
+            self._logger.debug('Device connected; setting state')
+            self._write_state()
+
+    def update_progress(self, progress):
+        """
+        Update the progress of running builds on the device, if connected. This is the server monitor's progress handler.
+
+        :param progress: The progress of running builds as a fraction. None if unknown or no builds are running.
+        """
+        if self._device_connected:
+            self._device.set_progress(progress)
+
+    def set_keep_alive_interval(self, keep_alive_interval):
+        """
+        Change the interval after which an unchanged build state is written again.
+
+        :param keep_alive_interval: The interval in seconds, or None to only write an unchanged state when the device is
+                                    reconnected.
+        """
+        self._keep_alive_interval = keep_alive_interval
+
+    def reload(self):
+        """
+        Set up the device from scratch and write the build state to it again, e.g. after the device was reconfigured.
+        """
+        if self._device_connected:
+            self._device.reset()
+            self._write_state(force=True)
+
+    def is_device_connected(self):
+        """
+        Check whether the device is connected.
+
+        :return: True if connected.
+        """
+        return self._device_connected
+
+    def get_build_state(self):
+        """
+        Get the last build state the controller was updated with.
+
+        :return: A tuple of (any_builds_running, any_build_failures), where None indicates an unknown state.
+        """
+        return self._build_state
+
+    def get_phase_timings(self):
+        """
+        Get the time each startup phase completed, e.g. the time to the first light showing a checked build state.
+
+        :return: A dictionary of the seconds since the controller was started, by phase, for the completed phases.
+        """
+        return dict(self._phase_timings)
+
+    def get_write_counts(self):
+        """
+        Get the number of build states written to the device, and the number of writes skipped as unchanged.
+
+        :return: A dictionary with the written and skipped counts.
+        """
+        with self._write_lock:
+            return {'written': self._nr_of_writes,
+                    'skipped': self._nr_of_skipped_writes}
+
+    def _write_state(self, force=False):
+        """
+        Write the build state to the device, unless it is the state last written and no keep-alive write is due.
+
+        :param force: Write even if the state is unchanged.
+        """
+        with self._write_lock:
+            build_state = self._build_state
+            now = time.time()
+            if (not force and build_state == self._written_state and
+                    (self._keep_alive_interval is None or now - self._written_at < self._keep_alive_interval)):
+                self._nr_of_skipped_writes += 1
+                return
+            (any_builds_running, any_build_failures) = build_state
+            # Recorded before sending, so that an asynchronous write that fails straight away can forget it
+            self._written_state = build_state
+            self._written_at = now
+            try:
+                if self._persistent:
+                    self._device.send(any_builds_running, any_build_failures)
+                else:
+                    # Warning: Abstraction bleeding: There can be only one open handle to the device
+                    # at any given time. Because we're using the same device for polling and updating
+                    # state, from two different contexts, we need to open the device only when we are
+                    # going to write, and immediately close it thereafter. The two polling loops (in
+                    # the two monitors) may coincide, so a device shared by them must be wrapped in a
+                    # DeviceWorker, which serialises all operations on one thread and reference counts
+                    # opens, so that hidapi never sees a second open of the same handle.
+                    self._device.open()
+                    self._device.send(any_builds_running, any_build_failures)
+                    self._device.close()
+            except Exception:
+                self._written_state = None
+                raise
+            self._nr_of_writes += 1
+            self._record_phase(self.FIRST_LIGHT_PHASE)
+            if self._checked:
+                self._record_phase(self.FIRST_CHECKED_LIGHT_PHASE)
+
+    def _write_failed(self, any_builds_running, any_build_failures):
+        """
+        Forget a write that failed after the device accepted it, e.g. on a device worker, so that the next update
+        writes the state again instead of skipping it as unchanged. This is the device's write error handler.
+
+        :param any_builds_running: True if any builds running. None if unknown or undefined.
+        :param any_build_failures: True if any builds failing or failed. None if unknown or undefined.
+        """
+        self._logger.warning('Could not write the build state; it will be written again')
+        # Not under the write lock, which a writer may hold while it waits for the device worker that calls this
+        if self._written_state == (any_builds_running, any_build_failures):
+            self._written_state = None
+
+    def _record_phase(self, phase):
+        """
+        Record the time a startup phase completed, the first time it does.
+
+        :param phase: The phase.
+        """
+        if self._started_at is None or phase in self._phase_timings:
+            return
+        self._phase_timings[phase] = time.time() - self._started_at
+        self._logger.info('Startup phase %s completed after %.3fs', phase, self._phase_timings[phase])
+
+    def _restore_state(self):
+        """
+        Restore the build state persisted before the last stop, to show it until the first check completes.
+        """
+        if not self._state_store or self._checked:
+            return
+        snapshot = self._state_store.load()
+        if snapshot is None:
+            return
+        (build_state, age) = snapshot
+        self._build_state = build_state
+        self._restored = True
+        self._stale = self._stale_after is not None and age > self._stale_after
+        if self._stale:
+            self._device.set_stale(True)
+        self._logger.info('Restored build state from %.0fs ago%s: Running: %s; Failures: %s',
+                          age, ' (stale)' if self._stale else '', build_state[0], build_state[1])
+
+    def _confirm_state(self):
+        """
+        Replace a restored build state with the first state checked, which must be written even if unchanged when the
+        restored state was shown as stale.
+        """
+        self._restored = False
+        if self._stale:
+            self._stale = False
+            self._device.set_stale(False)
+            self._device.reset()
+            with self._write_lock:
+                self._written_state = None
+
+    def _save_state(self):
+        """
+        Persist the build state, if known. Errors are logged, not raised.
+        """
+        if not self._state_store or self._build_state == (None, None):
+            return
+        try:
+            self._state_store.save(self._build_state)
+            self._state_saved = True
+        except (IOError, OSError), error:
+            self._logger.warning('Could not save the build state: %s', error)
+
     def stop(self):
         """
         Stop the controller and dependencies.
         """
         self._logger.info('Controller stopping')
         if self._device_connected:
-            self._device.open()
+            if not self._persistent:
+                self._device.open()
             self._device.off()
             self._device.close()
-        self._server_monitor.stop()
+        if self._server_monitor:
+            self._server_monitor.stop()
         self._device_monitor.stop()
+        # The state was current until now
+        if self._state_saved:
+            self._save_state()
         self._logger.info('Controller stopped')
+
+
+class StateStore(object):
+    """
+    Persists the last build state to a small JSON file, with the time it was saved and the server and user it is of.
+    The file is replaced atomically, by renaming a temporary file over it, so that it is never read half-written.
+    """
+
+    def __init__(self, path, client, username=None):
+        """
+        Constructor.
+
+        :param path: The path to the file.
+        :param client: The build server client, for the server URL and user of the build state.
+        :param username: The user whose build state is persisted. If None, the client's user.
+        """
+        self._logger = logging.getLogger()
+        self._path = path
+        self._client = client
+        self._username = username
+
+    def load(self):
+        """
+        Load the persisted build state, if it is of the current server and user.
+
+        :return: A tuple of the build state and its age in seconds, or None if there is no usable build state.
+        """
+        try:
+            with open(self._path) as state_file:
+                snapshot = json.load(state_file)
+            build_state = (snapshot['any_builds_running'], snapshot['any_build_failures'])
+            (server_url, username, timestamp) = (snapshot['server_url'], snapshot['username'], snapshot['timestamp'])
+        except (IOError, ValueError, KeyError, TypeError), error:
+            self._logger.info('No build state restored from %s: %s', self._path, error)
+            return None
+        if (server_url, username) != self._get_identity():
+            self._logger.info('No build state restored from %s: It is of another server or user', self._path)
+            return None
+        return build_state, max(0.0, time.time() - timestamp)
+
+    def save(self, build_state):
+        """
+        Persist a build state.
+
+        :param build_state: A tuple of whether any builds are running and whether any builds failed.
+        """
+        # Imported when saving, as it is slow to import
+        import tempfile
+        (server_url, username) = self._get_identity()
+        snapshot = {'any_builds_running': build_state[0],
+                    'any_build_failures': build_state[1],
+                    'timestamp': time.time(),
+                    'server_url': server_url,
+                    'username': username}
+        directory = os.path.dirname(os.path.abspath(self._path))
+        (handle, temporary_path) = tempfile.mkstemp(dir=directory, prefix='.{0}.'.format(os.path.basename(self._path)))
+        try:
+            with os.fdopen(handle, 'w') as state_file:
+                json.dump(snapshot, state_file)
+                state_file.flush()
+                os.fsync(state_file.fileno())
+            os.rename(temporary_path, self._path)
+        except (IOError, OSError):
+            os.remove(temporary_path)
+            raise
+
+    def _get_identity(self):
+        """
+        Get the server URL and user the build state is of, which may change when the configuration is reloaded.
+
+        :return: A tuple of the server URL and the username.
+        """
+        return self._client.get_server_url(), self._username or self._client.get_username()
+
+
+class MultiDeviceController(object):
+    """
+    Controller for driving several devices from one build server connection. Every device has its own controller,
+    without a server monitor, and the build state is fanned out to them by one shared server monitor.
+
+    Each controller is updated from its own thread, which only keeps the latest update, so that a slow device never
+    delays the others, nor the server monitor.
+
+    Devices can show the build state of different users, or of different builds. The server monitor then checks the
+    builds for all users at once, and the state of every device's user and routing rules is looked up in the
+    resulting index.
+    """
+
+    def __init__(self, controllers, server_monitor, usernames=None, rules=None):
+        """
+        Constructor.
+
+        :param controllers: A list of controllers, one per device, without server monitors.
+        :param server_monitor: The shared server monitor.
+        :param usernames: A list of the users whose build state to show, one per controller; None shows the client's
+                          user. If None, all devices show the client's user.
+        :param rules: A list of the RoutingRules of the builds to show, one per controller; None shows all builds. If
+                      None, all devices show all builds.
+        """
+        self._logger = logging.getLogger()
+        self._channels = [_ControllerChannel(controller) for controller in controllers]
+        self._server_monitor = server_monitor
+        self._usernames = usernames or [None] * len(controllers)
+        self._rules = rules or [None] * len(controllers)
+
+    def start(self):
+        """
+        Start the controllers and the server monitor.
+        """
+        self._logger.info('Multi-device controller starting')
+        for channel in self._channels:
+            channel.start()
+        # Starting doesn't wait for the devices, so they are discovered while the server is checked
+        for channel in self._channels:
+            channel.controller.start()
+        self.set_routing(self._usernames, self._rules)
+        self._server_monitor.start()
+        self._logger.info('Multi-device controller started')
+
+    def update(self, any_builds_running, any_build_failures):
+        """
+        Fan out the build state to every controller.
+
+        :param any_builds_running: True if any builds running. None if unknown or undefined.
+        :param any_build_failures: True if any builds failing or failed. None if unknown or undefined.
+        """
+        for channel in self._channels:
+            channel.put(channel.controller.update, any_builds_running, any_build_failures)
+
+    def update_progress(self, progress):
+        """
+        Fan out the progress of running builds to every controller.
+
+        :param progress: The progress of running builds as a fraction. None if unknown or no builds are running.
+        """
+        for channel in self._channels:
+            channel.put(channel.controller.update_progress, progress)
+
+    def set_routing(self, usernames=None, rules=None):
+        """
+        Change the users and routing rules of the builds every device shows, from the next check.
+
+        :param usernames: A list of usernames, one per controller, or None.
+        :param rules: A list of RoutingRules, one per controller, or None.
+        """
+        self._usernames = usernames or [None] * len(self._channels)
+        self._rules = rules or [None] * len(self._channels)
+        if any(self._usernames) or any(self._rules):
+            self._server_monitor.set_index_handler(self.update_index)
+        else:
+            self._server_monitor.set_index_handler(None)
+            self._server_monitor.set_handler(self.update)
+            self._server_monitor.set_progress_handler(self.update_progress)
+
+    def reload(self):
+        """
+        Write the build state to every device again, e.g. after the devices were reconfigured.
+        """
+        for channel in self._channels:
+            channel.put(channel.controller.reload)
+
+    def update_index(self, index):
+        """
+        Update every controller with the build state of its user.
+
+        :param index: A BuildIndex of the build state of all users. None if unknown.
+        """
+        for (channel, username, rules) in zip(self._channels, self._usernames, self._rules):
+            if index is None:
+                channel.put(channel.controller.update, None, None)
+                channel.put(channel.controller.update_progress, None)
+            else:
+                channel.put(channel.controller.update,
+                            index.any_builds_running(username, rules),
+                            index.any_build_failures(username, rules))
+                channel.put(channel.controller.update_progress, index.get_running_progress(username, rules))
+
+    def stop(self):
+        """
+        Stop the server monitor and the controllers.
+        """
+        self._logger.info('Multi-device controller stopping')
+        self._server_monitor.stop()
+        for channel in self._channels:
+            channel.stop()
+        self._run_all([channel.controller.stop for channel in self._channels])
+        self._logger.info('Multi-device controller stopped')
+
+    @staticmethod
+    def _run_all(functions):
+        """
+        Run functions concurrently and wait for all of them to complete.
+
+        :param functions: A list of parameterless functions.
+        """
+        threads = [threading.Thread(target=function) for function in functions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+
+class _ControllerChannel(object):
+    """
+    Updates a controller from its own thread. Only the latest update of each kind is kept, so a controller that is
+    slower than the updates skips to the latest state.
+    """
+
+    def __init__(self, controller):
+        """
+        Constructor.
+
+        :param controller: The controller.
+        """
+        self._logger = logging.getLogger()
+        self.controller = controller
+        self._condition = threading.Condition()
+        self._pending = {}
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """
+        Start the channel's thread.
+        """
+        with self._condition:
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name=self.__class__.__name__)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, function, *args):
+        """
+        Queue an update, replacing a pending update of the same function.
+
+        :param function: The controller's update function.
+        :param args: The function's arguments.
+        """
+        with self._condition:
+            self._pending[function] = args
+            self._condition.notify()
+
+    def stop(self):
+        """
+        Stop the channel's thread once pending updates are done.
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        """
+        Update thread.
+        """
+        while True:
+            with self._condition:
+                while self._running and not self._pending:
+                    self._condition.wait()
+                if not self._pending:
+                    break
+                pending = self._pending
+                self._pending = {}
+            for (function, args) in pending.iteritems():
+                # noinspection PyBroadException
+                # pylint: disable=broad-except
+                try:
+                    function(*args)
+                except Exception, error:
+                    self._logger.error('Could not update controller: %s', error)
+                # pylint: enable=broad-except
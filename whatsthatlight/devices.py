@@ -18,6 +18,10 @@ Various USB light devices.
 
 # System imports
 import abc
+import collections
+import logging
+import threading
+import time
 
 
 class BaseDevice(object):
@@ -27,11 +31,23 @@ class BaseDevice(object):
 
     __metaclass__ = abc.ABCMeta
 
+    # States
+    RUNNING_STATE = 'running'
+    FAILURE_STATE = 'failure'
+    SUCCESS_STATE = 'success'
+    UNKNOWN_STATE = 'unknown'
+    OFF_STATE = 'off'
+
     _DEFAULT_RUNNING_COLOUR = (200, 120, 0)
     _DEFAULT_SUCCESS_COLOUR = (0, 255, 0)
     _DEFAULT_FAILURE_COLOUR = (230, 0, 0)
     _DEFAULT_UNKNOWN_COLOUR = (0, 200, 255)
     _OFF_COLOUR = (0, 0, 0)
+    # No calibration
+    _DEFAULT_GAMMA = 1.0
+    _DEFAULT_WHITE_BALANCE = (1.0, 1.0, 1.0)
+    # A state restored from before a restart is dimmed until it is confirmed
+    _STALE_BRIGHTNESS = 0.25
 
     def __init__(self,
                  vendor_id,
@@ -54,11 +70,132 @@ class BaseDevice(object):
         """
         self._vendor_id = vendor_id
         self._product_id = product_id
+        self._hidapi = hidapi
         self._device = hidapi.device()
         self._running_colour = running_colour
         self._success_colour = success_colour
         self._failure_colour = failure_colour
         self._unknown_colour = unknown_colour
+        self._gamma = self._DEFAULT_GAMMA
+        self._white_balance = self._DEFAULT_WHITE_BALANCE
+        self._stale = False
+        self._calibration = self._create_calibration()
+
+    @staticmethod
+    def get_state(any_builds_running, any_build_failures):
+        """
+        Get the state to show for build information.
+
+        :param any_builds_running: True if any builds running. None if unknown or undefined.
+        :param any_build_failures: True if any builds failing or failed. None if unknown or undefined.
+        :return: One of the running, failure, success or unknown states.
+        """
+        # Running builds take precedence
+        if any_builds_running is True:
+            return BaseDevice.RUNNING_STATE
+        elif any_build_failures is True:
+            return BaseDevice.FAILURE_STATE
+        elif any_build_failures is False:
+            return BaseDevice.SUCCESS_STATE
+        else:
+            return BaseDevice.UNKNOWN_STATE
+
+    def get_colours(self):
+        """
+        Get the colour of every state.
+
+        :return: A dictionary of RGB colour tuples by state.
+        """
+        return {self.RUNNING_STATE: self._running_colour,
+                self.FAILURE_STATE: self._failure_colour,
+                self.SUCCESS_STATE: self._success_colour,
+                self.UNKNOWN_STATE: self._unknown_colour,
+                self.OFF_STATE: self._OFF_COLOUR}
+
+    def set_colours(self, running_colour=None, success_colour=None, failure_colour=None, unknown_colour=None):
+        """
+        Change the colours of states. Colours that are None are left unchanged.
+
+        :param running_colour: Colour to use when a build is running.
+        :param success_colour: Colour to use when all builds are passing.
+        :param failure_colour: Colour to use when one or more builds are failing.
+        :param unknown_colour: Colour to use when the build statuses are unknown.
+        """
+        self._running_colour = running_colour or self._running_colour
+        self._success_colour = success_colour or self._success_colour
+        self._failure_colour = failure_colour or self._failure_colour
+        self._unknown_colour = unknown_colour or self._unknown_colour
+
+    def set_calibration(self, gamma=None, white_balance=None):
+        """
+        Change the calibration of colours, which corrects for the LEDs' non-linear brightness and colour imbalance.
+        Values that are None are left unchanged.
+
+        :param gamma: The gamma exponent, e.g. 2.2; 1.0 leaves brightness uncorrected.
+        :param white_balance: An (R, G, B) tuple of channel gains between 0 and 1, e.g. to tone down a bright channel.
+        """
+        self._gamma = gamma or self._gamma
+        self._white_balance = white_balance or self._white_balance
+        self._calibration = self._create_calibration()
+
+    def calibrate(self, colour):
+        """
+        Calibrate a colour, as it must be written to the device.
+
+        :param colour: An RGB colour tuple.
+        :return: The calibrated RGB colour tuple.
+        """
+        return tuple(table[component] for (table, component) in zip(self._calibration, colour))
+
+    def _create_calibration(self):
+        """
+        Create a lookup table per channel up front, so that calibrating a colour is only three lookups.
+
+        :return: A tuple of three lists of 256 channel values.
+        """
+        brightness = self._STALE_BRIGHTNESS if self._stale else 1.0
+        return tuple([int(round(255 * gain * brightness * (value / 255.0) ** self._gamma)) for value in range(256)]
+                     for gain in self._white_balance)
+
+    def set_stale(self, stale):
+        """
+        Mark the state shown as stale, e.g. when it was restored from before a restart and not yet confirmed by the
+        build server. A stale state is shown dimmed.
+
+        :param stale: True if stale.
+        """
+        if stale != self._stale:
+            self._stale = stale
+            self.set_calibration()
+
+    def reset(self):
+        """
+        Forget any state kept about what the device is showing, e.g. after it was reconnected, so that the next send
+        sets it up from scratch.
+        """
+
+    def set_progress(self, progress):
+        """
+        Set the progress of running builds, for devices that can show it.
+
+        :param progress: The progress as a fraction, or None if unknown.
+        """
+
+    def set_fade_millis(self, fade_millis):
+        """
+        Change the time the device takes to fade to a new colour, for devices that fade.
+
+        :param fade_millis: The fade time in milliseconds. None for the default.
+        """
+
+    def set_write_error_handler(self, handler):
+        """
+        Set a handler for sends that fail after having returned, for devices that write asynchronously. Other devices
+        raise the error from send instead.
+
+        :param handler: A function which accepts the parameters (any_builds_running, any_build_failures) of the failed
+                        send.
+        """
 
     @abc.abstractmethod  # pragma: no cover
     def get_vendor_id(self):
@@ -88,6 +225,14 @@ class BaseDevice(object):
         Check whether the device is open for communication.
         """
 
+    @abc.abstractmethod  # pragma: no cover
+    def probe(self):
+        """
+        Check whether the device is present, without opening it.
+
+        :return: True if the device is plugged in.
+        """
+
     @abc.abstractmethod  # pragma: no cover
     def send(self, any_builds_running, any_build_failures):
         """
@@ -116,7 +261,15 @@ class HidApiDevice(BaseDevice):
     """
 
     _LED_NUMBER = 0
-    _FADE_MILLIS = 100
+    _FADE_MILLIS = 1000
+    # Commands
+    _FADE_TO_RGB_COMMAND = 0x63
+    _SET_PATTERN_LINE_COMMAND = 0x50
+    _PLAY_PATTERN_COMMAND = 0x70
+    # Pattern lines in RAM of a blink(1) mk2 and later
+    MAX_PATTERN_LINES = 32
+    # The device counts fade time in two bytes, in units of 10ms
+    MAX_FADE_MILLIS = 0xffff * 10
 
     def __init__(self,
                  vendor_id,
@@ -125,7 +278,11 @@ class HidApiDevice(BaseDevice):
                  running_colour=BaseDevice._DEFAULT_RUNNING_COLOUR,
                  success_colour=BaseDevice._DEFAULT_SUCCESS_COLOUR,
                  failure_colour=BaseDevice._DEFAULT_FAILURE_COLOUR,
-                 unknown_colour=BaseDevice._DEFAULT_UNKNOWN_COLOUR):
+                 unknown_colour=BaseDevice._DEFAULT_UNKNOWN_COLOUR,
+                 persistent=False,
+                 patterns=None,
+                 pattern_memory=True,
+                 serial_number=None):
         """
         Constructor.
 
@@ -136,6 +293,13 @@ class HidApiDevice(BaseDevice):
         :param success_colour: Colour to use when all builds are passing.
         :param failure_colour: Colour to use when one or more builds are failing.
         :param unknown_colour: Colour to use when the build statuses are unknown.
+        :param persistent: Whether the handle is kept open between writes, in which case a failed write reopens the
+                           device and is retried once.
+        :param patterns: A dictionary of Patterns by state, for states that must be animated.
+        :param pattern_memory: Whether the device can store and play patterns (a blink(1) mk2 or later). If not, patterns
+                               are played from the host, which requires a persistent handle.
+        :param serial_number: The device's serial number, to tell apart devices with the same VID and PID. If None, the
+                              first device found is used.
         """
         super(HidApiDevice, self).__init__(vendor_id,
                                            product_id,
@@ -147,8 +311,19 @@ class HidApiDevice(BaseDevice):
         self._packet_size = 64
         self._timeout = 50
         self._is_open = False
-        self._th = (self._FADE_MILLIS & 0xff00) >> 8
-        self._tl = self._FADE_MILLIS & 0x00ff
+        self._path = None
+        self._serial_number = serial_number
+        self._persistent = persistent
+        self._fade_millis = self._FADE_MILLIS
+        self._write_lock = threading.RLock()
+        self._patterns = {}
+        self._pattern_memory = pattern_memory
+        self._pattern_state = None
+        self._progress = None
+        self._animation_engine = AnimationEngine(self._write_animation_frame, self._create_animation_frame)
+        self._frames = self._create_frames()
+        self._pattern_frames = {}
+        self.set_patterns(patterns or {})
 
     def get_vendor_id(self):
         """
@@ -162,11 +337,30 @@ class HidApiDevice(BaseDevice):
         """
         return self._product_id
 
+    def get_serial_number(self):
+        """
+        Get the serial number of the device.
+
+        :return: The serial number, or None if any device with the VID and PID is used.
+        """
+        return self._serial_number
+
     def open(self):
         """
         Open the device for communication.
         """
-        self._device.open(self._vendor_id, self._product_id)
+        if self._path:
+            try:
+                self._device.open_path(self._path)
+                self._is_open = True
+                return
+            except IOError:
+                # The device may have been plugged into another port since it was enumerated
+                self._path = None
+        if self._serial_number:
+            self._device.open(self._vendor_id, self._product_id, self._serial_number)
+        else:
+            self._device.open(self._vendor_id, self._product_id)
         self._is_open = True
 
     def is_open(self):
@@ -175,6 +369,138 @@ class HidApiDevice(BaseDevice):
         """
         return self._is_open
 
+    def probe(self):
+        """
+        Check whether the device is present by enumerating HID devices, without opening it. The path of the device is
+        cached to open it by.
+
+        :return: True if the device is plugged in.
+        """
+        device_infos = self._hidapi.enumerate(self._vendor_id, self._product_id)
+        if self._serial_number:
+            device_infos = [device_info for device_info in device_infos
+                            if device_info.get('serial_number') == self._serial_number]
+        self._path = device_infos[0]['path'] if device_infos else None
+        return self._path is not None
+
+    def set_colours(self, running_colour=None, success_colour=None, failure_colour=None, unknown_colour=None):
+        """
+        Change the colours of states. Colours that are None are left unchanged.
+
+        :param running_colour: Colour to use when a build is running.
+        :param success_colour: Colour to use when all builds are passing.
+        :param failure_colour: Colour to use when one or more builds are failing.
+        :param unknown_colour: Colour to use when the build statuses are unknown.
+        """
+        super(HidApiDevice, self).set_colours(running_colour, success_colour, failure_colour, unknown_colour)
+        self._frames = self._create_frames()
+        self._pattern_frames = self._create_pattern_frames()
+
+    def set_calibration(self, gamma=None, white_balance=None):
+        """
+        Change the calibration of colours. Values that are None are left unchanged.
+
+        :param gamma: The gamma exponent, e.g. 2.2; 1.0 leaves brightness uncorrected.
+        :param white_balance: An (R, G, B) tuple of channel gains between 0 and 1.
+        """
+        super(HidApiDevice, self).set_calibration(gamma, white_balance)
+        self._frames = self._create_frames()
+        self._pattern_frames = self._create_pattern_frames()
+
+    def set_fade_millis(self, fade_millis):
+        """
+        Change the time the device takes to fade to a new colour.
+
+        :param fade_millis: The fade time in milliseconds, up to MAX_FADE_MILLIS. None for the default.
+        """
+        self._fade_millis = fade_millis if fade_millis is not None else self._FADE_MILLIS
+        self._frames = self._create_frames()
+
+    def set_patterns(self, patterns, pattern_memory=None, frame_rate=None):
+        """
+        Change the patterns of animated states. A pattern being played is stopped.
+
+        :param patterns: A dictionary of Patterns by state.
+        :param pattern_memory: Whether the device can store and play patterns. None leaves it unchanged.
+        :param frame_rate: The frame rate at which patterns are played from the host. None leaves it unchanged.
+        """
+        for pattern in patterns.itervalues():
+            if len(pattern.steps) > self.MAX_PATTERN_LINES:
+                raise ValueError('A pattern can have at most {0} steps'.format(self.MAX_PATTERN_LINES))
+        with self._write_lock:
+            if self._pattern_state is not None and self._is_open:
+                self._stop_pattern()
+            self._pattern_state = None
+            self._patterns = dict(patterns)
+            if pattern_memory is not None:
+                self._pattern_memory = pattern_memory
+            if frame_rate is not None:
+                self._animation_engine.set_frame_rate(frame_rate)
+            self._pattern_frames = self._create_pattern_frames()
+
+    def set_progress(self, progress):
+        """
+        Set the progress of running builds, which is shown by progress patterns.
+
+        :param progress: The progress as a fraction, or None if unknown.
+        """
+        with self._write_lock:
+            if progress == self._progress:
+                return
+            self._progress = progress
+            if self._pattern_state is not None and self._patterns[self._pattern_state].progress:
+                self._play_on_host(self._pattern_state)
+
+    def reset(self):
+        """
+        Forget which pattern the device is playing, so that the next send uploads it again. A pattern played by the host
+        is stopped.
+        """
+        with self._write_lock:
+            self._animation_engine.cancel()
+            self._pattern_state = None
+
+    def _create_frames(self):
+        """
+        Create the packet of every state up front, so that a send is only a lookup and a write. A new table is created
+        on every change, instead of updating the current one, so that a concurrent send never sees a partial update.
+
+        :return: A dictionary of binary data by state. The data must not be modified.
+        """
+        return dict((state, self._create_packet(colour)) for (state, colour) in self.get_colours().iteritems())
+
+    def _create_pattern_frames(self):
+        """
+        Create the packets of every pattern that the device can play by itself up front: The pattern line packets,
+        followed by the play packet. Without pattern memory, and for progress patterns (which change with every poll),
+        patterns are played from the host instead.
+
+        :return: A dictionary of lists of binary data by state.
+        """
+        if not self._pattern_memory:
+            return {}
+        colours = self.get_colours()
+        pattern_frames = {}
+        for (state, pattern) in self._patterns.iteritems():
+            if pattern.progress:
+                continue
+            steps = pattern.resolve(colours[state])
+            frames = [self._create_packet(colour, fade_millis, command=self._SET_PATTERN_LINE_COMMAND, index=index)
+                      for (index, (colour, fade_millis)) in enumerate(steps)]
+            frames.append(bytearray([0x01, self._PLAY_PATTERN_COMMAND, 1, 0, len(steps) - 1, pattern.repeats, 0, 0]))
+            pattern_frames[state] = frames
+        return pattern_frames
+
+    def _create_animation_frame(self, colour, fade_millis):
+        """
+        Create a frame for the animation engine.
+
+        :param colour: An RGB colour tuple.
+        :param fade_millis: The fade time in milliseconds.
+        :return: Binary data.
+        """
+        return self._create_packet(colour, fade_millis)
+
     def _encode(self, any_builds_running, any_build_failures):
         """
         Encode build server state.
@@ -183,39 +509,109 @@ class HidApiDevice(BaseDevice):
         :param any_build_failures: True if any builds failing or failed. None if unknown or undefined.
         :return: Binary data.
         """
-        # Running builds take precedence
-        if any_builds_running is True:
-            return self._create_packet(self._running_colour)
-        elif any_build_failures is True:
-            return self._create_packet(self._failure_colour)
-        elif any_build_failures is False:
-            return self._create_packet(self._success_colour)
-        else:
-            return self._create_packet(self._unknown_colour)
+        return self._frames[self.get_state(any_builds_running, any_build_failures)]
 
-    def _create_packet(self, colour):
+    def _create_packet(self, colour, fade_millis=None, command=_FADE_TO_RGB_COMMAND, index=_LED_NUMBER):
         """
-        Create a binary data packet from a RGB colour tuple.
+        Create a binary data packet from a RGB colour tuple, which is calibrated.
 
         :param colour: An RGB colour tuple.
+        :param fade_millis: The fade time in milliseconds. Defaults to the device's fade time.
+        :param command: The command, which is either to fade to the colour or to set a pattern line to it.
+        :param index: The LED number to fade, or the pattern line to set.
         :return: Binary data.
         """
-        (red, green, blue) = colour
-        return [0x01, 0x63, red, green, blue, self._th, self._tl, HidApiDevice._LED_NUMBER]
+        (red, green, blue) = self.calibrate(colour)
+        if fade_millis is None:
+            fade_millis = self._fade_millis
+        # The device counts fade time in units of 10ms
+        fade_time = int(fade_millis) // 10
+        fade_high = (fade_time & 0xff00) >> 8
+        fade_low = fade_time & 0x00ff
+        return bytearray([0x01, command, red, green, blue, fade_high, fade_low, index])
 
     def send(self, any_builds_running, any_build_failures):
         """
-        Sends build information to the device.
+        Sends build information to the device. An animated state is only set up when the state changes; the device (or
+        the host's animation engine, without pattern memory) then plays it by itself.
 
         :param any_builds_running: True if any builds running. None if unknown or undefined.
         :param any_build_failures: True if any builds failing or failed. None if unknown or undefined.
         """
-        data = self._encode(any_builds_running, any_build_failures)
-        self._write(data)
+        state = self.get_state(any_builds_running, any_build_failures)
+        with self._write_lock:
+            if state == self._pattern_state:
+                return
+            self._stop_pattern()
+            if state not in self._patterns:
+                self._write(self._frames[state])
+            elif state in self._pattern_frames:
+                for frame in self._pattern_frames[state]:
+                    self._write(frame)
+            else:
+                self._play_on_host(state)
+            if state in self._patterns:
+                self._pattern_state = state
+
+    def _play_on_host(self, state):
+        """
+        Play the pattern of a state with the animation engine. The write lock must be held.
+
+        :param state: The state.
+        """
+        pattern = self._patterns[state]
+        self._animation_engine.play(pattern.resolve(self.get_colours()[state], self._progress), pattern.repeats)
+
+    def _stop_pattern(self):
+        """
+        Stop playing a pattern, if any. The write lock must be held.
+        """
+        if self._pattern_state is None:
+            return
+        if self._pattern_state in self._pattern_frames:
+            self._write(bytearray([0x01, self._PLAY_PATTERN_COMMAND, 0, 0, 0, 0, 0, 0]))
+        else:
+            self._animation_engine.cancel()
+        self._pattern_state = None
+
+    def _write_animation_frame(self, data, is_current):
+        """
+        Write a frame of a pattern played by the animation engine.
+
+        :param data: Binary data.
+        :param is_current: A function that checks whether the frame's animation is still the current one. It is checked
+                           while holding the write lock, so that an animation that was replaced while waiting for the
+                           lock doesn't overwrite the state that replaced it.
+        :return: False if replaced, if the device is closed or if the write failed, to stop playing.
+        """
+        with self._write_lock:
+            if not is_current() or not self._is_open:
+                return False
+            try:
+                self._write_once(data)
+                return True
+            except IOError:
+                return False
 
     def _write(self, data):
         """
-        Internal write.
+        Internal write, which reopens the device and retries once if the write of a persistent handle failed.
+
+        :param data: Binary data.
+        """
+        try:
+            self._write_once(data)
+        except IOError:
+            if not self._persistent:
+                raise
+            # The handle may have gone stale, e.g. after the device was briefly unplugged
+            self._close()
+            self.open()
+            self._write_once(data)
+
+    def _write_once(self, data):
+        """
+        Write once.
 
         :param data: Binary data.
         """
@@ -227,12 +623,598 @@ class HidApiDevice(BaseDevice):
         """
         Switch off the device.
         """
-        data = self._create_packet(self._OFF_COLOUR)
-        self._write(data)
+        with self._write_lock:
+            self._stop_pattern()
+            self._write(self._frames[self.OFF_STATE])
 
     def close(self):
         """
-        Close the device for communication.
+        Close the device for communication, which ends a pattern played by the host, and its timer thread.
+        """
+        # Outside the write lock, which the timer thread's writes wait for
+        self._animation_engine.stop()
+        with self._write_lock:
+            if self._pattern_state is not None and self._pattern_state not in self._pattern_frames:
+                self._pattern_state = None
+            self._close()
+
+    def _close(self):
+        """
+        Close the device handle. The write lock must be held.
         """
         self._device.close()
         self._is_open = False
+
+
+class Pattern(object):
+    """
+    An animation, as a sequence of steps that each fade to a colour.
+    """
+
+    # Effects
+    PULSE_EFFECT = 'pulse'
+    BLINK_EFFECT = 'blink'
+    ALTERNATE_EFFECT = 'alternate'
+    PROGRESS_EFFECT = 'progress'
+
+    _OFF_COLOUR = (0, 0, 0)
+
+    def __init__(self, steps, repeats=0, progress=False):
+        """
+        Constructor.
+
+        :param steps: A list of (colour, fade_millis) tuples, where colour is an RGB colour tuple, or None for the colour
+                      of the state the pattern is played for.
+        :param repeats: The number of times to play the pattern; 0 plays it until stopped.
+        :param progress: Whether the state's colour is scaled by the progress of running builds.
+        """
+        self.steps = tuple(steps)
+        self.repeats = repeats
+        self.progress = progress
+
+    def resolve(self, colour, progress=None):
+        """
+        Get the steps for the colour of a state.
+
+        :param colour: The state's RGB colour tuple.
+        :param progress: The progress of running builds as a fraction, or None if unknown.
+        :return: A list of (colour, fade_millis) tuples.
+        """
+        if self.progress:
+            fraction = min(max(progress or 0.0, 0.0), 1.0)
+            colour = tuple(int(round(fraction * component)) for component in colour)
+        return [(step_colour if step_colour is not None else colour, fade_millis) for (step_colour, fade_millis) in self.steps]
+
+    @classmethod
+    def create(cls, effect, period_millis, colour=None):
+        """
+        Create a pattern for an effect.
+
+        :param effect: The effect: pulse (fade in and out), blink (switch on and off), alternate (switch between the
+                       state's colour and another) or progress (fill up to the progress of running builds).
+        :param period_millis: The time of one cycle in milliseconds.
+        :param colour: The other RGB colour tuple, for alternate.
+        :return: A pattern.
+        """
+        half_period = period_millis / 2
+        if effect == cls.PULSE_EFFECT:
+            return cls([(None, half_period), (cls._OFF_COLOUR, half_period)])
+        elif effect == cls.BLINK_EFFECT:
+            # A blink(1) holds a pattern line's colour for its fade time, once it reached it
+            return cls([(None, 0), (None, half_period), (cls._OFF_COLOUR, 0), (cls._OFF_COLOUR, half_period)])
+        elif effect == cls.ALTERNATE_EFFECT and colour:
+            return cls([(None, 0), (None, half_period), (colour, 0), (colour, half_period)])
+        elif effect == cls.PROGRESS_EFFECT:
+            return cls([(cls._OFF_COLOUR, 0), (None, 3 * period_millis / 4), (None, period_millis / 4)], progress=True)
+        raise ValueError('Unsupported effect: {0}'.format(effect))
+
+
+class AnimationEngine(object):
+    """
+    Plays patterns from the host, for devices that can't store them. A pattern is rendered to an array of frames at
+    the frame rate when it starts to play, with identical consecutive frames collapsed into one longer frame, so that
+    holding a colour costs a single write. A timer thread then writes the frames. If writes take longer than a frame
+    repeatedly, the frame rate is halved (down to a minimum) and the pattern rendered again. Playing and stopping only
+    swap the current animation, so they never wait for the timer thread.
+    """
+
+    _DEFAULT_FRAME_RATE = 25
+    _MIN_FRAME_RATE = 1
+    # The number of consecutive frames over budget, after which the frame rate is dropped
+    _MAX_OVERRUNS = 3
+
+    def __init__(self, write, create_frame, frame_rate=_DEFAULT_FRAME_RATE, min_frame_rate=_MIN_FRAME_RATE):
+        """
+        Constructor.
+
+        :param write: A function that accepts a frame and a function that checks whether the frame's animation is still
+                      the current one, and returns False to stop playing.
+        :param create_frame: A function that accepts an RGB colour tuple and a fade time in milliseconds, and returns a
+                             frame.
+        :param frame_rate: The frame rate in frames per second.
+        :param min_frame_rate: The lowest frame rate to drop to when writes can't keep up.
+        """
+        self._logger = logging.getLogger()
+        self._write = write
+        self._create_frame = create_frame
+        self._frame_rate = frame_rate
+        self._min_frame_rate = min_frame_rate
+        self._condition = threading.Condition()
+        self._animation = None
+        self._generation = 0
+        self._thread = None
+        self._stopped = None
+
+    def get_frame_rate(self):
+        """
+        Get the current frame rate, which may have been dropped.
+
+        :return: The frame rate in frames per second.
+        """
+        return self._frame_rate
+
+    def set_frame_rate(self, frame_rate):
+        """
+        Set the frame rate, from the next pattern played.
+
+        :param frame_rate: The frame rate in frames per second.
+        """
+        self._frame_rate = frame_rate
+
+    def play(self, steps, repeats=0):
+        """
+        Start playing a pattern, replacing the current one.
+
+        :param steps: A list of (colour, fade_millis) tuples.
+        :param repeats: The number of times to play the pattern; 0 plays it until stopped.
+        """
+        with self._condition:
+            self._generation += 1
+            self._animation = (self._generation, tuple(steps), repeats)
+            if not self._thread:
+                # Every timer thread has its own event, so that one being stopped can't miss it to a new one
+                self._stopped = threading.Event()
+                self._thread = threading.Thread(target=self._run, args=(self._stopped,), name=self.__class__.__name__)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify_all()
+
+    def cancel(self):
+        """
+        Stop playing, without waiting for the timer thread.
+        """
+        with self._condition:
+            self._generation += 1
+            self._animation = None
+            self._condition.notify_all()
+
+    def stop(self):
+        """
+        Stop playing and end the timer thread, if started. A later play starts a new one. It must not be called while
+        holding a lock that writes wait for, as the timer thread may be waiting for it.
+        """
+        with self._condition:
+            self._generation += 1
+            self._animation = None
+            thread = self._thread
+            if thread:
+                self._stopped.set()
+                self._thread = None
+            self._condition.notify_all()
+        if thread:
+            thread.join()
+
+    def render(self, steps, frame_rate):
+        """
+        Render a pattern to frames, fading linearly from the last step's colour through every step.
+
+        :param steps: A list of (colour, fade_millis) tuples.
+        :param frame_rate: The frame rate in frames per second.
+        :return: A list of (frame, seconds) tuples.
+        """
+        frame_seconds = 1.0 / frame_rate
+        # The device fades between frames, to smooth the steps
+        frame_fade_millis = int(1000 * frame_seconds)
+        frames = []
+        (previous_colour, _) = steps[-1]
+        for (colour, fade_millis) in steps:
+            nr_of_frames = max(1, int(round(fade_millis * frame_rate / 1000.0)))
+            for index in range(1, nr_of_frames + 1):
+                fraction = float(index) / nr_of_frames
+                frame_colour = tuple(int(round(start + fraction * (end - start)))
+                                     for (start, end) in zip(previous_colour, colour))
+                # Frames are compared after creation, as distinct colours may still map to the same frame
+                frame = self._create_frame(frame_colour, frame_fade_millis)
+                if frames and frames[-1][0] == frame:
+                    frames[-1][1] += frame_seconds
+                else:
+                    frames.append([frame, frame_seconds])
+            previous_colour = colour
+        return [(frame, seconds) for (frame, seconds) in frames]
+
+    def _is_current(self, generation):
+        """
+        Check whether an animation is still the current one.
+
+        :param generation: The animation's generation.
+        :return: True if current.
+        """
+        return generation == self._generation
+
+    def _run(self, stopped):
+        """
+        Timer thread.
+
+        :param stopped: An event that is set to end the thread.
+        """
+        while True:
+            with self._condition:
+                while self._animation is None and not stopped.is_set():
+                    self._condition.wait()
+                if stopped.is_set():
+                    return
+                (generation, steps, repeats) = self._animation
+                frame_rate = self._frame_rate
+            frames = self.render(steps, frame_rate)
+            if self._play(generation, frames, repeats, frame_rate):
+                with self._condition:
+                    if self._is_current(generation):
+                        self._animation = None
+
+    def _play(self, generation, frames, repeats, frame_rate):
+        """
+        Play frames until done, replaced or over budget.
+
+        :param generation: The animation's generation.
+        :param frames: A list of (frame, seconds) tuples.
+        :param repeats: The number of times to play the frames; 0 plays them until replaced.
+        :param frame_rate: The frame rate the frames were rendered at.
+        :return: True if done or the write failed, False if replaced or the frame rate was dropped.
+        """
+        budget = 1.0 / frame_rate
+        overruns = 0
+        iteration = 0
+        is_current = lambda: self._is_current(generation)
+        while repeats == 0 or iteration < repeats:
+            for (frame, seconds) in frames:
+                start = time.time()
+                if not is_current():
+                    return False
+                if not self._write(frame, is_current):
+                    return is_current()
+                elapsed = time.time() - start
+                overruns = overruns + 1 if elapsed > budget else 0
+                if overruns >= self._MAX_OVERRUNS and frame_rate > self._min_frame_rate:
+                    with self._condition:
+                        self._frame_rate = max(self._min_frame_rate, frame_rate / 2.0)
+                    self._logger.warning('Device writes are too slow for %s fps; dropping to %s fps', frame_rate, self._frame_rate)
+                    return False
+                with self._condition:
+                    if not is_current():
+                        return False
+                    self._condition.wait(max(0.0, seconds - elapsed))
+            iteration += 1
+        return True
+
+
+class DeviceWorker(object):
+    """
+    Serialises all operations on a device through a single thread, fed by a bounded command queue. It has the same
+    interface as a device, so that it can be shared by a controller and a device monitor in place of the device.
+
+    Opening is reference counted: The device is only opened by the first open and only closed by the last close, so
+    that overlapping open/close sequences from different threads don't open the same handle twice. Sends are
+    asynchronous and a pending send is updated in place by a later one, so that the latest state wins. All other
+    operations block until they have been executed and raise any error of the device.
+    """
+
+    _DEFAULT_MAX_QUEUE_SIZE = 16
+
+    def __init__(self, device, max_queue_size=_DEFAULT_MAX_QUEUE_SIZE):
+        """
+        Constructor.
+
+        :param device: The device to operate on.
+        :param max_queue_size: The maximum number of queued commands, after which callers are blocked.
+        """
+        self._logger = logging.getLogger()
+        self._device = device
+        self._max_queue_size = max_queue_size
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        self._pending_send = None
+        self._open_count = 0
+        self._running = False
+        self._thread = None
+        # Metrics
+        self._max_queue_depth = 0
+        self._nr_of_writes = 0
+        self._nr_of_write_errors = 0
+        self._nr_of_coalesced_writes = 0
+        self._total_write_latency = 0.0
+        self._max_write_latency = 0.0
+        self._last_write_latency = None
+        self._write_histogram = None
+        self._write_error_handler = None
+
+    def start(self):
+        """
+        Start the worker thread.
+        """
+        self._logger.info('Device worker starting')
+        with self._condition:
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name=self.__class__.__name__)
+        self._thread.start()
+        self._logger.info('Device worker started')
+
+    def stop(self):
+        """
+        Stop the worker thread, after it has executed all queued commands.
+        """
+        self._logger.info('Device worker stopping')
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        self._thread.join()
+        self._logger.info('Device worker stopped')
+
+    def get_vendor_id(self):
+        """
+        Get the vendor ID of the device.
+        """
+        return self._device.get_vendor_id()
+
+    def get_product_id(self):
+        """
+        Get the product ID of the device.
+        """
+        return self._device.get_product_id()
+
+    def open(self):
+        """
+        Open the device for communication, if not already open.
+        """
+        self._call(self._open)
+
+    def is_open(self):
+        """
+        Check whether the device is open for communication.
+        """
+        return self._open_count > 0
+
+    def probe(self):
+        """
+        Check whether the device is present, without opening it.
+
+        :return: True if the device is plugged in.
+        """
+        return self._call(self._device.probe)
+
+    def reset(self):
+        """
+        Forget any state kept about what the device is showing.
+        """
+        self._call(self._device.reset)
+
+    def set_progress(self, progress):
+        """
+        Set the progress of running builds.
+
+        :param progress: The progress as a fraction, or None if unknown.
+        """
+        self._call(self._device.set_progress, progress)
+
+    def set_stale(self, stale):
+        """
+        Mark the state shown as stale.
+
+        :param stale: True if stale.
+        """
+        self._call(self._device.set_stale, stale)
+
+    def send(self, any_builds_running, any_build_failures):
+        """
+        Queue build information to be sent to the device. Errors are logged and counted, not raised.
+
+        :param any_builds_running: True if any builds running. None if unknown or undefined.
+        :param any_build_failures: True if any builds failing or failed. None if unknown or undefined.
+        """
+        with self._condition:
+            if self._pending_send:
+                self._pending_send.args = (any_builds_running, any_build_failures)
+                self._nr_of_coalesced_writes += 1
+                return
+            command = _DeviceCommand(self._send, (any_builds_running, any_build_failures))
+            self._submit(command)
+            self._pending_send = command
+
+    def off(self):
+        """
+        Switch off the LED.
+        """
+        self._call(self._device.off)
+
+    def close(self):
+        """
+        Close the device for communication, if this is the last open reference.
+        """
+        self._call(self._close)
+
+    def run(self, function, *args):
+        """
+        Execute any function on the device on the worker thread and wait for it to complete, e.g. to reconfigure the
+        device between writes.
+
+        :param function: The function, which accepts the device, followed by the arguments.
+        :param args: The function's arguments.
+        :return: The function's return value.
+        """
+        return self._call(function, self._device, *args)
+
+    def set_write_error_handler(self, handler):
+        """
+        Set a handler for sends that fail, called on the worker thread, so that the caller can write the state again.
+
+        :param handler: A function which accepts the parameters (any_builds_running, any_build_failures) of the failed
+                        send, or None.
+        """
+        with self._condition:
+            self._write_error_handler = handler
+
+    def set_write_histogram(self, histogram):
+        """
+        Set a histogram to observe the latency of every write in, from being queued to being written.
+
+        :param histogram: A metrics Histogram, or None to stop observing.
+        """
+        with self._condition:
+            self._write_histogram = histogram
+
+    def get_metrics(self):
+        """
+        Get the worker's metrics.
+
+        :return: A dictionary of the queue depth, the maximum queue depth, the number of writes, write errors and
+                 coalesced writes, and the last, mean and maximum write latency (from being queued to being written) in
+                 seconds.
+        """
+        with self._condition:
+            return {'queue_depth': len(self._queue),
+                    'max_queue_depth': self._max_queue_depth,
+                    'writes': self._nr_of_writes,
+                    'write_errors': self._nr_of_write_errors,
+                    'coalesced_writes': self._nr_of_coalesced_writes,
+                    'last_write_latency': self._last_write_latency,
+                    'mean_write_latency': (self._total_write_latency / self._nr_of_writes if self._nr_of_writes else None),
+                    'max_write_latency': self._max_write_latency}
+
+    def _submit(self, command):
+        """
+        Queue a command, blocking while the queue is full. The condition must be held.
+
+        :param command: The command.
+        """
+        while self._running and len(self._queue) >= self._max_queue_size:
+            self._condition.wait()
+        if not self._running:
+            raise IOError('Device worker is not running')
+        self._queue.append(command)
+        self._max_queue_depth = max(self._max_queue_depth, len(self._queue))
+        self._condition.notify_all()
+
+    def _call(self, function, *args):
+        """
+        Execute a function on the worker thread and wait for it to complete.
+
+        :param function: The function.
+        :param args: The function's arguments.
+        :return: The function's return value.
+        """
+        command = _DeviceCommand(function, args)
+        with self._condition:
+            self._submit(command)
+        command.done.wait()
+        if command.error:
+            raise command.error
+        return command.result
+
+    def _open(self):
+        """
+        Open the device on the first reference. Worker thread only.
+        """
+        if self._open_count == 0:
+            self._device.open()
+        self._open_count += 1
+
+    def _close(self):
+        """
+        Close the device on the last reference. Worker thread only.
+        """
+        if self._open_count == 0:
+            return
+        self._open_count -= 1
+        if self._open_count == 0:
+            self._device.close()
+
+    def _send(self, any_builds_running, any_build_failures):
+        """
+        Send build information to the device and record the write's metrics. Worker thread only.
+
+        :param any_builds_running: True if any builds running. None if unknown or undefined.
+        :param any_build_failures: True if any builds failing or failed. None if unknown or undefined.
+        :return: True if written.
+        """
+        # Nobody waits for a send, so errors are logged here
+        # noinspection PyBroadException
+        # pylint: disable=broad-except
+        try:
+            self._device.send(any_builds_running, any_build_failures)
+            return True
+        except Exception, error:
+            self._logger.error('Could not write to device: %s', error)
+            with self._condition:
+                self._nr_of_write_errors += 1
+                write_error_handler = self._write_error_handler
+            if write_error_handler:
+                write_error_handler(any_builds_running, any_build_failures)
+            return False
+        # pylint: enable=broad-except
+
+    def _run(self):
+        """
+        Worker thread.
+        """
+        while True:
+            with self._condition:
+                while self._running and not self._queue:
+                    self._condition.wait()
+                if not self._queue:
+                    break
+                command = self._queue.popleft()
+                if command is self._pending_send:
+                    self._pending_send = None
+                self._condition.notify_all()
+            command.execute()
+            if command.function == self._send and command.result:
+                latency = time.time() - command.queued_at
+                with self._condition:
+                    self._nr_of_writes += 1
+                    self._total_write_latency += latency
+                    self._max_write_latency = max(self._max_write_latency, latency)
+                    self._last_write_latency = latency
+                    if self._write_histogram is not None:
+                        self._write_histogram.observe(latency)
+
+
+class _DeviceCommand(object):
+    """
+    A device operation, queued for the device worker.
+    """
+
+    def __init__(self, function, args):
+        """
+        Constructor.
+
+        :param function: The function to execute.
+        :param args: The function's arguments.
+        """
+        self.function = function
+        self.args = args
+        self.queued_at = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def execute(self):
+        """
+        Execute the command and signal its completion.
+        """
+        # noinspection PyBroadException
+        # pylint: disable=broad-except
+        try:
+            self.result = self.function(*self.args)
+        except Exception, error:
+            self.error = error
+        # pylint: enable=broad-except
+        self.done.set()
@@ -0,0 +1,626 @@
+# Copyright 2013 Pieter Rautenbach
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A fake TeamCity REST API, serving synthetic projects, build types, builds, changes and users generated from a seed, for
+tests, benchmarks and trying out the build light without a build server.
+
+The resources the client requests are served, with the build locator dimensions it uses (id, buildType, status,
+running, personal, canceled and sinceBuild), paging with count and start, and fields. Latency and errors can be
+injected, and requests are counted by endpoint.
+
+Run with python -m whatsthatlight.fake_teamcity, and point server_url at it.
+"""
+
+# System imports
+from __future__ import print_function
+import argparse
+import BaseHTTPServer
+import json
+import logging
+import random
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+
+# Local imports
+from whatsthatlight import clients
+
+# Constants
+_API_PATH = '/httpAuth/app/rest'
+_BUILD_TYPES_PATH = _API_PATH + '/buildTypes'
+_BUILDS_PATH = _API_PATH + '/builds'
+_CHANGES_PATH = _API_PATH + '/changes'
+_ID_PREFIX = 'id:'
+_BUILD_TYPE_HREF_TEMPLATE = _BUILD_TYPES_PATH + '/id:{0}'
+_BUILD_HREF_TEMPLATE = _BUILDS_PATH + '/id:{0}'
+_CHANGES_HREF_TEMPLATE = _CHANGES_PATH + '?locator=build:(id:{0})'
+_CHANGE_HREF_TEMPLATE = _CHANGES_PATH + '/id:{0}'
+# Changes are identified by their build's ID and their index in it, so that they needn't be stored
+_MAX_NR_OF_CHANGES_PER_BUILD = 1000
+_SUCCESS_STATUS = 'SUCCESS'
+_FAILURE_STATUS = 'FAILURE'
+_RUNNING_STATE = 'running'
+_FINISHED_STATE = 'finished'
+_DEFAULT_PORT = 8111
+
+
+class FakeTeamCityData(object):
+    """
+    Synthetic build server data. Every build type has a short history of finished builds, of which the latest may have
+    failed, and may have a build running. Every build has a fixed number of changes, by users picked from the seed.
+    Builds can be added, started and finished at any time, e.g. to flip a build type's state.
+    """
+
+    def __init__(self, seed=0, nr_of_projects=10, nr_of_build_types=100, nr_of_users=50, nr_of_changes_per_build=2,
+                 failure_rate=0.1, running_rate=0.05):
+        """
+        Constructor.
+
+        :param seed: The seed of the random data.
+        :param nr_of_projects: The number of projects, over which the build types are spread.
+        :param nr_of_build_types: The number of build types.
+        :param nr_of_users: The number of users, named user0, user1 and so on.
+        :param nr_of_changes_per_build: The number of changes in every build.
+        :param failure_rate: The fraction of build types whose latest finished build failed.
+        :param running_rate: The fraction of build types with a build running.
+        """
+        if nr_of_changes_per_build >= _MAX_NR_OF_CHANGES_PER_BUILD:
+            raise ValueError('At most {0} changes per build'.format(_MAX_NR_OF_CHANGES_PER_BUILD - 1))
+        self._seed = seed
+        self._nr_of_users = nr_of_users
+        self._nr_of_changes_per_build = nr_of_changes_per_build
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._next_build_id = 1
+        self.build_types = []
+        self._build_types_by_id = {}
+        # Builds by ID, and lists of the IDs of every build type's builds, oldest first
+        self._builds = {}
+        self._build_ids = {}
+        # The IDs of the running builds, which are listed every check
+        self._running_build_ids = set()
+        for index in range(nr_of_build_types):
+            project_id = 'Project{0}'.format(index % max(nr_of_projects, 1))
+            build_type_id = '{0}_Build{1}'.format(project_id, index)
+            build_type = {'id': build_type_id,
+                          'name': 'Build {0}'.format(index),
+                          'projectId': project_id,
+                          'href': _BUILD_TYPE_HREF_TEMPLATE.format(build_type_id)}
+            self.build_types.append(build_type)
+            self._build_types_by_id[build_type_id] = build_type
+            self._build_ids[build_type_id] = []
+            self._add_build(build_type_id, _SUCCESS_STATUS, _FINISHED_STATE)
+            if self._random.random() < failure_rate:
+                self._add_build(build_type_id, _FAILURE_STATUS, _FINISHED_STATE)
+            if self._random.random() < running_rate:
+                self._add_build(build_type_id, _SUCCESS_STATUS, _RUNNING_STATE)
+
+    def get_users(self):
+        """
+        Get the usernames.
+
+        :return: A list of usernames.
+        """
+        return ['user{0}'.format(index) for index in range(self._nr_of_users)]
+
+    def add_build(self, build_type_id, status, username=None):
+        """
+        Add a finished build.
+
+        :param build_type_id: The build type's ID.
+        :param status: SUCCESS or FAILURE.
+        :param username: The user who triggered the build, or None if triggered by a VCS change.
+        :return: The build's ID.
+        """
+        with self._lock:
+            return self._add_build(build_type_id, status, _FINISHED_STATE, username)
+
+    def start_build(self, build_type_id, username=None):
+        """
+        Start a build.
+
+        :param build_type_id: The build type's ID.
+        :param username: The user who triggered the build, or None if triggered by a VCS change.
+        :return: The build's ID.
+        """
+        with self._lock:
+            return self._add_build(build_type_id, _SUCCESS_STATUS, _RUNNING_STATE, username)
+
+    def finish_build(self, build_id, status):
+        """
+        Finish a running build.
+
+        :param build_id: The build's ID.
+        :param status: SUCCESS or FAILURE.
+        """
+        with self._lock:
+            build = self._builds[build_id]
+            build['status'] = status
+            build['state'] = _FINISHED_STATE
+            build['percentageComplete'] = None
+            self._running_build_ids.discard(build_id)
+
+    def get_builds(self, locator):
+        """
+        Get the builds that match a locator, newest first.
+
+        :param locator: A dictionary of locator dimensions.
+        :return: A list of build summaries.
+        """
+        with self._lock:
+            running = locator.get('running', 'false')
+            if 'id' in locator:
+                build_ids = [_parse_id(locator['id'])] if _parse_id(locator['id']) in self._builds else []
+            elif 'buildType' in locator:
+                build_ids = list(reversed(self._build_ids.get(_strip_id(locator['buildType']), [])))
+            elif running == 'true':
+                build_ids = sorted(self._running_build_ids, reverse=True)
+            else:
+                build_ids = sorted(self._builds, reverse=True)
+            status = locator.get('status')
+            since_build_id = None
+            if 'sinceBuild' in locator and 'buildType' in locator:
+                since_build_id = self._find_since_build_id(_strip_id(locator['buildType']), locator['sinceBuild'])
+            builds = []
+            for build_id in build_ids:
+                build = self._builds[build_id]
+                if running != 'any' and (build['state'] == _RUNNING_STATE) != (running == 'true'):
+                    continue
+                if status and build['status'] != status:
+                    continue
+                if since_build_id is not None and build_id <= since_build_id:
+                    continue
+                builds.append(self._summarise_build(build))
+            return builds
+
+    def get_build(self, build_id):
+        """
+        Get a build's details.
+
+        :param build_id: The build's ID.
+        :return: The build's details, or None if not found.
+        """
+        with self._lock:
+            build = self._builds.get(build_id)
+            if build is None:
+                return None
+            details = self._summarise_build(build)
+        details['buildType'] = dict(self._build_types_by_id[build['buildTypeId']])
+        details['triggered'] = ({'type': 'user', 'user': {'username': build['username']}} if build['username']
+                                else {'type': 'vcs'})
+        details['changes'] = {'count': self._nr_of_changes_per_build, 'href': _CHANGES_HREF_TEMPLATE.format(build_id)}
+        details['tags'] = {'count': 0, 'tag': []}
+        return details
+
+    def get_changes(self, build_id):
+        """
+        Get the changes of a build.
+
+        :param build_id: The build's ID.
+        :return: A list of change summaries, or None if the build isn't found.
+        """
+        with self._lock:
+            if build_id not in self._builds:
+                return None
+        return [{'id': change_id, 'href': _CHANGE_HREF_TEMPLATE.format(change_id)}
+                for change_id in range(build_id * _MAX_NR_OF_CHANGES_PER_BUILD,
+                                       build_id * _MAX_NR_OF_CHANGES_PER_BUILD + self._nr_of_changes_per_build)]
+
+    def get_change(self, change_id):
+        """
+        Get a change's details.
+
+        :param change_id: The change's ID.
+        :return: The change's details, or None if not found.
+        """
+        (build_id, index) = divmod(change_id, _MAX_NR_OF_CHANGES_PER_BUILD)
+        with self._lock:
+            if build_id not in self._builds or index >= self._nr_of_changes_per_build:
+                return None
+        # The same change always has the same user, without storing it
+        username = 'user{0}'.format(random.Random(self._seed * 1000003 + change_id).randrange(self._nr_of_users))
+        return {'id': change_id,
+                'version': '{0:040x}'.format(change_id),
+                'username': username,
+                'user': {'username': username},
+                'href': _CHANGE_HREF_TEMPLATE.format(change_id)}
+
+    def _add_build(self, build_type_id, status, state, username=None):
+        """
+        Add a build. The lock must be held, unless constructing.
+
+        :param build_type_id: The build type's ID.
+        :param status: SUCCESS or FAILURE.
+        :param state: running or finished.
+        :param username: The user who triggered the build, or None if triggered by a VCS change.
+        :return: The build's ID.
+        """
+        build_id = self._next_build_id
+        self._next_build_id += 1
+        self._builds[build_id] = {'id': build_id,
+                                  'buildTypeId': build_type_id,
+                                  'number': str(len(self._build_ids[build_type_id]) + 1),
+                                  'status': status,
+                                  'state': state,
+                                  'percentageComplete': self._random.randint(1, 99) if state == _RUNNING_STATE else None,
+                                  'username': username}
+        self._build_ids[build_type_id].append(build_id)
+        if state == _RUNNING_STATE:
+            self._running_build_ids.add(build_id)
+        return build_id
+
+    def _find_since_build_id(self, build_type_id, since_build):
+        """
+        Find the build a sinceBuild dimension refers to: the latest finished build of a build type with a status.
+        The lock must be held.
+
+        :param build_type_id: The build type's ID.
+        :param since_build: The dimension's value, e.g. status:SUCCESS.
+        :return: The build's ID, or 0 if there is none.
+        """
+        since_locator = parse_locator(since_build)
+        for build_id in reversed(self._build_ids.get(build_type_id, [])):
+            build = self._builds[build_id]
+            if build['state'] == _FINISHED_STATE and build['status'] == since_locator.get('status', build['status']):
+                return build_id
+        return 0
+
+    @staticmethod
+    def _summarise_build(build):
+        """
+        Get a build as listed.
+
+        :param build: The build.
+        :return: The build's summary.
+        """
+        summary = {'id': build['id'],
+                   'buildTypeId': build['buildTypeId'],
+                   'number': build['number'],
+                   'status': build['status'],
+                   'state': build['state'],
+                   'href': _BUILD_HREF_TEMPLATE.format(build['id'])}
+        if build['percentageComplete'] is not None:
+            summary['percentageComplete'] = build['percentageComplete']
+        return summary
+
+
+class FakeTeamCityServer(object):
+    """
+    Serves FakeTeamCityData over HTTP, on daemon threads, with optional latency and errors.
+    """
+
+    def __init__(self, data, port=0, host='127.0.0.1', latency=0.0, error_rate=0.0, seed=0):
+        """
+        Constructor.
+
+        :param data: The FakeTeamCityData to serve.
+        :param port: The port to listen on; 0 for any free port.
+        :param host: The address to listen on.
+        :param latency: The time in seconds every response is delayed by, to simulate the round trip.
+        :param error_rate: The fraction of requests that fail with an internal server error.
+        :param seed: The seed of the errors.
+        """
+        self._logger = logging.getLogger()
+        self.data = data
+        self._address = (host, port)
+        self._latency = latency
+        self._error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._request_counts = {}
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """
+        Start serving.
+        """
+        fake_server = self
+
+        class _FakeTeamCityRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            """
+            Serves the API.
+            """
+
+            # Keep connections open, as TeamCity does
+            protocol_version = 'HTTP/1.1'
+            # Write every response at once, as a response written in parts over a kept-open connection is held up by
+            # delayed acknowledgements
+            wbufsize = -1
+            disable_nagle_algorithm = True
+
+            # noinspection PyPep8Naming
+            def do_GET(self):  # pylint: disable=invalid-name
+                """
+                Serve a resource.
+                """
+                (status, body) = fake_server.handle(self.path)
+                content = json.dumps(body) if status == 200 else body
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json' if status == 200 else 'text/plain')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, log_format, *args):
+                """
+                Don't log requests.
+                """
+
+        self._server = _ThreadingHttpServer(self._address, _FakeTeamCityRequestHandler)
+        self._thread = threading.Thread(target=self._server.serve_forever, name=self.__class__.__name__)
+        self._thread.daemon = True
+        self._thread.start()
+        self._logger.info('Fake TeamCity server started on %s', self.get_url())
+
+    def stop(self):
+        """
+        Stop serving.
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def get_url(self):
+        """
+        Get the server's URL, to use as the client's server URL.
+
+        :return: The URL.
+        """
+        return 'http://{0}:{1}/'.format(*self._server.server_address[:2])
+
+    def set_latency(self, latency):
+        """
+        Change the time every response is delayed by.
+
+        :param latency: The time in seconds.
+        """
+        self._latency = latency
+
+    def set_error_rate(self, error_rate):
+        """
+        Change the fraction of requests that fail.
+
+        :param error_rate: The fraction.
+        """
+        self._error_rate = error_rate
+
+    def get_request_counts(self):
+        """
+        Get the number of requests made so far, by endpoint.
+
+        :return: A dictionary of counts by endpoint, with IDs normalised as by the client.
+        """
+        with self._lock:
+            return dict(self._request_counts)
+
+    def reset_request_counts(self):
+        """
+        Forget the requests made so far.
+        """
+        with self._lock:
+            self._request_counts = {}
+
+    def handle(self, resource):
+        """
+        Handle a request.
+
+        :param resource: The HTTP resource.
+        :return: A tuple of the HTTP status, and the JSON data or, on an error, a message.
+        """
+        endpoint = clients.TeamCityClient.get_endpoint(resource)
+        with self._lock:
+            self._request_counts[endpoint] = self._request_counts.get(endpoint, 0) + 1
+            is_error = self._error_rate and self._random.random() < self._error_rate
+        if self._latency:
+            time.sleep(self._latency)
+        if is_error:
+            return 500, 'Injected error'
+        (path, _, query) = resource.partition('?')
+        path = path.rstrip('/')
+        parameters = dict(urlparse.parse_qsl(query))
+        locator = parse_locator(parameters.get('locator', ''))
+        if path == _BUILD_TYPES_PATH:
+            body = _page('buildType', list(self.data.build_types), locator, resource)
+        elif path == _BUILDS_PATH:
+            body = _page('build', self.data.get_builds(locator), locator, resource)
+        elif path.startswith(_BUILDS_PATH + '/' + _ID_PREFIX):
+            body = self.data.get_build(_parse_id(path[len(_BUILDS_PATH) + 1:]))
+        elif path == _CHANGES_PATH and 'build' in locator:
+            changes = self.data.get_changes(_parse_id(locator['build'].strip('()')))
+            body = None if changes is None else _page('change', changes, locator, resource)
+        elif path.startswith(_CHANGES_PATH + '/' + _ID_PREFIX):
+            body = self.data.get_change(_parse_id(path[len(_CHANGES_PATH) + 1:]))
+        else:
+            body = None
+        if body is None:
+            return 404, 'Not found: {0}'.format(resource)
+        if 'fields' in parameters:
+            body = filter_fields(body, parse_fields(parameters['fields']))
+        return 200, body
+
+
+class _ThreadingHttpServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    An HTTP server that handles every connection on a thread of its own.
+    """
+
+    daemon_threads = True
+
+
+def parse_locator(locator):
+    """
+    Parse a TeamCity locator, e.g. buildType:(id:Backend_Test),status:FAILURE.
+
+    :param locator: The locator.
+    :return: A dictionary of dimension values by name. Nested locators are kept as text, without their parentheses.
+    """
+    dimensions = {}
+    for dimension in _split_top_level(locator, ','):
+        (name, _, value) = dimension.partition(':')
+        if value.startswith('(') and value.endswith(')'):
+            value = value[1:-1]
+        dimensions[name] = value
+    return dimensions
+
+
+def parse_fields(fields):
+    """
+    Parse a TeamCity fields specification, e.g. count,build(id,href).
+
+    :param fields: The specification.
+    :return: A dictionary of the nested specification by field, or None for a field to include as is.
+    """
+    specification = {}
+    for field in _split_top_level(fields, ','):
+        (name, _, nested) = field.partition('(')
+        specification[name] = parse_fields(nested[:-1]) if nested else None
+    return specification
+
+
+def filter_fields(value, specification):
+    """
+    Keep only the specified fields of JSON data.
+
+    :param value: The data.
+    :param specification: A parsed fields specification, in which * includes all fields.
+    :return: The filtered data.
+    """
+    if isinstance(value, list):
+        return [filter_fields(item, specification) for item in value]
+    if not isinstance(value, dict) or specification is None:
+        return value
+    if '*' in specification:
+        return value
+    return dict((name, filter_fields(value[name], nested)) for (name, nested) in specification.iteritems()
+                if name in value)
+
+
+def _split_top_level(text, separator):
+    """
+    Split text on a separator, except within parentheses.
+
+    :param text: The text.
+    :param separator: The separator.
+    :return: A list of the parts, without empty parts.
+    """
+    parts = []
+    depth = 0
+    start = 0
+    for (index, character) in enumerate(text):
+        if character == '(':
+            depth += 1
+        elif character == ')':
+            depth -= 1
+        elif character == separator and depth == 0:
+            parts.append(text[start:index])
+            start = index + 1
+    parts.append(text[start:])
+    return [part for part in parts if part]
+
+
+def _strip_id(value):
+    """
+    Strip the id: prefix of a locator value, e.g. of buildType:(id:Backend_Test).
+
+    :param value: The value.
+    :return: The ID.
+    """
+    return value[len(_ID_PREFIX):] if value.startswith(_ID_PREFIX) else value
+
+
+def _parse_id(value):
+    """
+    Parse a numeric ID, e.g. of id:1234.
+
+    :param value: The ID, with or without the id: prefix.
+    :return: The ID, or None if not numeric.
+    """
+    value = _strip_id(value)
+    return int(value) if value.isdigit() else None
+
+
+def _page(item_name, items, locator, resource):
+    """
+    Get a page of a list, as TeamCity lists items.
+
+    :param item_name: The name of the list's items, e.g. build.
+    :param items: All items.
+    :param locator: The request's locator, with optional count and start dimensions.
+    :param resource: The HTTP resource, to link to the next page.
+    :return: The page.
+    """
+    start = int(locator.get('start', 0))
+    count = int(locator['count']) if 'count' in locator else len(items)
+    page = items[start:start + count]
+    body = {'count': len(page), 'href': resource, item_name: page}
+    if start + count < len(items):
+        # Nested locators are put back in their parentheses
+        next_locator = ','.join('{0}:{1}'.format(name, '({0})'.format(value) if ':' in value else value)
+                                for (name, value) in sorted(locator.iteritems()) if name not in ('start', 'count'))
+        body['nextHref'] = '{0}?locator={1}'.format(resource.partition('?')[0],
+                                                    ','.join(part for part in (next_locator,
+                                                                               'count:{0}'.format(count),
+                                                                               'start:{0}'.format(start + count))
+                                                             if part))
+    return body
+
+
+def main():
+    """
+    Serve fake data until interrupted.
+    """
+    parser = argparse.ArgumentParser(description='A fake TeamCity REST API, serving synthetic data.')
+    parser.add_argument('--port', type=int, default=_DEFAULT_PORT, help='The port to listen on.')
+    parser.add_argument('--host', default='127.0.0.1', help='The address to listen on.')
+    parser.add_argument('--seed', type=int, default=0, help='The seed of the random data.')
+    parser.add_argument('--projects', type=int, default=10, help='The number of projects.')
+    parser.add_argument('--build-types', type=int, default=100, help='The number of build types.')
+    parser.add_argument('--users', type=int, default=50, help='The number of users.')
+    parser.add_argument('--changes', type=int, default=2, help='The number of changes per build.')
+    parser.add_argument('--failure-rate', type=float, default=0.1, help='The fraction of build types failing.')
+    parser.add_argument('--running-rate', type=float, default=0.05, help='The fraction of build types running.')
+    parser.add_argument('--latency', type=float, default=0.0, help='The delay of every response, in seconds.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='The fraction of requests that fail.')
+    arguments = parser.parse_args()
+    logging.basicConfig()
+    data = FakeTeamCityData(seed=arguments.seed,
+                            nr_of_projects=arguments.projects,
+                            nr_of_build_types=arguments.build_types,
+                            nr_of_users=arguments.users,
+                            nr_of_changes_per_build=arguments.changes,
+                            failure_rate=arguments.failure_rate,
+                            running_rate=arguments.running_rate)
+    server = FakeTeamCityServer(data=data,
+                                port=arguments.port,
+                                host=arguments.host,
+                                latency=arguments.latency,
+                                error_rate=arguments.error_rate,
+                                seed=arguments.seed)
+    server.start()
+    # Flushed, as benchmarks read the URL from a pipe
+    print('Serving on {0}; press Ctrl-C to stop'.format(server.get_url()))
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
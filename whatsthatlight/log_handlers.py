@@ -0,0 +1,145 @@
+# Copyright 2013 Pieter Rautenbach
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Asynchronous logging: Records are handed to a queue, and written by the configured handlers on a background thread, so
+that file I/O and rotation never hold up the threads that log. Python 2 has no QueueHandler or QueueListener, so these
+follow the Python 3 classes of the same names.
+"""
+
+# System imports
+import logging
+import Queue
+import threading
+
+# Constants
+_DEFAULT_QUEUE_SIZE = 10000
+
+
+class QueueHandler(logging.Handler):
+    """
+    A handler that hands records to a queue, for a QueueListener to pass on to the target handler. A record is dropped,
+    and counted, if the queue is full, rather than blocking the thread that logs.
+    """
+
+    def __init__(self, queue, target):
+        """
+        Constructor.
+
+        :param queue: The queue.
+        :param target: The handler the records are for. Its level applies here already, so that records it ignores are
+                       never queued.
+        """
+        logging.Handler.__init__(self, level=target.level)
+        self.queue = queue
+        self.target = target
+        self.nr_of_dropped_records = 0
+
+    def prepare(self, record):
+        """
+        Merge the message and its arguments, which may change once the caller continues, before the record is queued.
+
+        :param record: The log record.
+        :return: The record.
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def emit(self, record):
+        """
+        Queue a record.
+
+        :param record: The log record.
+        """
+        # noinspection PyBroadException
+        # pylint: disable=broad-except
+        try:
+            self.queue.put_nowait((self.target, self.prepare(record)))
+        except Queue.Full:
+            self.nr_of_dropped_records += 1
+        except Exception:
+            self.handleError(record)
+        # pylint: enable=broad-except
+
+
+class QueueListener(object):
+    """
+    Passes queued records on to their target handlers, on a background thread.
+    """
+
+    _STOP = None
+
+    def __init__(self, queue):
+        """
+        Constructor.
+
+        :param queue: The queue QueueHandlers hand records to.
+        """
+        self.queue = queue
+        self._thread = None
+
+    def start(self):
+        """
+        Start passing on records.
+        """
+        self._thread = threading.Thread(target=self._run, name=self.__class__.__name__)
+        # Never keep the process alive, but stop() is expected at exit to flush the queue
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Pass on the records queued so far, and stop.
+        """
+        if self._thread:
+            self.queue.put(self._STOP)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        """
+        Listener thread.
+        """
+        while True:
+            item = self.queue.get()
+            if item is self._STOP:
+                break
+            (target, record) = item
+            target.handle(record)
+
+
+def enqueue_handlers(queue_size=_DEFAULT_QUEUE_SIZE):
+    """
+    Move the handlers of all loggers behind one queue, with a listener that writes to them on a background thread.
+    Every logger keeps its handlers, levels and propagation, so the configuration still applies as written.
+
+    :param queue_size: The maximum number of records waiting to be written.
+    :return: The started QueueListener, to stop at exit.
+    """
+    queue = Queue.Queue(queue_size)
+    queue_handlers = {}
+    loggers = [logging.getLogger()] + [logger for logger in logging.Logger.manager.loggerDict.values()
+                                       if isinstance(logger, logging.Logger)]
+    for logger in loggers:
+        for handler in list(logger.handlers):
+            if isinstance(handler, QueueHandler):
+                continue
+            if handler not in queue_handlers:
+                queue_handlers[handler] = QueueHandler(queue, handler)
+            logger.removeHandler(handler)
+            logger.addHandler(queue_handlers[handler])
+    listener = QueueListener(queue)
+    listener.start()
+    return listener
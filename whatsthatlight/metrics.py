@@ -0,0 +1,553 @@
+# Copyright 2013 Pieter Rautenbach
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Metrics, served over HTTP in the Prometheus text format.
+
+Measurements on the hot path are only observations into histograms whose buckets are allocated up front; everything
+else is read from the instrumented objects when the metrics are scraped.
+"""
+
+# System imports
+import bisect
+import collections
+import logging
+import threading
+
+# Local imports
+from whatsthatlight import devices
+
+# Constants
+DEFAULT_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DEFAULT_SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+_METRICS_PATH = '/metrics'
+_DEFAULT_DEVICE_NAME = 'default'
+
+
+class Histogram(object):
+    """
+    A histogram with fixed buckets. An observation increments one bucket's count, and the count and sum.
+    """
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        """
+        Constructor.
+
+        :param buckets: The upper bounds of the buckets, in increasing order. Larger values are counted in an implicit
+                        +Inf bucket.
+        """
+        self._buckets = tuple(buckets)
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+
+    def observe(self, value):
+        """
+        Record a value.
+
+        :param value: The value.
+        """
+        # A value equal to a bound is in that bound's bucket
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._sum += value
+        self._count += 1
+
+    def get_buckets(self):
+        """
+        Get the cumulative count of every bucket.
+
+        :return: A list of (upper bound, count of values up to it) tuples, ending with the +Inf bucket.
+        """
+        buckets = []
+        cumulative_count = 0
+        for (bound, count) in zip(self._buckets + (float('inf'),), self._counts):
+            cumulative_count += count
+            buckets.append((bound, cumulative_count))
+        return buckets
+
+    def get_sum(self):
+        """
+        Get the sum of all values.
+
+        :return: The sum.
+        """
+        return self._sum
+
+    def get_count(self):
+        """
+        Get the number of values.
+
+        :return: The count.
+        """
+        return self._count
+
+
+class MetricsRegistry(object):
+    """
+    The metrics to serve, grouped in families by name.
+    """
+
+    # Types
+    COUNTER_TYPE = 'counter'
+    GAUGE_TYPE = 'gauge'
+    HISTOGRAM_TYPE = 'histogram'
+
+    def __init__(self):
+        """
+        Constructor.
+        """
+        self._lock = threading.Lock()
+        self._names = []
+        # (type, help, list of (labels, source)) tuples by name
+        self._families = {}
+        self._collectors = []
+
+    def add_counter(self, name, help_text, function, labels=None):
+        """
+        Add a counter, which is read when scraped.
+
+        :param name: The metric's name.
+        :param help_text: A description of the metric.
+        :param function: A parameterless function returning the count.
+        :param labels: A dictionary of labels, or None.
+        """
+        self._add(name, self.COUNTER_TYPE, help_text, function, labels)
+
+    def add_gauge(self, name, help_text, function, labels=None):
+        """
+        Add a gauge, which is read when scraped.
+
+        :param name: The metric's name.
+        :param help_text: A description of the metric.
+        :param function: A parameterless function returning the value.
+        :param labels: A dictionary of labels, or None.
+        """
+        self._add(name, self.GAUGE_TYPE, help_text, function, labels)
+
+    def add_histogram(self, name, help_text, histogram, labels=None):
+        """
+        Add a histogram.
+
+        :param name: The metric's name.
+        :param help_text: A description of the metric.
+        :param histogram: The Histogram.
+        :param labels: A dictionary of labels, or None.
+        """
+        self._add(name, self.HISTOGRAM_TYPE, help_text, histogram, labels)
+
+    def add_collector(self, collector):
+        """
+        Add a collector of metrics that aren't known up front, e.g. those of every endpoint requested so far.
+
+        :param collector: A parameterless function returning a list of (name, type, help, labels, value) tuples, where
+                          the value is a number, or a Histogram for a histogram.
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        """
+        Render all metrics in the Prometheus text format.
+
+        :return: The text.
+        """
+        lines = []
+        families = collections.OrderedDict()
+        with self._lock:
+            for name in self._names:
+                (metric_type, help_text, samples) = self._families[name]
+                families[name] = (metric_type, help_text, list(samples))
+            collectors = list(self._collectors)
+        for collector in collectors:
+            for (name, metric_type, help_text, labels, value) in collector():
+                families.setdefault(name, (metric_type, help_text, []))[2].append((labels, value))
+        for (name, (metric_type, help_text, samples)) in families.iteritems():
+            lines.append('# HELP {0} {1}'.format(name, help_text))
+            lines.append('# TYPE {0} {1}'.format(name, metric_type))
+            for (labels, source) in samples:
+                if metric_type == self.HISTOGRAM_TYPE:
+                    for (bound, count) in source.get_buckets():
+                        bucket_labels = dict(labels, le=_format_value(bound))
+                        lines.append('{0}_bucket{1} {2}'.format(name, _format_labels(bucket_labels), count))
+                    lines.append('{0}_sum{1} {2}'.format(name, _format_labels(labels), _format_value(source.get_sum())))
+                    lines.append('{0}_count{1} {2}'.format(name, _format_labels(labels), source.get_count()))
+                else:
+                    value = source() if callable(source) else source
+                    lines.append('{0}{1} {2}'.format(name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def _add(self, name, metric_type, help_text, source, labels):
+        """
+        Add a metric to its family.
+
+        :param name: The metric's name.
+        :param metric_type: The metric's type.
+        :param help_text: A description of the metric.
+        :param source: A function or Histogram.
+        :param labels: A dictionary of labels, or None.
+        """
+        with self._lock:
+            if name not in self._families:
+                self._names.append(name)
+                self._families[name] = (metric_type, help_text, [])
+            elif self._families[name][0] != metric_type:
+                raise ValueError('Metric {0} is a {1}'.format(name, self._families[name][0]))
+            self._families[name][2].append((labels or {}, source))
+
+
+def _format_labels(labels):
+    """
+    Format labels.
+
+    :param labels: A dictionary of labels.
+    :return: The labels in braces, or an empty string if there are none.
+    """
+    if not labels:
+        return ''
+    escaped = ('{0}="{1}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for (key, value) in sorted(labels.iteritems()))
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    """
+    Format a sample value.
+
+    :param value: A number, or None if unknown.
+    :return: The value as text.
+    """
+    if value is None or value != value:
+        return 'NaN'
+    elif value == float('inf'):
+        return '+Inf'
+    elif isinstance(value, bool):
+        return '1' if value else '0'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def instrument(registry, client, server_monitor, device_controllers, device_workers, device_names=None):
+    """
+    Instrument the application, and add its metrics to a registry.
+
+    :param registry: A MetricsRegistry.
+    :param client: The build server client.
+    :param server_monitor: The server monitor.
+    :param device_controllers: The controllers of the devices.
+    :param device_workers: The device workers, one per controller.
+    :param device_names: The names of the devices, one per controller; None for a device without a name.
+    """
+    cycle_durations = Histogram()
+    server_monitor.set_cycle_histogram(cycle_durations)
+    registry.add_histogram('whatsthatlight_check_duration_seconds',
+                           'The time a check of the build server took.',
+                           cycle_durations)
+    request_metrics = RequestMetrics()
+    client.set_request_hook(request_metrics)
+    registry.add_collector(request_metrics.collect)
+    registry.add_gauge('whatsthatlight_cache_hit_ratio',
+                       'The fraction of lookups of cached build information that were found.',
+                       lambda: _get_ratio(request_metrics.get_cache_counts()))
+    for (name, controller, device_worker) in zip(device_names or [None] * len(device_controllers),
+                                                 device_controllers,
+                                                 device_workers):
+        _instrument_device(registry, name or _DEFAULT_DEVICE_NAME, controller, device_worker)
+    registry.add_gauge('whatsthatlight_threads',
+                       'The number of threads.',
+                       threading.active_count)
+
+
+def _instrument_device(registry, name, controller, device_worker):
+    """
+    Instrument a device, and add its metrics to a registry.
+
+    :param registry: A MetricsRegistry.
+    :param name: The device's name.
+    :param controller: The device's controller.
+    :param device_worker: The device's worker.
+    """
+    labels = {'device': name}
+    write_durations = Histogram()
+    device_worker.set_write_histogram(write_durations)
+    registry.add_histogram('whatsthatlight_device_write_duration_seconds',
+                           'The time from a build state being queued for a device to it being written.',
+                           write_durations,
+                           labels)
+    registry.add_counter('whatsthatlight_device_write_errors_total',
+                         'The writes to a device that failed.',
+                         lambda: device_worker.get_metrics()['write_errors'],
+                         labels)
+    registry.add_gauge('whatsthatlight_device_connected',
+                       'Whether a device is connected.',
+                       controller.is_device_connected,
+                       labels)
+    for state in (devices.BaseDevice.RUNNING_STATE,
+                  devices.BaseDevice.FAILURE_STATE,
+                  devices.BaseDevice.SUCCESS_STATE,
+                  devices.BaseDevice.UNKNOWN_STATE):
+        registry.add_gauge('whatsthatlight_build_state',
+                           'The build state a device shows, as 1 for the current state and 0 for the others.',
+                           _create_state_function(controller, state),
+                           dict(labels, state=state))
+
+
+def _create_state_function(controller, state):
+    """
+    Create a function that checks whether a controller's build state is a state.
+
+    :param controller: The controller.
+    :param state: The state.
+    :return: A parameterless function returning True if the build state is the state.
+    """
+    return lambda: devices.BaseDevice.get_state(*controller.get_build_state()) == state
+
+
+def _get_ratio(counts):
+    """
+    Get the hit ratio of cache counts.
+
+    :param counts: A dictionary of hits and misses.
+    :return: The ratio, or None if nothing was looked up.
+    """
+    lookups = counts['hits'] + counts['misses']
+    return float(counts['hits']) / lookups if lookups else None
+
+
+class RequestMetrics(object):
+    """
+    The requests to the build server, aggregated by endpoint, as a client's request hook. Observing a request only
+    counts it and observes it into histograms, which are allocated the first time its endpoint is seen.
+    """
+
+    def __init__(self, latency_buckets=DEFAULT_LATENCY_BUCKETS, size_buckets=DEFAULT_SIZE_BUCKETS):
+        """
+        Constructor.
+
+        :param latency_buckets: The upper bounds of the buckets of durations, in seconds.
+        :param size_buckets: The upper bounds of the buckets of response sizes, in bytes.
+        """
+        self._latency_buckets = latency_buckets
+        self._size_buckets = size_buckets
+        self._lock = threading.Lock()
+        # _EndpointMetrics by endpoint
+        self._endpoints = {}
+        # Lists of [misses, hits] by kind
+        self._cache_counts = {}
+
+    def observe_request(self, endpoint, kind, status, nr_of_bytes, first_byte_seconds, total_seconds, decode_seconds):
+        """
+        Record a request.
+
+        :param endpoint: The resource with IDs normalised.
+        :param kind: The kind of resource, e.g. builds.
+        :param status: The HTTP status, or the client's error status if no response was received.
+        :param nr_of_bytes: The size of the response body.
+        :param first_byte_seconds: The time until the response's headers were received.
+        :param total_seconds: The time until the response's body was received.
+        :param decode_seconds: The time decoding the response took.
+        """
+        endpoint_metrics = self._endpoints.get(endpoint)
+        if endpoint_metrics is None:
+            with self._lock:
+                endpoint_metrics = self._endpoints.setdefault(endpoint, _EndpointMetrics(kind,
+                                                                                         self._latency_buckets,
+                                                                                         self._size_buckets))
+        endpoint_metrics.observe(status, nr_of_bytes, first_byte_seconds, total_seconds, decode_seconds)
+
+    def observe_cache(self, kind, hit):
+        """
+        Record a lookup of cached information.
+
+        :param kind: The kind of resource the information is requested from on a miss.
+        :param hit: True if found.
+        """
+        cache_counts = self._cache_counts.get(kind)
+        if cache_counts is None:
+            with self._lock:
+                cache_counts = self._cache_counts.setdefault(kind, [0, 0])
+        cache_counts[1 if hit else 0] += 1
+
+    def get_cache_counts(self):
+        """
+        Get the number of lookups of cached information that were found, and the number that weren't.
+
+        :return: A dictionary of hits and misses.
+        """
+        with self._lock:
+            cache_counts = self._cache_counts.values()
+        return {'hits': sum(hits for (_, hits) in cache_counts),
+                'misses': sum(misses for (misses, _) in cache_counts)}
+
+    def collect(self):
+        """
+        Collect the metrics of every endpoint requested so far, for a MetricsRegistry.
+
+        :return: A list of (name, type, help, labels, value) tuples.
+        """
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+            cache_counts = sorted(self._cache_counts.items())
+        samples = []
+        for (endpoint, endpoint_metrics) in endpoints:
+            labels = {'endpoint': endpoint, 'kind': endpoint_metrics.kind}
+            for (status, count) in sorted(endpoint_metrics.statuses.items()):
+                samples.append(('whatsthatlight_requests_total',
+                                MetricsRegistry.COUNTER_TYPE,
+                                'The requests to the build server, by endpoint and HTTP status.',
+                                dict(labels, status=status),
+                                count))
+            for (name, help_text, histogram) in (
+                    ('whatsthatlight_request_duration_seconds',
+                     'The time until the response to a request to the build server was received.',
+                     endpoint_metrics.total_seconds),
+                    ('whatsthatlight_request_first_byte_seconds',
+                     'The time until the headers of a response were received, including connecting.',
+                     endpoint_metrics.first_byte_seconds),
+                    ('whatsthatlight_response_decode_seconds',
+                     'The time decoding the JSON of a response took.',
+                     endpoint_metrics.decode_seconds),
+                    ('whatsthatlight_response_size_bytes',
+                     'The size of the body of a response.',
+                     endpoint_metrics.nr_of_bytes)):
+                samples.append((name, MetricsRegistry.HISTOGRAM_TYPE, help_text, labels, histogram))
+        for (kind, (misses, hits)) in cache_counts:
+            samples.append(('whatsthatlight_cache_hits_total',
+                            MetricsRegistry.COUNTER_TYPE,
+                            'The lookups of cached build information that were found, by the kind of resource saved.',
+                            {'kind': kind},
+                            hits))
+            samples.append(('whatsthatlight_cache_misses_total',
+                            MetricsRegistry.COUNTER_TYPE,
+                            'The lookups of cached build information that had to be requested, by kind of resource.',
+                            {'kind': kind},
+                            misses))
+        return samples
+
+
+class _EndpointMetrics(object):
+    """
+    The requests to one endpoint.
+    """
+
+    def __init__(self, kind, latency_buckets, size_buckets):
+        """
+        Constructor.
+
+        :param kind: The endpoint's kind of resource.
+        :param latency_buckets: The upper bounds of the buckets of durations, in seconds.
+        :param size_buckets: The upper bounds of the buckets of response sizes, in bytes.
+        """
+        self.kind = kind
+        # Request counts by HTTP status
+        self.statuses = {}
+        self.first_byte_seconds = Histogram(latency_buckets)
+        self.total_seconds = Histogram(latency_buckets)
+        self.decode_seconds = Histogram(latency_buckets)
+        self.nr_of_bytes = Histogram(size_buckets)
+
+    def observe(self, status, nr_of_bytes, first_byte_seconds, total_seconds, decode_seconds):
+        """
+        Record a request.
+
+        :param status: The HTTP status, or the client's error status if no response was received.
+        :param nr_of_bytes: The size of the response body.
+        :param first_byte_seconds: The time until the response's headers were received.
+        :param total_seconds: The time until the response's body was received.
+        :param decode_seconds: The time decoding the response took.
+        """
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.first_byte_seconds.observe(first_byte_seconds)
+        self.total_seconds.observe(total_seconds)
+        self.decode_seconds.observe(decode_seconds)
+        self.nr_of_bytes.observe(nr_of_bytes)
+
+
+class MetricsServer(object):
+    """
+    Serves metrics over HTTP, on a daemon thread.
+    """
+
+    def __init__(self, registry, port, host=''):
+        """
+        Constructor.
+
+        :param registry: The MetricsRegistry to serve.
+        :param port: The port to listen on; 0 for any free port.
+        :param host: The address to listen on; all addresses by default.
+        """
+        self._logger = logging.getLogger()
+        self._registry = registry
+        self._address = (host, port)
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """
+        Start serving.
+        """
+        self._logger.info('Metrics server starting')
+        # Imported when started, as it is slow to import and metrics are optional
+        import BaseHTTPServer
+        registry = self._registry
+        logger = self._logger
+
+        class _MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            """
+            Serves the metrics.
+            """
+
+            # noinspection PyPep8Naming
+            def do_GET(self):  # pylint: disable=invalid-name
+                """
+                Serve the metrics.
+                """
+                if self.path.split('?')[0] != _METRICS_PATH:
+                    self.send_error(404)
+                    return
+                body = registry.render()
+                self.send_response(200)
+                self.send_header('Content-Type', _CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, log_format, *args):
+                """
+                Log requests at debug level.
+                """
+                logger.debug('Metrics request from %s: %s', self.client_address[0], log_format % args)
+
+        self._server = BaseHTTPServer.HTTPServer(self._address, _MetricsRequestHandler)
+        self._thread = threading.Thread(target=self._server.serve_forever, name=self.__class__.__name__)
+        self._thread.daemon = True
+        self._thread.start()
+        self._logger.info('Metrics server started on port %s', self.get_port())
+
+    def stop(self):
+        """
+        Stop serving.
+        """
+        self._logger.info('Metrics server stopping')
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._logger.info('Metrics server stopped')
+
+    def get_port(self):
+        """
+        Get the port being listened on.
+
+        :return: The port.
+        """
+        return self._server.server_address[1]
@@ -17,30 +17,120 @@ Various monitors.
 """
 
 # System imports
+import abc
 import logging
+import os
+import select
+import socket
 import threading
+import time
 
+# Local imports
+from whatsthatlight import tracing
 
-class DeviceMonitor(object):
+
+class BaseDeviceMonitor(object):
     """
-    A simple polling device monitor, to have something that works across commonly platforms.
+    An abstract device monitor, which notifies handlers when a device gets plugged in or out.
     """
 
-    def __init__(self, device, polling_interval=1):
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, device, probe_by_enumeration=False):
         """
         Constructor.
 
         :param device: A Device instance.
-        :param polling_interval: The polling interval in seconds, as a float.
+        :param probe_by_enumeration: Check for the device's presence by enumeration, instead of by opening it.
         """
         self._logger = logging.getLogger()
         self._device = device
+        self._probe_by_enumeration = probe_by_enumeration
         self._connected = False
         self._running = False
         self._thread = None
         self._added_handler = None
         self._removed_handler = None
+
+    @abc.abstractmethod  # pragma: no cover
+    def start(self):
+        """
+        Start monitoring.
+        """
+
+    @abc.abstractmethod  # pragma: no cover
+    def stop(self):
+        """
+        Stop monitoring.
+        """
+
+    def set_added_handler(self, handler):
+        """
+        Set a handler for when a device gets plugged in.
+
+        :param handler: Parameterless function.
+        """
+        self._added_handler = handler
+
+    def set_removed_handler(self, handler):
+        """
+        Set a handler for when a device gets plugged out.
+
+        :param handler: Parameterless function.
+        """
+        self._removed_handler = handler
+
+    def _probe(self):
+        """
+        Check whether the device is present.
+
+        :return: True if the device is present.
+        """
+        if self._probe_by_enumeration:
+            # This never opens the device, so it can't contend with writes
+            return self._device.probe()
+        try:
+            if not self._device.is_open():
+                self._device.open()
+                self._device.close()
+            return True
+        except IOError:
+            return False
+
+    def _update(self, present):
+        """
+        Update the connection state and notify the handlers of any change.
+
+        :param present: True if the device is present.
+        """
+        if self._connected and not present and self._removed_handler:
+            # The device was plugged out
+            self._connected = False
+            self._removed_handler()
+        elif not self._connected and present and self._added_handler:
+            # The device was plugged in
+            self._connected = True
+            self._added_handler()
+
+
+class DeviceMonitor(BaseDeviceMonitor):
+    """
+    A simple polling device monitor, to have something that works across commonly platforms.
+    """
+
+    def __init__(self, device, polling_interval=1, probe_by_enumeration=False, max_polling_interval=None):
+        """
+        Constructor.
+
+        :param device: A Device instance.
+        :param polling_interval: The polling interval in seconds, as a float.
+        :param probe_by_enumeration: Check for the device's presence by enumeration, instead of by opening it.
+        :param max_polling_interval: While the device is absent, the polling interval is doubled after every poll, up
+                                     to this interval in seconds. Defaults to the polling interval (no back-off).
+        """
+        super(DeviceMonitor, self).__init__(device, probe_by_enumeration)
         self._polling_interval = polling_interval
+        self._max_polling_interval = max(polling_interval, max_polling_interval or polling_interval)
         self._polling_event = threading.Event()
 
     def start(self):
@@ -48,6 +138,9 @@ class DeviceMonitor(object):
         Start to poll.
         """
         self._logger.info('Device monitor starting')
+        # Set before the thread starts, so that an immediate stop can't be overridden by the thread
+        self._polling_event.clear()
+        self._running = True
         self._thread = threading.Thread(target=self._run, name=self.__class__.__name__)
         self._thread.start()
         self._logger.info('Device monitor started')
@@ -62,47 +155,239 @@ class DeviceMonitor(object):
         self._thread.join()
         self._logger.info('Device monitor stopped')
 
-    def set_added_handler(self, handler):
+    def _run(self):
         """
-        Set a handler for when a device gets plugged in.
+        Polling thread.
+        """
+        polling_interval = self._polling_interval
+        while self._running:
+            self._logger.debug('Polling for device')
+            present = self._probe()
+            self._update(present)
+            if present:
+                # Check again soon, so that a removal (or a brief glitch) is noticed quickly
+                polling_interval = self._polling_interval
+            else:
+                polling_interval = min(2 * polling_interval, self._max_polling_interval)
+            self._polling_event.wait(polling_interval)
 
-        :param handler: Parameterless function.
+
+class HotplugDeviceMonitor(BaseDeviceMonitor):
+    """
+    An event-driven device monitor, which only wakes up when the kernel reports that a matching device was plugged in
+    or out. It is only available on Linux; use the polling DeviceMonitor elsewhere.
+    """
+
+    # Kernel uevent subsystems that can be matched
+    HIDRAW_SUBSYSTEM = 'hidraw'
+    USB_SUBSYSTEM = 'usb'
+
+    _ADD_ACTION = 'add'
+    _REMOVE_ACTION = 'remove'
+    _USB_DEVICE_TYPE = 'usb_device'
+    # The device node may only become accessible shortly after the event (e.g. once udev has set its permissions)
+    _SETTLE_ATTEMPTS = 10
+    _SETTLE_INTERVAL = 0.1
+
+    def __init__(self, device, event_source=None, subsystem=HIDRAW_SUBSYSTEM, probe_by_enumeration=False):
         """
-        self._added_handler = handler
+        Constructor.
 
-    def set_removed_handler(self, handler):
+        :param device: A Device instance.
+        :param event_source: A source of uevents, with the same interface as NetlinkEventSource. Defaults to a
+                             NetlinkEventSource.
+        :param subsystem: The subsystem to match events on: hidraw (for the hidraw backend of hidapi) or usb (for the
+                          libusb backend).
+        :param probe_by_enumeration: Check for the device's presence by enumeration, instead of by opening it.
         """
-        Set a handler for when a device gets plugged out.
+        super(HotplugDeviceMonitor, self).__init__(device, probe_by_enumeration)
+        self._event_source = event_source if event_source else NetlinkEventSource()
+        self._subsystem = subsystem
+        # A uevent's PRODUCT value has the format vid/pid/bcdDevice, in hex without leading zeroes
+        self._product_prefix = '{0:x}/{1:x}/'.format(device.get_vendor_id(), device.get_product_id())
+        # A hidraw node's path includes the HID ID, which has the format bus:VID:PID.instance
+        self._hid_id_infix = ':{0:04X}:{1:04X}.'.format(device.get_vendor_id(), device.get_product_id())
+        self._settle_event = threading.Event()
 
-        :param handler: Parameterless function.
+    def start(self):
         """
-        self._removed_handler = handler
+        Start listening for events.
+        """
+        self._logger.info('Hotplug device monitor starting')
+        # Open the source before the thread starts, so that an error is raised here and no event can be missed between
+        # the initial probe and the first wait
+        self._event_source.open()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=self.__class__.__name__)
+        self._thread.start()
+        self._logger.info('Hotplug device monitor started')
+
+    def stop(self):
+        """
+        Stop listening for events.
+        """
+        self._logger.info('Hotplug device monitor stopping')
+        self._running = False
+        self._settle_event.set()
+        self._event_source.interrupt()
+        self._thread.join()
+        self._event_source.close()
+        self._logger.info('Hotplug device monitor stopped')
+
+    def _matches(self, event):
+        """
+        Check whether a uevent concerns the monitored device.
+
+        :param event: A dictionary of uevent properties.
+        :return: True if the event is for the device.
+        """
+        if event.get('SUBSYSTEM') != self._subsystem:
+            return False
+        if self._subsystem == self.USB_SUBSYSTEM:
+            return (event.get('DEVTYPE') == self._USB_DEVICE_TYPE and
+                    event.get('PRODUCT', '').lower().startswith(self._product_prefix))
+        return self._hid_id_infix in event.get('DEVPATH', '').upper()
+
+    def _settle(self):
+        """
+        Wait for an added device to become accessible.
+
+        :return: True if the device could be accessed.
+        """
+        for _ in range(self._SETTLE_ATTEMPTS):
+            if self._probe():
+                return True
+            self._settle_event.wait(self._SETTLE_INTERVAL)
+            if not self._running:
+                break
+        self._logger.warning('Device was added, but could not be accessed')
+        return False
 
     def _run(self):
         """
-        Polling thread.
+        Event thread.
         """
-        self._polling_event.clear()
-        self._running = True
+        # The device may have been plugged in before we started
+        self._update(self._probe())
         while self._running:
-            try:
-                self._logger.debug('Polling for device')
-                if not self._device.is_open():
-                    self._device.open()
-                    self._device.close()
-                could_open = True
-            except IOError:
-                could_open = False
-            if self._connected and not could_open and self._removed_handler:
-                # The device was plugged out
-                self._connected = False
-                self._removed_handler()
-            elif not self._connected and could_open and self._added_handler:
-                # The device was plugged in
-                self._connected = True
-                self._added_handler()
-            # else:
-            self._polling_event.wait(self._polling_interval)
+            event = self._event_source.wait()
+            if event is None or not self._matches(event):
+                continue
+            action = event.get('ACTION')
+            self._logger.debug('Device event: %s %s', action, event.get('DEVPATH'))
+            if action == self._ADD_ACTION:
+                self._update(self._settle())
+            elif action == self._REMOVE_ACTION:
+                self._update(False)
+
+
+class NetlinkEventSource(object):
+    """
+    A source of kernel uevents, read from a netlink socket (Linux only).
+    """
+
+    _NETLINK_KOBJECT_UEVENT = 15
+    _KERNEL_GROUP = 1
+    _BUFFER_SIZE = 16384
+
+    def __init__(self):
+        """
+        Constructor.
+        """
+        self._socket = None
+        self._interrupt_reader = None
+        self._interrupt_writer = None
+
+    @staticmethod
+    def is_supported():
+        """
+        Check whether netlink uevents are supported on this platform.
+
+        :return: True if supported.
+        """
+        if not hasattr(socket, 'AF_NETLINK'):
+            return False
+        try:
+            socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NetlinkEventSource._NETLINK_KOBJECT_UEVENT).close()
+            return True
+        except socket.error:
+            return False
+
+    def open(self):
+        """
+        Open the netlink socket.
+        """
+        self._socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, self._NETLINK_KOBJECT_UEVENT)
+        # A port ID of 0 lets the kernel assign one
+        self._socket.bind((0, self._KERNEL_GROUP))
+        (self._interrupt_reader, self._interrupt_writer) = os.pipe()
+
+    def wait(self):
+        """
+        Block until an event is received or the wait is interrupted.
+
+        :return: A dictionary of the event's properties, or None if interrupted or the message isn't a uevent.
+        """
+        (readable, _, _) = select.select([self._socket, self._interrupt_reader], [], [])
+        if self._interrupt_reader in readable:
+            os.read(self._interrupt_reader, 1)
+            return None
+        return self.parse(self._socket.recv(self._BUFFER_SIZE))
+
+    def interrupt(self):
+        """
+        Interrupt a blocking wait.
+        """
+        os.write(self._interrupt_writer, '\0')
+
+    def close(self):
+        """
+        Close the netlink socket.
+        """
+        self._socket.close()
+        os.close(self._interrupt_reader)
+        os.close(self._interrupt_writer)
+
+    @staticmethod
+    def parse(data):
+        """
+        Parse a kernel uevent message.
+
+        :param data: The raw message, in the format action@devpath, followed by null-separated key=value pairs.
+        :return: A dictionary of the event's properties, or None if the message isn't a kernel uevent.
+        """
+        fields = data.split('\0')
+        if '@' not in fields[0]:
+            return None
+        event = {}
+        for field in fields[1:]:
+            (key, separator, value) = field.partition('=')
+            if separator:
+                event[key] = value
+        return event
+
+
+def create_device_monitor(device, backend='polling', polling_interval=1, probe_by_enumeration=False, max_polling_interval=None,
+                          hotplug_subsystem=HotplugDeviceMonitor.USB_SUBSYSTEM):
+    """
+    Create a device monitor.
+
+    :param device: A Device instance.
+    :param backend: One of hotplug, polling or auto (hotplug if supported, otherwise polling).
+    :param polling_interval: The polling interval in seconds, for the polling monitor.
+    :param probe_by_enumeration: Check for the device's presence by enumeration, instead of by opening it.
+    :param max_polling_interval: The maximum back-off interval in seconds while the device is absent, for the polling
+                                 monitor.
+    :param hotplug_subsystem: The subsystem whose events the hotplug monitor watches: usb, whose events are raised for
+                              any backend, or hidraw, whose node disappears when a libusb backend claims the device.
+    :return: A device monitor.
+    """
+    if backend == 'hotplug' or (backend == 'auto' and NetlinkEventSource.is_supported()):
+        return HotplugDeviceMonitor(device=device, subsystem=hotplug_subsystem, probe_by_enumeration=probe_by_enumeration)
+    return DeviceMonitor(device=device,
+                         polling_interval=polling_interval,
+                         probe_by_enumeration=probe_by_enumeration,
+                         max_polling_interval=max_polling_interval)
 
 
 class ServerMonitor(object):
@@ -122,6 +407,11 @@ class ServerMonitor(object):
         self._polling_interval = polling_interval
         self._polling_event = threading.Event()
         self._handler = None
+        self._progress_handler = None
+        self._index_handler = None
+        self._trace_sink = None
+        self._cycle_histogram = None
+        self._cycle_profiler = None
         self._running = False
         self._thread = None
         self._logger = logging.getLogger()
@@ -131,7 +421,9 @@ class ServerMonitor(object):
         Start the monitor.
         """
         self._logger.info('Server monitor starting')
-        self._client.connect()
+        # Set before the thread starts, so that an immediate stop can't be overridden by the thread
+        self._polling_event.clear()
+        self._running = True
         self._thread = threading.Thread(target=self._run, name=self.__class__.__name__)
         self._thread.start()
         self._logger.info('Server monitor started')
@@ -157,22 +449,162 @@ class ServerMonitor(object):
         """
         self._handler = handler
 
+    def set_progress_handler(self, handler):
+        """
+        Set a handler for the progress of running builds, called after every check.
+
+        :param handler: A function which accepts the parameter (progress), where progress is a fraction. A value of
+                        None indicates an unknown progress or that no builds are running.
+        """
+        self._progress_handler = handler
+
+    def set_index_handler(self, handler):
+        """
+        Set a handler for the build state of all users, instead of only the client's user. When set, the other
+        handlers are not called.
+
+        :param handler: A function which accepts the parameter (index), where index is a BuildIndex. A value of None
+                        indicates an unknown state.
+        """
+        self._index_handler = handler
+
+    def set_trace_sink(self, trace_sink):
+        """
+        Set a sink to write a trace of every check to.
+
+        :param trace_sink: A TraceSink, or None to stop tracing.
+        """
+        self._trace_sink = trace_sink
+
+    def set_cycle_histogram(self, histogram):
+        """
+        Set a histogram to observe the duration of every check in.
+
+        :param histogram: A metrics Histogram, or None to stop observing.
+        """
+        self._cycle_histogram = histogram
+
+    def set_cycle_profiler(self, cycle_profiler):
+        """
+        Set a profiler to profile checks with, on request.
+
+        :param cycle_profiler: A CycleProfiler, or None.
+        """
+        self._cycle_profiler = cycle_profiler
+
+    def set_polling_interval(self, polling_interval):
+        """
+        Change the interval between checks, from the next check.
+
+        :param polling_interval: The interval, in seconds, between checks.
+        """
+        self._polling_interval = polling_interval
+
     def _run(self):
         """
-        Polling thread.
+        Polling thread. The client connects here, so that the caller isn't held up by it. A failed connection is
+        retried at the polling interval, and the state is unknown until it succeeds.
         """
-        self._polling_event.clear()
-        self._running = True
+        connected = False
         while self._running:
-            if self._handler:
+            if not connected:
+                # noinspection PyBroadException
+                # pylint: disable=broad-except
+                try:
+                    self._client.connect()
+                    connected = True
+                except Exception, error:
+                    self._logger.error('Could not connect to the build server: %s', error)
+                    if self._index_handler:
+                        self._call_handler(self._index_handler, None)
+                    elif self._handler:
+                        self._call_handler(self._handler, None, None)
+                    self._polling_event.wait(self._polling_interval)
+                    continue
+                # pylint: enable=broad-except
+            cycle_profiler = self._cycle_profiler
+            if cycle_profiler is not None:
+                cycle_profiler.begin_cycle()
+            started_at = time.time()
+            trace_sink = self._trace_sink
+            trace = tracing.CycleTrace() if trace_sink else None
+            self._client.set_trace(trace)
+            if self._index_handler:
+                index = None
+                # noinspection PyBroadException
+                # pylint: disable=broad-except
+                try:
+                    index = self._client.create_index()
+                    if trace:
+                        trace.set_verdict(index.any_builds_running(), index.any_build_failures())
+                except Exception, error:
+                    self._logger.error(error)
+                    if trace:
+                        trace.set_error(error)
+                # pylint: enable=broad-except
+                self._call_handler(self._index_handler, index)
+            elif self._handler:
+                progress = None
                 # noinspection PyBroadException
                 # pylint: disable=broad-except
                 try:
                     any_builds_running = self._client.any_builds_running()
                     any_build_failures = self._client.any_build_failures()
-                    self._handler(any_builds_running, any_build_failures)
+                    if trace:
+                        trace.set_verdict(any_builds_running, any_build_failures)
                 except Exception, error:
                     self._logger.error(error)
-                    self._handler(None, None)
+                    if trace:
+                        trace.set_error(error)
+                    (any_builds_running, any_build_failures) = (None, None)
                 # pylint: enable=broad-except
+                self._call_handler(self._handler, any_builds_running, any_build_failures)
+                if self._progress_handler:
+                    if any_builds_running is not None:
+                        # noinspection PyBroadException
+                        # pylint: disable=broad-except
+                        try:
+                            progress = self._client.get_running_progress()
+                        except Exception, error:
+                            self._logger.error(error)
+                        # pylint: enable=broad-except
+                    self._call_handler(self._progress_handler, progress)
+            if trace:
+                trace.finish()
+                self._call_observer(trace_sink.write, trace)
+            cycle_histogram = self._cycle_histogram
+            if cycle_histogram is not None:
+                self._call_observer(cycle_histogram.observe, time.time() - started_at)
+            if cycle_profiler is not None:
+                self._call_observer(cycle_profiler.end_cycle)
             self._polling_event.wait(self._polling_interval)
+
+    def _call_handler(self, handler, *args):
+        """
+        Call a handler, which must not stop the monitor on an error.
+
+        :param handler: The handler.
+        :param args: The handler's arguments.
+        """
+        # noinspection PyBroadException
+        # pylint: disable=broad-except
+        try:
+            handler(*args)
+        except Exception, error:
+            self._logger.error('Could not handle the build state: %s', error)
+        # pylint: enable=broad-except
+
+    def _call_observer(self, function, *args):
+        """
+        Call a function that observes a check, e.g. to trace or profile it, which must not stop the monitor on an error.
+
+        :param function: The function.
+        :param args: The function's arguments.
+        """
+        # noinspection PyBroadException
+        # pylint: disable=broad-except
+        try:
+            function(*args)
+        except Exception, error:
+            self._logger.error('Could not observe the check: %s', error)
+        # pylint: enable=broad-except
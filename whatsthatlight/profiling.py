@@ -0,0 +1,284 @@
+# Copyright 2013 Pieter Rautenbach
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Profiling tools.
+"""
+
+# System imports
+import __builtin__
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+# Constants
+STARTUP_PROFILE_OPTION = '--profile-startup'
+DEFAULT_NR_OF_PROFILED_CYCLES = 10
+_DEFAULT_SUMMARY_LIMIT = 30
+_FILE_NAME_TEMPLATE = 'build_light-{0}-{1}{2}'
+
+
+class StartupProfiler(object):
+    """
+    Times the phases of startup, and every module imported while installed, like Python 3's -X importtime: Each import
+    is reported with its own time and its cumulative time, including the modules it imported in turn.
+    """
+
+    def __init__(self, clock=time.time):
+        """
+        Constructor.
+
+        :param clock: A function returning the current time in seconds.
+        """
+        self._clock = clock
+        self._started_at = clock()
+        self._lock = threading.Lock()
+        # Tuples of (depth, name, own seconds, cumulative seconds), in the order imports complete
+        self._imports = []
+        # Tuples of (name, seconds since the profiler was created, seconds)
+        self._phases = []
+        self._local = threading.local()
+        self._original_import = None
+
+    def install(self):
+        """
+        Start timing imports.
+        """
+        self._original_import = __builtin__.__import__
+        __builtin__.__import__ = self._import
+
+    def uninstall(self):
+        """
+        Stop timing imports. Imports already being timed, e.g. on other threads, complete as usual.
+        """
+        if self._original_import:
+            __builtin__.__import__ = self._original_import
+
+    def mark(self, name):
+        """
+        Mark the end of a phase of startup, which began at the end of the previous phase, or when the profiler was
+        created.
+
+        :param name: The phase's name.
+        """
+        with self._lock:
+            started_at = self._phases[-1][1] + self._phases[-1][2] if self._phases else 0.0
+            self._phases.append((name, started_at, self._clock() - self._started_at - started_at))
+
+    def get_imports(self):
+        """
+        Get the timed imports, of modules that weren't imported yet.
+
+        :return: A list of (depth, name, own seconds, cumulative seconds) tuples, in the order the imports completed.
+        """
+        with self._lock:
+            return list(self._imports)
+
+    def get_phases(self):
+        """
+        Get the timed phases.
+
+        :return: A list of (name, seconds since the profiler was created, seconds) tuples.
+        """
+        with self._lock:
+            return list(self._phases)
+
+    def report(self, stream=None):
+        """
+        Print the phases, followed by the imports.
+
+        :param stream: The stream to print to. Defaults to stderr.
+        """
+        stream = stream or sys.stderr
+        stream.write('phase time: start [us] | duration [us] | phase\n')
+        for (name, offset, seconds) in self.get_phases():
+            stream.write('phase time: {0:>10} | {1:>13} | {2}\n'.format(int(offset * 1e6), int(seconds * 1e6), name))
+        stream.write('import time: self [us] | cumulative | imported package\n')
+        for (depth, name, own_seconds, cumulative_seconds) in self.get_imports():
+            stream.write('import time: {0:>9} | {1:>10} | {2}{3}\n'.format(int(own_seconds * 1e6),
+                                                                           int(cumulative_seconds * 1e6),
+                                                                           '  ' * depth,
+                                                                           name))
+
+    def _import(self, name, *args, **kwargs):
+        """
+        Time an import, as a replacement of the built-in __import__. Imports of modules that were imported before are
+        not recorded, but count towards the cumulative time of the import that made them.
+
+        :param name: The module's name.
+        :param args: The built-in's other positional arguments.
+        :param kwargs: The built-in's keyword arguments.
+        :return: The module.
+        """
+        # Every thread has its own stack of the time spent in the nested imports of the imports it is making
+        stack = self._local.__dict__.setdefault('stack', [])
+        nr_of_modules = _count_modules()
+        stack.append(0.0)
+        started_at = self._clock()
+        try:
+            return self._original_import(name, *args, **kwargs)
+        finally:
+            cumulative_seconds = self._clock() - started_at
+            nested_seconds = stack.pop()
+            if stack:
+                stack[-1] += cumulative_seconds
+            if _count_modules() > nr_of_modules:
+                # Submodules imported from a package are named after it
+                fromlist = args[2] if len(args) > 2 else kwargs.get('fromlist')
+                if fromlist:
+                    name = '{0} ({1})'.format(name, ', '.join(fromlist))
+                with self._lock:
+                    self._imports.append((len(stack), name, cumulative_seconds - nested_seconds, cumulative_seconds))
+
+
+def _count_modules():
+    """
+    Count the imported modules, without the placeholders Python 2 keeps for failed implicit relative imports.
+
+    :return: The number of modules.
+    """
+    return sum(1 for module in sys.modules.values() if module is not None)
+
+
+class CycleProfiler(object):
+    """
+    Profiles the next checks of the build server with cProfile, on request, e.g. from a signal handler, without a
+    restart. Only the thread checking the server is profiled. Once the checks are done, the statistics are written to
+    a .pstats file, to load with pstats, along with a summary of the functions that took the most time.
+    """
+
+    def __init__(self, directory, summary_limit=_DEFAULT_SUMMARY_LIMIT):
+        """
+        Constructor.
+
+        :param directory: The directory to write the statistics and summary to.
+        :param summary_limit: The number of functions in the summary.
+        """
+        self._logger = logging.getLogger()
+        self._directory = directory
+        self._summary_limit = summary_limit
+        self._lock = threading.Lock()
+        self._nr_of_requested_cycles = 0
+        self._nr_of_profiled_cycles = 0
+        self._profile = None
+
+    def request(self, nr_of_cycles=DEFAULT_NR_OF_PROFILED_CYCLES):
+        """
+        Profile the next checks. A request while checks are being profiled is ignored.
+
+        :param nr_of_cycles: The number of checks to profile.
+        :return: True if requested, or False if checks are already being profiled.
+        """
+        with self._lock:
+            if self._nr_of_requested_cycles:
+                return False
+            self._nr_of_requested_cycles = nr_of_cycles
+            return True
+
+    def begin_cycle(self):
+        """
+        Start profiling a check, if requested. Called on the thread that checks the server, before every check.
+        """
+        # Checked without the lock first, as nothing is requested nearly all the time
+        if not self._nr_of_requested_cycles:
+            return
+        with self._lock:
+            if not self._nr_of_requested_cycles:
+                return
+            if self._profile is None:
+                import cProfile
+                self._profile = cProfile.Profile()
+            profile = self._profile
+        profile.enable()
+
+    def end_cycle(self):
+        """
+        Stop profiling a check, and write the statistics once the requested checks are done. Called on the thread that
+        checks the server, after every check.
+
+        :return: A tuple of the paths of the statistics and the summary, if written, otherwise None.
+        """
+        profile = self._profile
+        if profile is None:
+            return None
+        profile.disable()
+        with self._lock:
+            self._nr_of_profiled_cycles += 1
+            if self._nr_of_profiled_cycles < self._nr_of_requested_cycles:
+                return None
+            nr_of_cycles = self._nr_of_profiled_cycles
+            self._profile = None
+            self._nr_of_requested_cycles = 0
+            self._nr_of_profiled_cycles = 0
+        return self._write(profile, nr_of_cycles)
+
+    def _write(self, profile, nr_of_cycles):
+        """
+        Write the statistics of a profile, and a summary of the functions that took the most time.
+
+        :param profile: The profile.
+        :param nr_of_cycles: The number of checks profiled.
+        :return: A tuple of the paths of the statistics and the summary, or None if they couldn't be written.
+        """
+        import pstats
+        stats_path = _create_path(self._directory, 'profile', '.pstats')
+        summary_path = _create_path(self._directory, 'profile', '.txt')
+        # Written on the thread that checks the server, which must survive e.g. a missing directory
+        try:
+            profile.dump_stats(stats_path)
+            with open(summary_path, 'w') as summary_file:
+                summary_file.write('{0} checks of the build server, by cumulative time\n'.format(nr_of_cycles))
+                stats = pstats.Stats(profile, stream=summary_file)
+                stats.sort_stats('cumulative').print_stats(self._summary_limit)
+        except (IOError, OSError), error:
+            self._logger.error('Could not write the profile of %s checks: %s', nr_of_cycles, error)
+            return None
+        self._logger.info('Profile of %s checks written to %s, with a summary in %s',
+                          nr_of_cycles, stats_path, summary_path)
+        return stats_path, summary_path
+
+
+def dump_thread_stacks(directory):
+    """
+    Write the stack of every thread to a file, e.g. to find where a thread hangs.
+
+    :param directory: The directory to write the file to.
+    :return: The path of the file.
+    """
+    path = _create_path(directory, 'stacks', '.txt')
+    names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+    # pylint: disable=protected-access
+    frames = sys._current_frames()
+    # pylint: enable=protected-access
+    with open(path, 'w') as stacks_file:
+        for (ident, frame) in frames.items():
+            stacks_file.write('Thread {0} ({1}):\n'.format(names.get(ident, 'unknown'), ident))
+            stacks_file.write(''.join(traceback.format_stack(frame)))
+            stacks_file.write('\n')
+    return path
+
+
+def _create_path(directory, kind, extension):
+    """
+    Create the path of a file to write diagnostics to, named after the time.
+
+    :param directory: The directory.
+    :param kind: The kind of diagnostics, e.g. profile.
+    :param extension: The file's extension.
+    :return: The path.
+    """
+    return os.path.join(directory, _FILE_NAME_TEMPLATE.format(kind, time.strftime('%Y%m%d-%H%M%S'), extension))
@@ -0,0 +1,181 @@
+# Copyright 2013 Pieter Rautenbach
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Routing rules, which select the builds a light watches.
+"""
+
+# System imports
+import fnmatch
+import re
+
+
+class RoutingRules(object):
+    """
+    Include and exclude rules for builds, by project ID, build type ID (which may be a glob) or build tag. Each rule has
+    the format kind:pattern, e.g. project:Backend, build_type:Backend_*, tag:release.
+
+    A build is routed if it matches no exclude rule and, if there are include rules, matches any of them. The rules are
+    compiled to sets and a single regular expression, and decisions on build types are cached, so that a check costs a
+    lookup once a build type was seen.
+    """
+
+    # Kinds
+    PROJECT_KIND = 'project'
+    BUILD_TYPE_KIND = 'build_type'
+    TAG_KIND = 'tag'
+
+    # Configuration keys
+    _INCLUDE_KEY = 'include'
+    _EXCLUDE_KEY = 'exclude'
+
+    def __init__(self, include=(), exclude=()):
+        """
+        Constructor.
+
+        :param include: A list of rules, of which a build must match any. If empty, all builds are included.
+        :param exclude: A list of rules, of which a build must match none.
+        """
+        self._include = _CompiledRules(include)
+        self._exclude = _CompiledRules(exclude)
+        self._build_type_decisions = {}
+
+    @classmethod
+    def create(cls, rules):
+        """
+        Create routing rules from configuration.
+
+        :param rules: A dictionary with include and exclude lists of rules, or None.
+        :return: The routing rules, or None if there are no rules.
+        """
+        if not rules:
+            return None
+        unknown_keys = set(rules) - set([cls._INCLUDE_KEY, cls._EXCLUDE_KEY])
+        if unknown_keys:
+            raise ValueError('Unsupported routing keys: {0}'.format(', '.join(sorted(unknown_keys))))
+        return cls(rules.get(cls._INCLUDE_KEY, ()), rules.get(cls._EXCLUDE_KEY, ()))
+
+    def matches_build_type(self, build_type_id, project_id=None):
+        """
+        Check whether builds of a build type may be routed, to prune build types before requesting their builds. Tags
+        are only known per build, so a build type is kept if an include rule on tags could still match its builds.
+
+        :param build_type_id: The build type's ID.
+        :param project_id: The ID of the build type's project, if known.
+        :return: False if no build of the build type can be routed.
+        """
+        key = (build_type_id, project_id)
+        decision = self._build_type_decisions.get(key)
+        if decision is None:
+            decision = (not self._exclude.matches_build_type(build_type_id, project_id) and
+                        (not self._include.has_build_type_rules() or
+                         self._include.has_tag_rules() or
+                         self._include.matches_build_type(build_type_id, project_id)))
+            self._build_type_decisions[key] = decision
+        return decision
+
+    def matches_build(self, build_type_id, project_id=None, tags=()):
+        """
+        Check whether a build is routed.
+
+        :param build_type_id: The ID of the build's build type.
+        :param project_id: The ID of the build's project, if known.
+        :param tags: The build's tags.
+        :return: True if routed.
+        """
+        if not self.matches_build_type(build_type_id, project_id) or self._exclude.matches_tags(tags):
+            return False
+        if self._include.is_empty():
+            return True
+        return self._include.matches_build_type(build_type_id, project_id) or self._include.matches_tags(tags)
+
+
+class _CompiledRules(object):
+    """
+    A list of rules, compiled for fast matching: Sets for project IDs, build type IDs and tags, and a single regular
+    expression for build type globs.
+    """
+
+    def __init__(self, rules):
+        """
+        Constructor.
+
+        :param rules: A list of rules, each with the format kind:pattern.
+        """
+        self._project_ids = set()
+        self._build_type_ids = set()
+        self._tags = set()
+        build_type_globs = []
+        for rule in rules:
+            (kind, _, pattern) = rule.partition(':')
+            if not pattern:
+                raise ValueError('Invalid routing rule: {0}'.format(rule))
+            if kind == RoutingRules.PROJECT_KIND:
+                self._project_ids.add(pattern)
+            elif kind == RoutingRules.BUILD_TYPE_KIND:
+                if any(character in pattern for character in '*?['):
+                    build_type_globs.append(pattern)
+                else:
+                    self._build_type_ids.add(pattern)
+            elif kind == RoutingRules.TAG_KIND:
+                self._tags.add(pattern)
+            else:
+                raise ValueError('Unsupported routing rule kind: {0}'.format(kind))
+        self._build_type_pattern = (re.compile('|'.join(fnmatch.translate(glob) for glob in build_type_globs))
+                                    if build_type_globs else None)
+
+    def is_empty(self):
+        """
+        Check whether there are no rules.
+
+        :return: True if empty.
+        """
+        return not self.has_build_type_rules() and not self.has_tag_rules()
+
+    def has_build_type_rules(self):
+        """
+        Check whether there are rules on projects or build types.
+
+        :return: True if there are.
+        """
+        return bool(self._project_ids or self._build_type_ids or self._build_type_pattern)
+
+    def has_tag_rules(self):
+        """
+        Check whether there are rules on tags.
+
+        :return: True if there are.
+        """
+        return bool(self._tags)
+
+    def matches_build_type(self, build_type_id, project_id):
+        """
+        Check whether a build type matches a project or build type rule.
+
+        :param build_type_id: The build type's ID.
+        :param project_id: The ID of the build type's project, if known.
+        :return: True if matched.
+        """
+        return (project_id in self._project_ids or
+                build_type_id in self._build_type_ids or
+                bool(self._build_type_pattern and self._build_type_pattern.match(build_type_id)))
+
+    def matches_tags(self, tags):
+        """
+        Check whether any tag matches a tag rule.
+
+        :param tags: The tags.
+        :return: True if matched.
+        """
+        return not self._tags.isdisjoint(tags)
@@ -184,6 +184,7 @@ class TestTeamCityClient(unittest.TestCase):
                                 }}
                         }},
                     "running": true,
+                    "percentageComplete": 40,
                     "changes":
                         {{
                             "href": "{changes_resource}?locator=build:(id:376)"
@@ -273,6 +274,7 @@ class TestTeamCityClient(unittest.TestCase):
             self.assertEqual(actual_verb, expected_verb)
             self.assertDictContainsSubset(expected_headers_subset, actual_headers)
         self.assertEqual(actual_any_builds_running, expected_any_builds_running)
+        self.assertEqual(0.4, client.get_running_progress())
 
     def test_any_builds_running_positive_vcs_user_different(self):
         """
@@ -1378,6 +1380,56 @@ class TestTeamCityClient(unittest.TestCase):
         self.assertEqual(1, len(requests))
         self.assertEqual(actual_any_build_failures, expected_any_build_failures)
 
+    def test_create_index(self):
+        """
+        Test that one check indexes builds by every affected user, and that the users of known builds are cached.
+        """
+        # Test parameters
+        resources = {
+            '/running': {'count': 1, 'build': [{'id': 1, 'href': '/builds/1'}]},
+            '/builds/1': {'id': 1,
+                          'percentageComplete': 25,
+                          'triggered': {'type': 'user', 'user': {'username': 'alice'}},
+                          'changes': {'href': '/changes/1'}},
+            '/changes/1': {'count': 1, 'change': [{'href': '/change/1'}]},
+            '/change/1': {'user': {'username': 'bob'}},
+            '/buildTypes': {'count': 1, 'buildType': [{'id': 'Foo'}]},
+            '/failed/Foo': {'count': 1, 'build': [{'id': 2, 'href': '/builds/2'}]},
+            '/builds/2': {'id': 2,
+                          'triggered': {'type': 'vcs'},
+                          'changes': {'href': '/changes/2'}},
+            '/changes/2': {'count': 1, 'change': [{'href': '/change/2'}]},
+            '/change/2': {'user': {'username': 'carol'}},
+        }
+        requested_resources = []
+
+        # Mocks
+        client = clients.TeamCityClient(server_url=None, username='alice', password=None)
+        client._RUNNING_BUILDS_RESOURCE = '/running'
+        client._BUILD_TYPES_RESOURCE = '/buildTypes'
+        client._BUILD_TYPE_RESOURCE_TEMPLATE = '/failed/{build_type_id}'
+        client._get_resource = lambda resource: requested_resources.append(resource) or resources[resource]
+
+        # Execute
+        index = client.create_index()
+        nr_of_first_requests = len(requested_resources)
+        del requested_resources[:]
+        client.create_index()
+
+        # Test
+        self.assertTrue(index.any_builds_running())
+        self.assertFalse(index.any_build_failures())
+        self.assertEqual(0.25, index.get_running_progress())
+        self.assertTrue(index.any_builds_running('bob'))
+        self.assertTrue(index.any_build_failures('carol'))
+        self.assertFalse(index.any_builds_running('carol'))
+        self.assertFalse(index.any_builds_running('dave'))
+        self.assertFalse(index.any_build_failures('dave'))
+        self.assertEqual(([], [2]), index.get_affected_builds('carol'))
+        self.assertEqual(9, nr_of_first_requests)
+        # Only the running build's details are requested again, for its progress
+        self.assertListEqual(['/running', '/builds/1', '/buildTypes', '/failed/Foo'], requested_resources)
+
 
 class _SimpleHttpServer(object):
     """
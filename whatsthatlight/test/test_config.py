@@ -102,6 +102,9 @@ class TestConfig(unittest.TestCase):
             self.assertEqual(expected_device_namespace, actual_device_namespace)
             self.assertEqual(expected_device_class_name, actual_device_class_name)
             self.assertEqual(expected_device_args, actual_device_args)
+            # The polling monitor, unless hotplug is opted into
+            self.assertEqual('polling', config.get_device_monitor(config_parser))
+            self.assertEqual('usb', config.get_device_hotplug_subsystem(config_parser))
             # Server
             actual_client_namespace = config.get_client_namespace(config_parser)
             actual_client_class_name = config.get_client_class_name(config_parser)
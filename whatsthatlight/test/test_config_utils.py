@@ -28,12 +28,19 @@ Test the configuration utilities module.
 import logging.config
 import os
 import StringIO
+import threading
+import time
 import unittest
 
+# Third-party imports
+from mockito import mock
+
 # Local imports
 from whatsthatlight import clients
+from whatsthatlight import controllers
 from whatsthatlight import devices
 from whatsthatlight import config_utils
+from whatsthatlight import monitors
 
 
 class TestConfigUtils(unittest.TestCase):
@@ -229,6 +236,45 @@ class TestConfigUtils(unittest.TestCase):
         self.assertIsNotNone(device)
         self.assertIsInstance(device, expected_device_class)
 
+    def test_load_device_config_parsers(self):
+        """
+        Test that named device sections override the device section.
+        """
+        # Test parameters
+        config_file = 'test.ini'
+        expected_names = ['lobby', 'kitchen']
+        expected_serial_numbers = ['1234', '5678']
+
+        # Write a config file
+        config_content = [
+            '[device]',
+            'namespace=whatsthatlight.devices',
+            'class_name=HidApiDevice',
+            'vid=0x0001',
+            'pid=0x0002',
+            'hid_module=hid',
+            "args=(%(vid)s,%(pid)s,'%(hid_module)s',)",
+            '[device:lobby]',
+            'serial_number=1234',
+            '[device:kitchen]',
+            'serial_number=5678',
+            'pid=0x0003',
+        ]
+        with open(name=config_file, mode='w') as config_file_handle:
+            config_file_handle.writelines(['{0}\n'.format(line) for line in config_content])
+
+        # Execute
+        config_parser = config_utils.create_config_parser(config_file)
+        device_config_parsers = config_utils.load_device_config_parsers(config_parser)
+        loaded_devices = [config_utils.load_device(device_config_parser)
+                          for (_, device_config_parser) in device_config_parsers]
+        os.remove(config_file)
+
+        # Test
+        self.assertListEqual(expected_names, [name for (name, _) in device_config_parsers])
+        self.assertListEqual(expected_serial_numbers, [device.get_serial_number() for device in loaded_devices])
+        self.assertListEqual([0x0002, 0x0003], [device.get_product_id() for device in loaded_devices])
+
     def test_load_client(self):
         """
         Test that a client can be loaded from config.
@@ -264,6 +310,409 @@ class TestConfigUtils(unittest.TestCase):
         self.assertIsNotNone(client)
         self.assertIsInstance(client, expected_client_class)
 
+    def test_reload(self):
+        """
+        Test that only changed components are reconfigured, and that invalid or unreloadable changes are rejected.
+        """
+        # Test parameters
+        config_file = 'test.ini'
+        config_content = [
+            '[device]',
+            'namespace=whatsthatlight.devices',
+            'class_name=HidApiDevice',
+            'vid=0x0001',
+            'pid=0x0002',
+            'hid_module=hid',
+            'running_colour=(1,2,3)',
+            'keep_alive_interval=10',
+            "args=(%(vid)s,%(pid)s,'%(hid_module)s',%(running_colour)s,)",
+            '[server]',
+            'namespace=whatsthatlight.clients',
+            'class_name=TeamCityClient',
+            'server_url=http://example.com/',
+            'username=user',
+            'password=pass',
+            "args=('%(server_url)s','%(username)s','%(password)s',)",
+        ]
+        calls = []
+
+        def write_config(replacements):
+            """
+            Write the config file, with some lines replaced.
+
+            :param replacements: A dictionary of replacement lines by line.
+            """
+            with open(name=config_file, mode='w') as config_file_handle:
+                config_file_handle.writelines(['{0}\n'.format(replacements.get(line, line)) for line in config_content])
+
+        # Mocks
+        device = mock(devices.HidApiDevice)
+        device.set_colours = lambda *colours: calls.append(('set_colours', colours))
+        device.set_calibration = lambda *_args: None
+        device.set_fade_millis = lambda fade_millis: calls.append(('set_fade_millis', fade_millis))
+        device_worker = devices.DeviceWorker(device=device)
+        device_controller = mock(controllers.Controller)
+        device_controller.set_keep_alive_interval = lambda interval: calls.append(('set_keep_alive_interval', interval))
+        controller = mock(controllers.MultiDeviceController)
+        controller.set_routing = lambda *_args: None
+        controller.reload = lambda: calls.append(('reload',))
+        client = mock(clients.TeamCityClient)
+        client.reconfigure = lambda *args: calls.append(('reconfigure',) + args)
+        server_monitor = mock(monitors.ServerMonitor)
+
+        # Execute
+        write_config({})
+        reloader = config_utils.ConfigReloader(config_parser=config_utils.create_config_parser(config_file),
+                                               client=client,
+                                               server_monitor=server_monitor,
+                                               controller=controller,
+                                               device_controllers=[device_controller],
+                                               device_workers=[device_worker])
+        device_worker.start()
+        try:
+            unchanged = reloader.reload(config_file)
+            write_config({'running_colour=(1,2,3)': 'running_colour=(4,5,6)', 'keep_alive_interval=10': 'keep_alive_interval=20'})
+            device_reloaded = reloader.reload(config_file)
+            device_calls = list(calls)
+            del calls[:]
+            write_config({'running_colour=(1,2,3)': 'running_colour=(4,5,6)',
+                          'keep_alive_interval=10': 'keep_alive_interval=20',
+                          'password=pass': 'password=secret'})
+            client_reloaded = reloader.reload(config_file)
+            client_calls = list(calls)
+            del calls[:]
+            write_config({'running_colour=(1,2,3)': 'running_colour=(4,5,6)',
+                          'keep_alive_interval=10': 'keep_alive_interval=20',
+                          'password=pass': 'password=secret',
+                          'vid=0x0001': 'vid=0x0003'})
+            restart_required = reloader.reload(config_file)
+            write_config({'running_colour=(1,2,3)': 'running_colour=(4,5,6)',
+                          'keep_alive_interval=10': 'animations={0}',
+                          'password=pass': 'password=secret'})
+            invalid = reloader.reload(config_file)
+            write_config({'running_colour=(1,2,3)': 'running_colour=(300,5,6)',
+                          'password=pass': 'password=secret'})
+            invalid_colour = reloader.reload(config_file)
+            invalid_colour_calls = list(calls)
+            del calls[:]
+            controller.reload = lambda: _raise(IOError('Device gone'))
+            write_config({'running_colour=(1,2,3)': 'running_colour=(7,8,9)',
+                          'keep_alive_interval=10': 'keep_alive_interval=20',
+                          'password=pass': 'password=secret'})
+            apply_failed = reloader.reload(config_file)
+            del calls[:]
+            controller.reload = lambda: calls.append(('reload',))
+            applied_again = reloader.reload(config_file)
+            applied_again_calls = list(calls)
+            del calls[:]
+            write_config({'running_colour=(1,2,3)': 'running_colour=(7,8,9)',
+                          'keep_alive_interval=10': 'fade_millis=-1',
+                          'password=pass': 'password=secret'})
+            invalid_fade = reloader.reload(config_file)
+            write_config({'running_colour=(1,2,3)': 'running_colour=(7,8,9)',
+                          'keep_alive_interval=10': 'fade_millis=500',
+                          'password=pass': 'password=secret'})
+            fade_reloaded = reloader.reload(config_file)
+        finally:
+            device_worker.stop()
+            os.remove(config_file)
+
+        # Test
+        self.assertFalse(unchanged)
+        self.assertTrue(device_reloaded)
+        self.assertListEqual([('set_colours', ((4, 5, 6),)), ('set_keep_alive_interval', 20.0), ('reload',)], device_calls)
+        self.assertTrue(client_reloaded)
+        self.assertListEqual([('reconfigure', 'http://example.com/', 'user', 'secret')], client_calls)
+        self.assertFalse(restart_required)
+        self.assertFalse(invalid)
+        self.assertFalse(invalid_colour)
+        self.assertListEqual([], invalid_colour_calls)
+        self.assertFalse(apply_failed)
+        self.assertTrue(applied_again)
+        self.assertListEqual([('set_colours', ((7, 8, 9),)), ('set_keep_alive_interval', 20.0), ('reload',)],
+                             applied_again_calls)
+        self.assertFalse(invalid_fade)
+        self.assertTrue(fade_reloaded)
+        self.assertListEqual([('set_colours', ((7, 8, 9),)),
+                              ('set_fade_millis', 500),
+                              ('set_keep_alive_interval', None),
+                              ('reload',)], calls)
+
+    def test_reload_named_devices(self):
+        """
+        Test that named devices are reconfigured by name, even if their sections are reordered, and that adding or
+        removing a device is rejected.
+        """
+        # Test parameters
+        config_file = 'test.ini'
+        device_content = [
+            '[device]',
+            'namespace=whatsthatlight.devices',
+            'class_name=HidApiDevice',
+            'vid=0x0001',
+            'pid=0x0002',
+            'hid_module=hid',
+            'running_colour=(1,2,3)',
+            "args=(%(vid)s,%(pid)s,'%(hid_module)s',%(running_colour)s,)",
+        ]
+        server_content = [
+            '[server]',
+            'namespace=whatsthatlight.clients',
+            'class_name=TeamCityClient',
+            'server_url=http://example.com/',
+            'username=user',
+            'password=pass',
+            "args=('%(server_url)s','%(username)s','%(password)s',)",
+        ]
+        calls = []
+
+        def write_config(*named_devices):
+            """
+            Write the config file, with a section per named device.
+
+            :param named_devices: A (name, running colour) tuple per device.
+            """
+            lines = list(device_content)
+            for (name, running_colour) in named_devices:
+                lines.extend(['[device:{0}]'.format(name), 'running_colour={0}'.format(running_colour)])
+            with open(name=config_file, mode='w') as config_file_handle:
+                config_file_handle.writelines(['{0}\n'.format(line) for line in lines + server_content])
+
+        def create_device_worker(name):
+            """
+            Create a device worker, for a device that records its colours.
+
+            :param name: The device's name.
+            :return: A device worker.
+            """
+            device = mock(devices.HidApiDevice)
+            device.set_colours = lambda *colours: calls.append((name, colours))
+            device.set_calibration = lambda *_args: None
+            return devices.DeviceWorker(device=device)
+
+        # Mocks
+        device_workers = [create_device_worker('a'), create_device_worker('b')]
+        controller = mock(controllers.MultiDeviceController)
+        controller.set_routing = lambda *_args: None
+        controller.reload = lambda: None
+
+        # Execute
+        write_config(('a', '(1,1,1)'), ('b', '(2,2,2)'))
+        reloader = config_utils.ConfigReloader(config_parser=config_utils.create_config_parser(config_file),
+                                               client=mock(clients.TeamCityClient),
+                                               server_monitor=mock(monitors.ServerMonitor),
+                                               controller=controller,
+                                               device_controllers=[mock(controllers.Controller),
+                                                                   mock(controllers.Controller)],
+                                               device_workers=device_workers)
+        for device_worker in device_workers:
+            device_worker.start()
+        try:
+            write_config(('b', '(3,3,3)'), ('a', '(1,1,1)'))
+            reordered = reloader.reload(config_file)
+            reordered_calls = sorted(calls)
+            del calls[:]
+            write_config(('b', '(4,4,4)'), ('a', '(1,1,1)'), ('c', '(5,5,5)'))
+            added = reloader.reload(config_file)
+            write_config(('b', '(4,4,4)'))
+            removed = reloader.reload(config_file)
+        finally:
+            for device_worker in device_workers:
+                device_worker.stop()
+            os.remove(config_file)
+
+        # Test
+        self.assertTrue(reordered)
+        self.assertListEqual([('a', ((1, 1, 1),)), ('b', ((3, 3, 3),))], reordered_calls)
+        self.assertFalse(added)
+        self.assertFalse(removed)
+        self.assertListEqual([], calls)
+
+    def test_config_watcher(self):
+        """
+        Test that a burst of writes to the configuration file is handled once, with inotify and by polling.
+        """
+        # Test parameters
+        config_file = 'watched.ini'
+        debounce_interval = 0.2
+        nr_of_writes = 5
+
+        for use_inotify in (True, False):
+            if use_inotify and not config_utils.InotifyEventSource.is_supported():
+                continue
+            open(config_file, 'w').close()
+            changes = []
+            event = threading.Event()
+
+            # Callback closure
+            def handler():
+                """
+                Count changes.
+                """
+                changes.append(time.time())
+                event.set()
+
+            # Execute
+            watcher = config_utils.ConfigWatcher(config_path=config_file,
+                                                 handler=handler,
+                                                 event_source=config_utils.InotifyEventSource() if use_inotify else False,
+                                                 debounce_interval=debounce_interval,
+                                                 polling_interval=0.05)
+            watcher.start()
+            try:
+                for index in range(nr_of_writes):
+                    with open(config_file, 'w') as config_file_handle:
+                        config_file_handle.write('[device]\nindex={0}\n'.format(index))
+                    time.sleep(debounce_interval / 4)
+                event.wait(5 * debounce_interval)
+                time.sleep(2 * debounce_interval)
+            finally:
+                watcher.stop()
+                os.remove(config_file)
+
+            # Test
+            self.assertEqual(1, len(changes), 'inotify' if use_inotify else 'polling')
+
+    def test_config_watcher_busy_directory(self):
+        """
+        Test that a change to the configuration file settles while other files in its directory keep changing.
+        """
+        # Test parameters
+        config_file = 'watched.ini'
+        debounce_interval = 0.1
+        timeout = 5.0
+        changes = []
+        event = threading.Event()
+
+        # Callback closure
+        def handler():
+            """
+            Count changes.
+            """
+            changes.append(time.time())
+            event.set()
+
+        # Mocks
+        event_source = _BusyDirectoryEventSource(name=config_file, other_name='other.log', interval=debounce_interval / 10)
+
+        # Execute
+        watcher = config_utils.ConfigWatcher(config_path=config_file,
+                                             handler=handler,
+                                             event_source=event_source,
+                                             debounce_interval=debounce_interval)
+        watcher.start()
+        try:
+            handled = event.wait(timeout)
+            time.sleep(2 * debounce_interval)
+        finally:
+            watcher.stop()
+
+        # Test
+        self.assertTrue(handled)
+        self.assertEqual(1, len(changes))
+
+    def test_config_watcher_invalid_change(self):
+        """
+        Test that an invalid edit picked up by the watcher keeps the running configuration, and that the watcher goes on
+        to apply a later valid edit.
+        """
+        # Test parameters
+        config_file = 'watched.ini'
+        debounce_interval = 0.05
+        timeout = 5.0
+        config_content = [
+            '[device]',
+            'namespace=whatsthatlight.devices',
+            'class_name=HidApiDevice',
+            'vid=0x0001',
+            'pid=0x0002',
+            'hid_module=hid',
+            'running_colour=(1,2,3)',
+            "args=(%(vid)s,%(pid)s,'%(hid_module)s',%(running_colour)s,)",
+            '[server]',
+            'namespace=whatsthatlight.clients',
+            'class_name=TeamCityClient',
+            'server_url=http://example.com/',
+            'username=user',
+            'password=pass',
+            "args=('%(server_url)s','%(username)s','%(password)s',)",
+        ]
+        colours = []
+        reloads = []
+        condition = threading.Condition()
+
+        def write_config(running_colour):
+            """
+            Write the config file, with a running colour.
+
+            :param running_colour: The running colour.
+            """
+            with open(name=config_file, mode='w') as config_file_handle:
+                config_file_handle.writelines(['{0}\n'.format(line.replace('(1,2,3)', running_colour))
+                                               for line in config_content])
+
+        def wait_for_reloads(nr_of_reloads):
+            """
+            Wait until the watcher reloaded the configuration a number of times.
+
+            :param nr_of_reloads: The number of reloads.
+            """
+            deadline = time.time() + timeout
+            with condition:
+                while len(reloads) < nr_of_reloads and time.time() < deadline:
+                    condition.wait(deadline - time.time())
+
+        # Callback closure
+        def handler():
+            """
+            Reload the configuration.
+            """
+            reloaded = reloader.reload(config_file)
+            with condition:
+                reloads.append(reloaded)
+                condition.notify_all()
+
+        # Mocks
+        device = mock(devices.HidApiDevice)
+        device.set_colours = lambda *args: colours.append(args)
+        device.set_calibration = lambda *_args: None
+        device_worker = devices.DeviceWorker(device=device)
+
+        # Setup
+        write_config('(1,2,3)')
+        config_parser = config_utils.create_config_parser(config_file)
+        reloader = config_utils.ConfigReloader(config_parser=config_parser,
+                                               client=mock(clients.TeamCityClient),
+                                               server_monitor=mock(monitors.ServerMonitor),
+                                               controller=mock(controllers.MultiDeviceController),
+                                               device_controllers=[mock(controllers.Controller)],
+                                               device_workers=[device_worker])
+        watcher = config_utils.ConfigWatcher(config_path=config_file,
+                                             handler=handler,
+                                             event_source=False,
+                                             debounce_interval=debounce_interval,
+                                             polling_interval=debounce_interval)
+
+        # Execute
+        device_worker.start()
+        watcher.start()
+        try:
+            # A different size, as the modification time may not change within the same second
+            write_config('(300,2,3)')
+            wait_for_reloads(1)
+            invalid_config_parser = reloader.get_config_parser()
+            write_config('(4,5,6)')
+            wait_for_reloads(2)
+        finally:
+            watcher.stop()
+            device_worker.stop()
+            os.remove(config_file)
+
+        # Test
+        self.assertListEqual([False, True], reloads)
+        self.assertIs(config_parser, invalid_config_parser)
+        self.assertListEqual([((4, 5, 6),)], colours)
+
 
 class _MockArguments(object):
     """
@@ -277,5 +726,67 @@ class _MockArguments(object):
         self.config = None
 
 
+class _BusyDirectoryEventSource(object):
+    """
+    A source of file events in a directory in which one file changes once, while another keeps changing.
+    """
+
+    def __init__(self, name, other_name, interval):
+        """
+        Constructor.
+
+        :param name: The name of the file that changes once.
+        :param other_name: The name of the file that keeps changing.
+        :param interval: The interval in seconds between changes of the other file.
+        """
+        self._name = name
+        self._other_name = other_name
+        self._interval = interval
+        self._changed = False
+        self._interrupted = threading.Event()
+
+    def open(self, directory):
+        """
+        Start watching a directory.
+
+        :param directory: The directory.
+        """
+
+    def wait(self, timeout=None):
+        """
+        Block until files change or the wait is interrupted.
+
+        :param timeout: The timeout in seconds, or None to wait indefinitely.
+        :return: A set of the names of the changed files, or None if interrupted.
+        """
+        if not self._changed:
+            self._changed = True
+            return set([self._name])
+        self._interrupted.wait(self._interval if timeout is None else min(timeout, self._interval))
+        if self._interrupted.is_set():
+            return None
+        return set([self._other_name])
+
+    def interrupt(self):
+        """
+        Interrupt a blocking wait.
+        """
+        self._interrupted.set()
+
+    def close(self):
+        """
+        Stop watching.
+        """
+
+
+def _raise(error):
+    """
+    Raise an error, from a lambda.
+
+    :param error: The error.
+    """
+    raise error
+
+
 if __name__ == '__main__':
     unittest.main()
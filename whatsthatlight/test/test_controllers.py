@@ -29,9 +29,12 @@ Tests for the controller.
 import importlib
 import logging
 import logging.config
+import os
+import shutil
 import signal
 import subprocess
 import sys
+import tempfile
 import threading
 import time
 import unittest
@@ -109,10 +112,9 @@ class TestController(unittest.TestCase):
 
     def test_initial_state_and_device_added(self):
         """
-        Test that the initial state and device added state is set.
+        Test that the initial state and device added state is set, and that the startup phases are timed.
         """
         # Test parameters
-        expected_nr_of_writes = 2
         expected_data_0 = (None, None)
         expected_any_builds_running_1 = True
         expected_any_build_failures_1 = False
@@ -131,7 +133,7 @@ class TestController(unittest.TestCase):
             :param any_build_failures: True if any builds failing or failed. None if unknown or undefined.
             """
             device_data.append((any_builds_running, any_build_failures))
-            if len(device_data) == expected_nr_of_writes:
+            if device_data[-1] == expected_data_1:
                 event.set()
 
         # Mocks
@@ -161,13 +163,244 @@ class TestController(unittest.TestCase):
         finally:
             controller.stop()
 
+        # Test: The device and the server are started together, so the unknown state is only shown if the device is
+        # added before the first check completes
+        self.assertTrue(event.is_set(), 'Timeout')
+        self.assertIn(device_data[0], [expected_data_0, expected_data_1])
+        self.assertEqual(expected_data_1, device_data[-1])
+        phase_timings = controller.get_phase_timings()
+        self.assertSetEqual(set([controllers.Controller.DEVICE_ADDED_PHASE,
+                                 controllers.Controller.FIRST_CHECK_PHASE,
+                                 controllers.Controller.FIRST_LIGHT_PHASE,
+                                 controllers.Controller.FIRST_CHECKED_LIGHT_PHASE]), set(phase_timings))
+        self.assertLessEqual(phase_timings[controllers.Controller.FIRST_LIGHT_PHASE],
+                             phase_timings[controllers.Controller.FIRST_CHECKED_LIGHT_PHASE])
+        # The first check doesn't wait for the device to be added
+        self.assertLess(phase_timings[controllers.Controller.FIRST_CHECK_PHASE], 1)
+
+    def test_persistent(self):
+        """
+        Test that a persistent device is opened once when added, and closed when stopped.
+        """
+        # Test parameters
+        polling_interval = 0.05
+
+        calls = []
+        event = threading.Event()
+
+        # Callback closure
+        def send(_any_builds_running, _any_build_failures):
+            """
+            Record a send.
+            """
+            calls.append('send')
+            if calls.count('send') == 3:
+                event.set()
+
+        # Mocks
+        device = mock(devices.BaseDevice)
+        when(device).get_vendor_id().thenReturn(0)
+        when(device).get_product_id().thenReturn(0)
+        when(device).probe().thenReturn(True)
+        device.open = lambda: calls.append('open')
+        device.send = send
+        device.off = lambda: calls.append('off')
+        device.close = lambda: calls.append('close')
+        client = mock(clients.BaseClient)
+        when(client).any_builds_running().thenReturn(False)
+        when(client).any_build_failures().thenReturn(False)
+
+        # Setup
+        device_monitor = monitors.DeviceMonitor(device=device,
+                                                polling_interval=polling_interval,
+                                                probe_by_enumeration=True)
+        server_monitor = monitors.ServerMonitor(client=client,
+                                                polling_interval=polling_interval)
+        controller = controllers.Controller(device=device,
+                                            device_monitor=device_monitor,
+                                            server_monitor=server_monitor,
+                                            persistent=True,
+                                            keep_alive_interval=0)
+
+        # Execute
+        controller.start()
+        event.wait(20 * polling_interval)
+        controller.stop()
+
         # Test
         self.assertTrue(event.is_set(), 'Timeout')
-        self.assertEqual(expected_nr_of_writes, len(device_data))
-        actual_data = device_data[0]
-        self.assertEqual(actual_data, expected_data_0)
-        actual_data = device_data[1]
-        self.assertEqual(actual_data, expected_data_1)
+        self.assertEqual('open', calls[0])
+        self.assertEqual(1, calls.count('open'))
+        self.assertEqual(1, calls.count('close'))
+        self.assertIn('off', calls)
+        self.assertEqual('close', calls[-1])
+
+    def test_unchanged_state_not_written(self):
+        """
+        Test that an unchanged build state is only written again once the keep-alive interval has passed.
+        """
+        # Test parameters
+        polling_interval = 0.02
+        keep_alive_interval = 0.2
+        duration = 0.3
+        states = []
+
+        # Mocks
+        device = mock(devices.BaseDevice)
+        when(device).get_vendor_id().thenReturn(0)
+        when(device).get_product_id().thenReturn(0)
+        when(device).probe().thenReturn(True)
+        device.send = lambda *state: states.append(state)
+        client = mock(clients.BaseClient)
+        when(client).any_builds_running().thenReturn(False)
+        when(client).any_build_failures().thenReturn(True)
+
+        # Setup
+        device_monitor = monitors.DeviceMonitor(device=device,
+                                                polling_interval=polling_interval,
+                                                probe_by_enumeration=True)
+        server_monitor = monitors.ServerMonitor(client=client,
+                                                polling_interval=polling_interval)
+        controller = controllers.Controller(device=device,
+                                            device_monitor=device_monitor,
+                                            server_monitor=server_monitor,
+                                            keep_alive_interval=keep_alive_interval)
+
+        # Execute
+        controller.start()
+        time.sleep(duration)
+        controller.stop()
+
+        # Test: The initial state if added before the first check completes, the first server state, and one
+        # keep-alive write
+        counts = controller.get_write_counts()
+        self.assertEqual(len(states), counts['written'])
+        if states[0] == (None, None):
+            states.pop(0)
+        self.assertListEqual([(False, True), (False, True)], states)
+        self.assertGreater(counts['skipped'], 5)
+
+    def test_failed_write_written_again(self):
+        """
+        Test that a state the device worker failed to write isn't skipped as unchanged, but written again.
+        """
+        # Test parameters
+        polling_interval = 0.01
+        timeout = 2.0
+        build_state = (False, True)
+        attempts = []
+
+        # Callback closure
+        def send(*state):
+            """
+            Record a send, and fail the first of the build state.
+            """
+            attempts.append(state)
+            if attempts.count(build_state) == 1 and state == build_state:
+                raise IOError('Write failed')
+
+        # Mocks
+        device = mock(devices.BaseDevice)
+        when(device).get_vendor_id().thenReturn(0)
+        when(device).get_product_id().thenReturn(0)
+        when(device).probe().thenReturn(True)
+        device.send = send
+
+        # Setup
+        device_worker = devices.DeviceWorker(device=device)
+        device_monitor = monitors.DeviceMonitor(device=device_worker,
+                                                polling_interval=polling_interval,
+                                                probe_by_enumeration=True)
+        controller = controllers.Controller(device=device_worker,
+                                            device_monitor=device_monitor,
+                                            persistent=True)
+        device_worker.start()
+        controller.start()
+        deadline = time.time() + timeout
+        while not controller.is_device_connected() and time.time() < deadline:
+            time.sleep(polling_interval)
+
+        # Execute: Every device operation is executed in order, so a call on the worker waits for the writes before it
+        controller.update(*build_state)
+        device_worker.run(lambda _device: None)
+        controller.update(*build_state)
+        device_worker.run(lambda _device: None)
+        controller.stop()
+        device_worker.stop()
+
+        # Test
+        self.assertEqual(2, attempts.count(build_state))
+        self.assertEqual(1, device_worker.get_metrics()['write_errors'])
+
+    def test_multi_device(self):
+        """
+        Test that one server monitor drives several devices, and that a slow device doesn't delay the others.
+        """
+        # Test parameters
+        polling_interval = 0.02
+        slow_write_time = 0.5
+        fast_states = []
+        slow_states = []
+        event = threading.Event()
+
+        # Callback closures
+        def fast_send(*state):
+            """
+            A fast write.
+
+            :param state: The build state.
+            """
+            fast_states.append(state)
+            if state == (True, False):
+                event.set()
+
+        def slow_send(*state):
+            """
+            A slow write.
+
+            :param state: The build state.
+            """
+            time.sleep(slow_write_time)
+            slow_states.append(state)
+
+        # Mocks
+        fast_device = mock(devices.BaseDevice)
+        slow_device = mock(devices.BaseDevice)
+        for (device, send) in ((fast_device, fast_send), (slow_device, slow_send)):
+            when(device).get_vendor_id().thenReturn(0)
+            when(device).get_product_id().thenReturn(0)
+            when(device).probe().thenReturn(True)
+            device.send = send
+        client = mock(clients.BaseClient)
+        when(client).any_builds_running().thenReturn(True)
+        when(client).any_build_failures().thenReturn(False)
+
+        # Setup
+        device_controllers = [controllers.Controller(device=device,
+                                                     device_monitor=monitors.DeviceMonitor(device=device,
+                                                                                           polling_interval=polling_interval,
+                                                                                           probe_by_enumeration=True),
+                                                     keep_alive_interval=0)
+                              for device in (fast_device, slow_device)]
+        server_monitor = monitors.ServerMonitor(client=client, polling_interval=polling_interval)
+        controller = controllers.MultiDeviceController(controllers=device_controllers, server_monitor=server_monitor)
+
+        # Execute
+        controller.start()
+        start = time.time()
+        try:
+            event.wait(slow_write_time)
+            elapsed = time.time() - start
+            time.sleep(slow_write_time)
+        finally:
+            controller.stop()
+
+        # Test
+        self.assertTrue(event.is_set(), 'Timeout')
+        self.assertLess(elapsed, slow_write_time)
+        self.assertIn((True, False), slow_states)
+        # The slow device skips the updates it missed, instead of falling behind
+        self.assertLess(len(slow_states), len(fast_states))
 
     @staticmethod
     @unittest.skipIf(constants.SKIP_MANUAL_TESTS, 'Manual test')
@@ -204,6 +437,61 @@ class TestController(unittest.TestCase):
         controller.stop()
         time.sleep(2 * polling_interval)
 
+    def test_warm_restart(self):
+        """
+        Test that the persisted build state is shown when started, dimmed if stale, until the first check completes.
+        """
+        # Test parameters
+        polling_interval = 0.02
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'state.json')
+        states = []
+        stale = []
+        event = threading.Event()
+
+        # Mocks
+        device = mock(devices.BaseDevice)
+        when(device).get_vendor_id().thenReturn(0)
+        when(device).get_product_id().thenReturn(0)
+        when(device).probe().thenReturn(True)
+        device.send = lambda *state: states.append(state) or event.set()
+        device.set_stale = stale.append
+        client = mock(clients.BaseClient)
+        when(client).get_server_url().thenReturn('http://localhost:8111/')
+        when(client).get_username().thenReturn('alice')
+
+        # Setup
+        state_store = controllers.StateStore(path=path, client=client)
+        self.assertIsNone(state_store.load())
+        state_store.save((False, True))
+        self.assertIsNone(controllers.StateStore(path=path, client=client, username='bob').load())
+        device_monitor = monitors.DeviceMonitor(device=device,
+                                                polling_interval=polling_interval,
+                                                probe_by_enumeration=True)
+        controller = controllers.Controller(device=device,
+                                            device_monitor=device_monitor,
+                                            state_store=state_store,
+                                            stale_after=0)
+
+        # Execute
+        try:
+            time.sleep(0.01)
+            controller.start()
+            event.wait(20 * polling_interval)
+            controller.update(False, True)
+            controller.stop()
+            files = os.listdir(directory)
+            snapshot = state_store.load()
+        finally:
+            shutil.rmtree(directory)
+
+        # Test: The restored state is shown stale, and written again once confirmed
+        self.assertListEqual([True, False], stale)
+        self.assertListEqual([(False, True), (False, True)], states)
+        self.assertListEqual(['state.json'], files)
+        self.assertEqual((False, True), snapshot[0])
+        self.assertLess(snapshot[1], 1)
+
     def test_no_device_no_write(self):
         """
         Test that when there is no device, nothing gets written to the device.
@@ -28,6 +28,7 @@ Tests for various devices.
 # System imports
 import importlib
 import logging.config
+import threading
 import time
 import unittest
 
@@ -58,7 +59,7 @@ class TestHidApiDevice(unittest.TestCase):
         # Test parameters
         expected_vendor_id = 0x27b8
         expected_product_id = 0x01ed
-        # We assume fade millis is 100ms, so we'll wait 1s
+        # We assume fade millis is 1000ms, so we'll wait 2s
         wait_time = 2
         hidapi = importlib.import_module('hid')
 
@@ -124,6 +125,31 @@ class TestHidApiDevice(unittest.TestCase):
         device = devices.HidApiDevice(vendor_id=vendor_id, product_id=product_id, hidapi=mock_hidapi)
         self.assertRaises(IOError, device.send, any_builds_running=None, any_build_failures=None)
 
+    def test_persistent_reopen(self):
+        """
+        Test that a failed write on a persistent handle reopens the device and retries.
+        """
+        # Test parameters
+        vendor_id = 0
+        product_id = 0
+        calls = []
+
+        # Mocks
+        hidapi = importlib.import_module('hid')
+        mock_device = mock(hidapi.device)
+        mock_device.open = lambda *_args: calls.append('open')
+        mock_device.close = lambda: calls.append('close')
+        when(mock_device).write(any()).thenReturn(0).thenReturn(8)
+        mock_hidapi = mock(hidapi)
+        when(mock_hidapi).device().thenReturn(mock_device)
+
+        # Test
+        device = devices.HidApiDevice(vendor_id=vendor_id, product_id=product_id, hidapi=mock_hidapi, persistent=True)
+        device.open()
+        device.send(any_builds_running=None, any_build_failures=None)
+        self.assertTrue(device.is_open())
+        self.assertListEqual(['open', 'close', 'open'], calls)
+
     def test_open_close(self):
         """
         Test opening and closing the device.
@@ -146,6 +172,36 @@ class TestHidApiDevice(unittest.TestCase):
         device.close()
         self.assertFalse(device.is_open())
 
+    def test_probe(self):
+        """
+        Test probing for the device by enumeration, and opening it by the cached path.
+        """
+        # Test parameters
+        vendor_id = 0x27b8
+        product_id = 0x01ed
+        expected_path = '/dev/hidraw0'
+        opened_paths = []
+
+        # Mocks
+        hidapi = importlib.import_module('hid')
+        mock_device = mock(hidapi.device)
+        mock_device.open_path = opened_paths.append
+        mock_hidapi = mock(hidapi)
+        when(mock_hidapi).device().thenReturn(mock_device)
+        (when(mock_hidapi).enumerate(vendor_id, product_id)
+         .thenReturn([])
+         .thenReturn([{'path': expected_path, 'vendor_id': vendor_id, 'product_id': product_id}]))
+
+        # Test
+        device = devices.HidApiDevice(vendor_id=vendor_id, product_id=product_id, hidapi=mock_hidapi)
+        self.assertFalse(device.probe())
+        self.assertFalse(device.is_open())
+        self.assertTrue(device.probe())
+        self.assertFalse(device.is_open())
+        device.open()
+        self.assertTrue(device.is_open())
+        self.assertListEqual([expected_path], opened_paths)
+
     def test_send_and_off(self):
         """
         Test sending information to the device.
@@ -189,7 +245,303 @@ class TestHidApiDevice(unittest.TestCase):
         device.off()
 
         # Test
-        self.assertListEqual(actual_data, expected_data)
+        self.assertListEqual([list(data) for data in actual_data], expected_data)
+
+    def test_frame_table(self):
+        """
+        Test that frames are looked up, not created per send, and are recreated when the colours or fade change.
+        """
+        # Test parameters
+        vendor_id = 0
+        product_id = 0
+        actual_data = []
+
+        # Mocks
+        hidapi = importlib.import_module('hid')
+        mock_device = mock(hidapi.device)
+        mock_device.write = lambda data: actual_data.append(data) or len(data)
+        mock_hidapi = mock(hidapi)
+        when(mock_hidapi).device().thenReturn(mock_device)
+
+        # Execute
+        device = devices.HidApiDevice(vendor_id=vendor_id, product_id=product_id, hidapi=mock_hidapi)
+        device.send(False, True)
+        device.send(False, True)
+        device.set_colours(failure_colour=(255, 0, 0))
+        device.send(False, True)
+        # 5150ms, or 515 (0x0203) units of 10ms
+        device.set_fade_millis(5150)
+        device.send(False, True)
+        device.send(False, False)
+
+        # Test
+        self.assertIs(actual_data[0], actual_data[1])
+        self.assertListEqual([1, 99, 230, 0, 0, 0, 100, 0], list(actual_data[0]))
+        self.assertListEqual([1, 99, 255, 0, 0, 0, 100, 0], list(actual_data[2]))
+        self.assertListEqual([1, 99, 255, 0, 0, 2, 3, 0], list(actual_data[3]))
+        self.assertListEqual([1, 99, 0, 255, 0, 2, 3, 0], list(actual_data[4]))
+
+    def test_calibration(self):
+        """
+        Test that colours are calibrated for gamma and white balance when frames are created.
+        """
+        # Test parameters
+        vendor_id = 0
+        product_id = 0
+        actual_data = []
+
+        # Mocks
+        hidapi = importlib.import_module('hid')
+        mock_device = mock(hidapi.device)
+        mock_device.write = lambda data: actual_data.append(list(data)) or len(data)
+        mock_hidapi = mock(hidapi)
+        when(mock_hidapi).device().thenReturn(mock_device)
+
+        # Execute
+        device = devices.HidApiDevice(vendor_id=vendor_id,
+                                      product_id=product_id,
+                                      hidapi=mock_hidapi,
+                                      failure_colour=(255, 128, 0))
+        device.send(False, True)
+        device.set_calibration(gamma=2.0, white_balance=(1.0, 0.5, 1.0))
+        device.send(False, True)
+
+        # Test
+        self.assertListEqual([1, 99, 255, 128, 0, 0, 100, 0], actual_data[0])
+        self.assertListEqual([1, 99, 255, 32, 0, 0, 100, 0], actual_data[1])
+        self.assertEqual((255, 32, 0), device.calibrate((255, 128, 0)))
+        self.assertEqual((0, 0, 0), device.calibrate((0, 0, 0)))
+
+        # A stale state is dimmed
+        device.set_stale(True)
+        self.assertEqual((64, 8, 0), device.calibrate((255, 128, 0)))
+        device.set_stale(False)
+        self.assertEqual((255, 32, 0), device.calibrate((255, 128, 0)))
+
+    def test_pattern_memory(self):
+        """
+        Test that a pattern is uploaded and played once per state change, and stopped when the state changes.
+        """
+        # Test parameters
+        vendor_id = 0
+        product_id = 0
+        expected_data = [[1, 99, 0, 255, 0, 0, 100, 0],
+                         # Pulse between the running colour and off, taking 1s per step
+                         [1, 80, 200, 120, 0, 0, 100, 0],
+                         [1, 80, 0, 0, 0, 0, 100, 1],
+                         [1, 112, 1, 0, 1, 0, 0, 0],
+                         # Stop, then fade to the failure colour
+                         [1, 112, 0, 0, 0, 0, 0, 0],
+                         [1, 99, 230, 0, 0, 0, 100, 0]]
+        actual_data = []
+
+        # Mocks
+        hidapi = importlib.import_module('hid')
+        mock_device = mock(hidapi.device)
+        mock_device.write = lambda data: actual_data.append(list(data)) or len(data)
+        mock_hidapi = mock(hidapi)
+        when(mock_hidapi).device().thenReturn(mock_device)
+
+        # Execute
+        patterns = {devices.BaseDevice.RUNNING_STATE: devices.Pattern.create(devices.Pattern.PULSE_EFFECT, 2000)}
+        device = devices.HidApiDevice(vendor_id=vendor_id, product_id=product_id, hidapi=mock_hidapi, patterns=patterns)
+        device.send(False, False)
+        device.send(True, False)
+        device.send(True, True)
+        device.send(False, True)
+
+        # Test
+        self.assertListEqual(expected_data, actual_data)
+
+        # A reset device gets the pattern again, even though the state is unchanged
+        device.send(True, False)
+        device.reset()
+        device.send(True, False)
+        self.assertEqual(3, actual_data.count([1, 112, 1, 0, 1, 0, 0, 0]))
+
+    def test_pattern_played_by_host(self):
+        """
+        Test that a pattern is played from the host for a device without pattern memory.
+        """
+        # Test parameters
+        vendor_id = 0
+        product_id = 0
+        period_millis = 80
+        timeout = 10
+        nr_of_played_frames = 4
+        # At 25 fps, every half period is a single frame of 40ms
+        on_data = [1, 99, 200, 120, 0, 0, 4, 0]
+        off_data = [1, 99, 0, 0, 0, 0, 4, 0]
+        failure_data = [1, 99, 230, 0, 0, 0, 100, 0]
+        actual_data = []
+        played_event = threading.Event()
+        failure_event = threading.Event()
+
+        # Callback closure
+        def write(data):
+            """
+            Capture data written to the device.
+
+            :param data: The binary data.
+            :return: The number of bytes written.
+            """
+            actual_data.append(list(data))
+            if len(actual_data) == nr_of_played_frames:
+                played_event.set()
+            if list(data) == failure_data:
+                failure_event.set()
+            return len(data)
+
+        # Mocks
+        hidapi = importlib.import_module('hid')
+        mock_device = mock(hidapi.device)
+        mock_device.write = write
+        mock_hidapi = mock(hidapi)
+        when(mock_hidapi).device().thenReturn(mock_device)
+
+        # Execute
+        patterns = {devices.BaseDevice.RUNNING_STATE: devices.Pattern.create(devices.Pattern.PULSE_EFFECT, period_millis)}
+        device = devices.HidApiDevice(vendor_id=vendor_id,
+                                      product_id=product_id,
+                                      hidapi=mock_hidapi,
+                                      patterns=patterns,
+                                      pattern_memory=False)
+        device.open()
+        device.send(True, False)
+        played = played_event.wait(timeout)
+        device.send(False, True)
+        failed = failure_event.wait(timeout)
+        # Closing ends the timer thread, so nothing is written after this
+        device.close()
+
+        # Test
+        self.assertTrue(played)
+        self.assertTrue(failed)
+        # The pattern alternates until replaced, however many frames were played by then
+        played_data = actual_data[:-1]
+        self.assertGreaterEqual(len(played_data), nr_of_played_frames)
+        self.assertListEqual([on_data, off_data] * (len(played_data) // 2) + [on_data] * (len(played_data) % 2),
+                             played_data)
+        self.assertEqual(failure_data, actual_data[-1])
+
+    def test_animation_thread_stopped(self):
+        """
+        Test that closing a device ends the timer thread of a pattern played from the host, and that a pattern played
+        after reopening starts a new one.
+        """
+        # Test parameters
+        vendor_id = 0
+        product_id = 0
+        period_millis = 80
+
+        # Mocks
+        hidapi = importlib.import_module('hid')
+        mock_device = mock(hidapi.device)
+        mock_device.write = len
+        mock_hidapi = mock(hidapi)
+        when(mock_hidapi).device().thenReturn(mock_device)
+
+        # Execute
+        patterns = {devices.BaseDevice.RUNNING_STATE: devices.Pattern.create(devices.Pattern.PULSE_EFFECT, period_millis)}
+        device = devices.HidApiDevice(vendor_id=vendor_id,
+                                      product_id=product_id,
+                                      hidapi=mock_hidapi,
+                                      patterns=patterns,
+                                      pattern_memory=False)
+        device.open()
+        device.send(True, False)
+        playing_threads = _get_animation_threads()
+        device.close()
+        closed_threads = _get_animation_threads()
+        device.open()
+        device.send(True, False)
+        reopened_threads = _get_animation_threads()
+        device.close()
+
+        # Test
+        self.assertEqual(1, len(playing_threads))
+        self.assertListEqual([], closed_threads)
+        self.assertEqual(1, len(reopened_threads))
+        self.assertListEqual([], _get_animation_threads())
+
+    def test_pattern_effects(self):
+        """
+        Test creating patterns for effects.
+        """
+        pattern = devices.Pattern.create(devices.Pattern.BLINK_EFFECT, 1000)
+        self.assertListEqual([((1, 2, 3), 0), ((1, 2, 3), 500), ((0, 0, 0), 0), ((0, 0, 0), 500)], pattern.resolve((1, 2, 3)))
+        pattern = devices.Pattern.create(devices.Pattern.ALTERNATE_EFFECT, 1000, (4, 5, 6))
+        self.assertListEqual([((1, 2, 3), 0), ((1, 2, 3), 500), ((4, 5, 6), 0), ((4, 5, 6), 500)], pattern.resolve((1, 2, 3)))
+        pattern = devices.Pattern.create(devices.Pattern.PROGRESS_EFFECT, 1000)
+        self.assertListEqual([((0, 0, 0), 0), ((100, 50, 0), 750), ((100, 50, 0), 250)], pattern.resolve((200, 100, 0), 0.5))
+        self.assertRaises(ValueError, devices.Pattern.create, devices.Pattern.ALTERNATE_EFFECT, 1000)
+        self.assertRaises(ValueError, devices.Pattern.create, 'no_such_effect', 1000)
+
+    def test_animation_render(self):
+        """
+        Test that the animation engine interpolates fades and collapses identical consecutive frames.
+        """
+        # Test parameters
+        frame_rate = 10
+        steps = [((0, 0, 0), 0), ((100, 0, 0), 400), ((100, 0, 0), 1000)]
+        expected_frames = [((0, 0, 0), 100, 0.1),
+                           ((25, 0, 0), 100, 0.1),
+                           ((50, 0, 0), 100, 0.1),
+                           ((75, 0, 0), 100, 0.1),
+                           ((100, 0, 0), 100, 1.1)]
+
+        # Execute
+        engine = devices.AnimationEngine(write=lambda data, is_current: True,
+                                         create_frame=lambda colour, fade_millis: (colour, fade_millis))
+        actual_frames = engine.render(steps, frame_rate)
+
+        # Test
+        self.assertEqual(len(expected_frames), len(actual_frames))
+        for ((expected_colour, expected_fade_millis, expected_seconds),
+             ((actual_colour, actual_fade_millis), actual_seconds)) in zip(expected_frames, actual_frames):
+            self.assertEqual(expected_colour, actual_colour)
+            self.assertEqual(expected_fade_millis, actual_fade_millis)
+            self.assertAlmostEqual(expected_seconds, actual_seconds)
+
+    def test_animation_frame_rate_drop(self):
+        """
+        Test that the animation engine drops its frame rate when writes can't keep up, without blocking play and stop.
+        """
+        # Test parameters
+        frame_rate = 100
+        min_frame_rate = 25
+        steps = [((0, 0, 0), 500), ((100, 0, 0), 500)]
+        event = threading.Event()
+
+        # Callback closure
+        def write(data, is_current):
+            """
+            A write slower than a frame at 100 fps.
+
+            :param data: The frame.
+            :param is_current: Checks whether the frame's animation is current.
+            :return: True to keep playing.
+            """
+            time.sleep(0.02)
+            if engine.get_frame_rate() == min_frame_rate:
+                event.set()
+            return is_current()
+
+        # Execute
+        engine = devices.AnimationEngine(write=write,
+                                         create_frame=lambda colour, fade_millis: colour,
+                                         frame_rate=frame_rate,
+                                         min_frame_rate=min_frame_rate)
+        start = time.time()
+        engine.play(steps)
+        engine.play(steps)
+        self.assertLess(time.time() - start, 0.01)
+        event.wait(2)
+        engine.stop()
+
+        # Test
+        self.assertTrue(event.is_set())
+        self.assertEqual(min_frame_rate, engine.get_frame_rate())
 
     # @unittest.skip
     # def test_(self):
@@ -245,5 +597,196 @@ class TestHidApiDevice(unittest.TestCase):
     #     self.assertEqual(0, len(errors), errors)
 
 
+class TestDeviceWorker(unittest.TestCase):
+    """
+    Device worker tests.
+    """
+
+    def setUp(self):
+        """
+        Test setup.
+        """
+        logging.config.fileConfig('../conf/build_light.ini')
+
+    def test_serialised(self):
+        """
+        Test that operations from different threads are executed one at a time, on the worker thread.
+        """
+        # Test parameters
+        nr_of_threads = 4
+        nr_of_iterations = 20
+        thread_names = set()
+        active = []
+        overlaps = []
+
+        # Callback closure
+        def operation(*_args):
+            """
+            Record the calling thread and detect concurrent operations.
+            """
+            thread_names.add(threading.current_thread().name)
+            active.append(None)
+            if len(active) > 1:
+                overlaps.append(None)
+            time.sleep(0.0001)
+            active.pop()
+
+        # Mocks
+        device = mock(devices.BaseDevice)
+        device.open = operation
+        device.send = operation
+        device.close = operation
+        device.probe = operation
+
+        # Setup
+        worker = devices.DeviceWorker(device=device)
+
+        def _run():
+            """
+            Client thread.
+            """
+            for _ in range(nr_of_iterations):
+                worker.open()
+                worker.send(True, False)
+                worker.probe()
+                worker.close()
+
+        threads = [threading.Thread(target=_run) for _ in range(nr_of_threads)]
+
+        # Execute
+        worker.start()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        worker.stop()
+
+        # Test
+        self.assertSetEqual({'DeviceWorker'}, thread_names)
+        self.assertEqual(0, len(overlaps), 'Operations overlapped')
+        self.assertFalse(worker.is_open())
+
+    def test_reference_counted_open(self):
+        """
+        Test that the device is only opened by the first open and closed by the last close.
+        """
+        # Test parameters
+        calls = []
+
+        # Mocks
+        device = mock(devices.BaseDevice)
+        device.open = lambda: calls.append('open')
+        device.close = lambda: calls.append('close')
+
+        # Execute
+        worker = devices.DeviceWorker(device=device)
+        worker.start()
+        try:
+            worker.open()
+            worker.open()
+            self.assertTrue(worker.is_open())
+            worker.close()
+            self.assertTrue(worker.is_open())
+            worker.close()
+            self.assertFalse(worker.is_open())
+            worker.close()
+        finally:
+            worker.stop()
+
+        # Test
+        self.assertListEqual(['open', 'close'], calls)
+
+    def test_open_error(self):
+        """
+        Test that an error is raised to the caller.
+        """
+        # Mocks
+        device = mock(devices.BaseDevice)
+        when(device).open().thenRaise(IOError('Test'))
+
+        # Execute and test
+        worker = devices.DeviceWorker(device=device)
+        worker.start()
+        try:
+            self.assertRaises(IOError, worker.open)
+            self.assertFalse(worker.is_open())
+        finally:
+            worker.stop()
+        self.assertRaises(IOError, worker.open)
+
+    def test_coalesced_sends(self):
+        """
+        Test that pending sends are coalesced, so that the latest one wins.
+        """
+        # Test parameters
+        expected_data = [(None, None), (True, True)]
+        actual_data = []
+        release_event = threading.Event()
+
+        # Callback closure
+        def send(any_builds_running, any_build_failures):
+            """
+            Capture data and block the first write, so that the sends that follow are queued.
+
+            :param any_builds_running: True if any builds running. None if unknown or undefined.
+            :param any_build_failures: True if any builds failing or failed. None if unknown or undefined.
+            """
+            release_event.wait(1)
+            actual_data.append((any_builds_running, any_build_failures))
+
+        # Mocks
+        device = mock(devices.BaseDevice)
+        device.send = send
+
+        # Execute
+        worker = devices.DeviceWorker(device=device)
+        worker.start()
+        worker.send(None, None)
+        while worker.get_metrics()['queue_depth'] > 0:
+            time.sleep(0.001)
+        worker.send(False, False)
+        worker.send(False, True)
+        worker.send(True, True)
+        release_event.set()
+        worker.stop()
+
+        # Test
+        self.assertListEqual(expected_data, actual_data)
+        metrics = worker.get_metrics()
+        self.assertEqual(2, metrics['writes'])
+        self.assertEqual(2, metrics['coalesced_writes'])
+        self.assertEqual(0, metrics['write_errors'])
+        self.assertEqual(0, metrics['queue_depth'])
+        self.assertGreater(metrics['max_write_latency'], 0)
+
+    def test_send_error(self):
+        """
+        Test that a failed send is counted, not raised.
+        """
+        # Mocks
+        device = mock(devices.BaseDevice)
+        when(device).send(True, False).thenRaise(IOError('Test'))
+
+        # Execute
+        worker = devices.DeviceWorker(device=device)
+        worker.start()
+        worker.send(True, False)
+        worker.stop()
+
+        # Test
+        metrics = worker.get_metrics()
+        self.assertEqual(0, metrics['writes'])
+        self.assertEqual(1, metrics['write_errors'])
+
+
+def _get_animation_threads():
+    """
+    Get the animation engines' live timer threads.
+
+    :return: A list of threads.
+    """
+    return [thread for thread in threading.enumerate() if thread.name == devices.AnimationEngine.__name__]
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,159 @@
+# Copyright 2013 Pieter Rautenbach
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=too-many-locals
+# pylint: disable=invalid-name
+# pylint: disable=too-many-statements
+# pylint: disable=too-many-public-methods
+# pylint: disable=too-many-instance-attributes
+# pylint: disable=duplicate-code
+# pylint: disable=too-many-public-methods
+
+"""
+Fake TeamCity server tests.
+"""
+
+# System imports
+import logging.config
+import unittest
+
+# Local imports
+from whatsthatlight import clients
+from whatsthatlight import fake_teamcity
+
+
+class TestFakeTeamCity(unittest.TestCase):
+    """
+    Fake TeamCity server tests.
+    """
+
+    def setUp(self):
+        """
+        Test setup.
+        """
+        logging.config.fileConfig('../conf/build_light.ini')
+
+    def test_client(self):
+        """
+        Test that the client finds a build failed by its user, until the build type succeeds again.
+        """
+        # Test parameters
+        data = fake_teamcity.FakeTeamCityData(seed=1, nr_of_build_types=20, failure_rate=0.5, running_rate=0.0)
+        build_type_id = data.build_types[3]['id']
+
+        # Setup
+        server = fake_teamcity.FakeTeamCityServer(data=data)
+        client = clients.TeamCityClient(server_url=None, username='alice', password='secret')
+
+        # Execute
+        server.start()
+        try:
+            client.reconfigure(server.get_url(), 'alice', 'secret')
+            client.connect()
+            any_build_failures_before = client.any_build_failures()
+            data.add_build(build_type_id, 'FAILURE', username='alice')
+            any_build_failures = client.any_build_failures()
+            any_builds_running = client.any_builds_running()
+            data.add_build(build_type_id, 'SUCCESS')
+            any_build_failures_after = client.any_build_failures()
+            request_counts = server.get_request_counts()
+        finally:
+            client.disconnect()
+            server.stop()
+
+        # Test
+        self.assertFalse(any_build_failures_before)
+        self.assertTrue(any_build_failures)
+        self.assertFalse(any_builds_running)
+        self.assertFalse(any_build_failures_after)
+        self.assertEqual(3, request_counts['/httpAuth/app/rest/buildTypes'])
+        self.assertEqual(1, request_counts['/httpAuth/app/rest/builds/?locator=personal:false,canceled:false,'
+                                           'running:true'])
+
+    def test_locator_fields_and_paging(self):
+        """
+        Test that locators, fields and paging are honoured.
+        """
+        # Setup
+        data = fake_teamcity.FakeTeamCityData(seed=2, nr_of_build_types=5, nr_of_changes_per_build=3)
+        server = fake_teamcity.FakeTeamCityServer(data=data)
+        build_type_id = data.build_types[0]['id']
+        build_id = data.start_build(build_type_id, username='bob')
+
+        # Execute
+        (_, page) = server.handle('/httpAuth/app/rest/buildTypes?locator=count:2,start:1&fields=count,buildType(id)')
+        (_, running_builds) = server.handle('/httpAuth/app/rest/builds/?locator=running:true,buildType:(id:{0})'
+                                            .format(build_type_id))
+        (_, build) = server.handle('/httpAuth/app/rest/builds/id:{0}'.format(build_id))
+        (_, changes) = server.handle(build['changes']['href'])
+        (_, change) = server.handle(changes['change'][0]['href'])
+        data.finish_build(build_id, 'FAILURE')
+        (_, failed_builds) = server.handle('/httpAuth/app/rest/builds/?locator=buildType:{0},status:FAILURE,'
+                                           'running:any,sinceBuild:status:SUCCESS'.format(build_type_id))
+        (status, _) = server.handle('/httpAuth/app/rest/builds/id:999999')
+
+        # Test
+        self.assertDictEqual({'count': 2, 'buildType': [{'id': data.build_types[1]['id']},
+                                                        {'id': data.build_types[2]['id']}]}, page)
+        self.assertListEqual([build_id], [running_build['id'] for running_build in running_builds['build']])
+        self.assertEqual('bob', build['triggered']['user']['username'])
+        self.assertEqual(build_type_id, build['buildType']['id'])
+        self.assertEqual(3, changes['count'])
+        self.assertIn(change['user']['username'], data.get_users())
+        self.assertIn(build_id, [failed_build['id'] for failed_build in failed_builds['build']])
+        self.assertEqual(404, status)
+
+    def test_paging_links(self):
+        """
+        Test that every page links to the next, and that the pages add up to the whole list.
+        """
+        # Setup
+        data = fake_teamcity.FakeTeamCityData(seed=3, nr_of_build_types=5)
+        server = fake_teamcity.FakeTeamCityServer(data=data)
+
+        # Execute
+        build_type_ids = []
+        resource = '/httpAuth/app/rest/buildTypes?locator=count:2'
+        while resource:
+            (_, page) = server.handle(resource)
+            build_type_ids.extend(build_type['id'] for build_type in page['buildType'])
+            resource = page.get('nextHref')
+
+        # Test
+        self.assertListEqual([build_type['id'] for build_type in data.build_types], build_type_ids)
+
+    def test_seeded_data_and_errors(self):
+        """
+        Test that the same seed generates the same data, and that errors are injected.
+        """
+        # Setup
+        data = fake_teamcity.FakeTeamCityData(seed=4, nr_of_build_types=50)
+        same_data = fake_teamcity.FakeTeamCityData(seed=4, nr_of_build_types=50)
+        server = fake_teamcity.FakeTeamCityServer(data=data, error_rate=1.0)
+
+        # Execute
+        (status, _) = server.handle('/httpAuth/app/rest/buildTypes')
+        server.set_error_rate(0.0)
+        (other_status, _) = server.handle('/httpAuth/app/rest/buildTypes')
+
+        # Test
+        self.assertEqual(data.get_builds({'running': 'any'}), same_data.get_builds({'running': 'any'}))
+        self.assertEqual(data.get_change(1001), same_data.get_change(1001))
+        self.assertEqual(500, status)
+        self.assertEqual(200, other_status)
+        self.assertDictEqual({'/httpAuth/app/rest/buildTypes': 2}, server.get_request_counts())
+
+
+if __name__ == '__main__':
+    unittest.main()
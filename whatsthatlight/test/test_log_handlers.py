@@ -0,0 +1,129 @@
+# Copyright 2013 Pieter Rautenbach
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=too-many-locals
+# pylint: disable=invalid-name
+# pylint: disable=too-many-statements
+# pylint: disable=too-many-public-methods
+# pylint: disable=too-many-instance-attributes
+# pylint: disable=duplicate-code
+# pylint: disable=too-many-public-methods
+
+"""
+Asynchronous logging tests.
+"""
+
+# System imports
+import logging
+import logging.config
+import Queue
+import threading
+import unittest
+
+# Local imports
+from whatsthatlight import log_handlers
+
+
+class _RecordingHandler(logging.Handler):
+    """
+    A handler that records the messages it writes, and the thread it writes them on.
+    """
+
+    def __init__(self, level=logging.NOTSET):
+        """
+        Constructor.
+
+        :param level: The handler's level.
+        """
+        logging.Handler.__init__(self, level=level)
+        self.messages = []
+        self.thread_names = set()
+
+    def emit(self, record):
+        """
+        Record a message.
+
+        :param record: The log record.
+        """
+        self.messages.append(record.getMessage())
+        self.thread_names.add(threading.current_thread().name)
+
+
+class TestLogHandlers(unittest.TestCase):
+    """
+    Asynchronous logging tests.
+    """
+
+    def setUp(self):
+        """
+        Test setup.
+        """
+        logging.config.fileConfig('../conf/build_light.ini')
+
+    def test_enqueue_handlers(self):
+        """
+        Test that records are written by the configured handlers on the listener's thread, in order, with their levels.
+        """
+        # Test parameters
+        handler = _RecordingHandler(level=logging.INFO)
+        logger = logging.getLogger('test_log_handlers')
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(handler)
+        arguments = [1]
+
+        # Execute
+        listener = log_handlers.enqueue_handlers()
+        try:
+            logger.info('Message %s', arguments)
+            # The message is merged before the arguments change
+            arguments.append(2)
+            logger.debug('Ignored')
+            logger.warning('Message %d', 3)
+        finally:
+            listener.stop()
+            logger.handlers = []
+
+        # Test
+        self.assertListEqual(['Message [1]', 'Message 3'], handler.messages)
+        self.assertSetEqual(set(['QueueListener']), handler.thread_names)
+
+    def test_full_queue(self):
+        """
+        Test that a record is dropped rather than blocking when the queue is full.
+        """
+        # Test parameters
+        handler = _RecordingHandler()
+        queue_handler = log_handlers.QueueHandler(Queue.Queue(1), handler)
+        logger = logging.getLogger('test_full_queue')
+        logger.propagate = False
+        logger.addHandler(queue_handler)
+
+        # Execute: Nothing writes the queued records yet
+        try:
+            logger.warning('Queued')
+            logger.warning('Dropped')
+            listener = log_handlers.QueueListener(queue_handler.queue)
+            listener.start()
+            listener.stop()
+        finally:
+            logger.handlers = []
+
+        # Test
+        self.assertEqual(1, queue_handler.nr_of_dropped_records)
+        self.assertListEqual(['Queued'], handler.messages)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+# Copyright 2013 Pieter Rautenbach
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=too-many-locals
+# pylint: disable=invalid-name
+# pylint: disable=too-many-statements
+# pylint: disable=too-many-public-methods
+# pylint: disable=too-many-instance-attributes
+# pylint: disable=duplicate-code
+# pylint: disable=too-many-public-methods
+
+"""
+Metrics tests.
+"""
+
+# System imports
+import logging.config
+import unittest
+import urllib2
+
+# Third-party imports
+from mockito import mock
+
+# Local imports
+from whatsthatlight import clients
+from whatsthatlight import controllers
+from whatsthatlight import devices
+from whatsthatlight import fake_teamcity
+from whatsthatlight import metrics
+from whatsthatlight import monitors
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Metrics tests.
+    """
+
+    def setUp(self):
+        """
+        Test setup.
+        """
+        logging.config.fileConfig('../conf/build_light.ini')
+
+    def test_histogram(self):
+        """
+        Test that values are counted in the bucket of the smallest bound they don't exceed.
+        """
+        # Setup
+        histogram = metrics.Histogram(buckets=(0.1, 1.0))
+
+        # Execute
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+
+        # Test
+        self.assertListEqual([(0.1, 2), (1.0, 3), (float('inf'), 4)], histogram.get_buckets())
+        self.assertEqual(4, histogram.get_count())
+        self.assertAlmostEqual(2.65, histogram.get_sum())
+
+    def test_instrument(self):
+        """
+        Test that the application's metrics are rendered in the Prometheus text format.
+        """
+        # Mocks
+        client = clients.TeamCityClient(server_url='http://localhost/', username='alice', password=None)
+        server_monitor = monitors.ServerMonitor(client=client)
+        device_worker = devices.DeviceWorker(device=mock())
+        controller = controllers.Controller(device=device_worker, device_monitor=mock())
+
+        # Setup
+        registry = metrics.MetricsRegistry()
+        metrics.instrument(registry=registry,
+                           client=client,
+                           server_monitor=server_monitor,
+                           device_controllers=[controller],
+                           device_workers=[device_worker],
+                           device_names=['office'])
+
+        # Execute
+        controller.update(False, True)
+        text = registry.render()
+
+        # Test
+        lines = text.splitlines()
+        self.assertIn('# TYPE whatsthatlight_check_duration_seconds histogram', lines)
+        self.assertIn('whatsthatlight_check_duration_seconds_count 0', lines)
+        self.assertIn('whatsthatlight_cache_hit_ratio NaN', lines)
+        self.assertIn('whatsthatlight_device_connected{device="office"} 0', lines)
+        self.assertIn('whatsthatlight_device_write_errors_total{device="office"} 0', lines)
+        self.assertIn('whatsthatlight_build_state{device="office",state="failure"} 1', lines)
+        self.assertIn('whatsthatlight_build_state{device="office",state="success"} 0', lines)
+        self.assertTrue(any(line.startswith('whatsthatlight_threads ') for line in lines))
+
+    def test_request_metrics(self):
+        """
+        Test that requests are aggregated by endpoint, and collected with the cache lookups.
+        """
+        # Setup
+        request_metrics = metrics.RequestMetrics(latency_buckets=(0.1,), size_buckets=(1024,))
+        registry = metrics.MetricsRegistry()
+        registry.add_collector(request_metrics.collect)
+
+        # Execute
+        request_metrics.observe_request('/builds/id:{id}', 'build detail', 200, 512, 0.01, 0.02, 0.001)
+        request_metrics.observe_request('/builds/id:{id}', 'build detail', 200, 2048, 0.1, 0.2, 0.002)
+        request_metrics.observe_request('/builds/id:{id}', 'build detail', 404, 10, 0.01, 0.01, 0.0)
+        request_metrics.observe_cache('build detail', True)
+        request_metrics.observe_cache('build detail', True)
+        request_metrics.observe_cache('build detail', False)
+        lines = registry.render().splitlines()
+
+        # Test
+        labels = 'endpoint="/builds/id:{id}",kind="build detail"'
+        self.assertDictEqual({'hits': 2, 'misses': 1}, request_metrics.get_cache_counts())
+        self.assertIn('whatsthatlight_requests_total{' + labels + ',status="200"} 2', lines)
+        self.assertIn('whatsthatlight_requests_total{' + labels + ',status="404"} 1', lines)
+        self.assertIn('whatsthatlight_request_duration_seconds_bucket{' + labels + ',le="0.1"} 2', lines)
+        self.assertIn('whatsthatlight_request_first_byte_seconds_bucket{' + labels + ',le="0.1"} 3', lines)
+        self.assertIn('whatsthatlight_response_decode_seconds_count{' + labels + '} 3', lines)
+        self.assertIn('whatsthatlight_response_size_bytes_bucket{' + labels + ',le="1024"} 2', lines)
+        self.assertIn('whatsthatlight_cache_hits_total{kind="build detail"} 2', lines)
+        self.assertIn('whatsthatlight_cache_misses_total{kind="build detail"} 1', lines)
+        self.assertEqual(1, lines.count('# TYPE whatsthatlight_requests_total counter'))
+
+    def test_failed_requests(self):
+        """
+        Test that requests that fail, or whose response isn't JSON, are observed with their status.
+        """
+        # Setup
+        data = fake_teamcity.FakeTeamCityData(seed=1, nr_of_build_types=1)
+        server = fake_teamcity.FakeTeamCityServer(data=data, error_rate=1.0)
+        client = clients.TeamCityClient(server_url=None, username='alice', password='secret')
+        request_metrics = metrics.RequestMetrics()
+        client.set_request_hook(request_metrics)
+        registry = metrics.MetricsRegistry()
+        registry.add_collector(request_metrics.collect)
+
+        # Execute
+        server.start()
+        try:
+            client.reconfigure(server.get_url(), 'alice', 'secret')
+            client.connect()
+            with self.assertRaises(ValueError):
+                client.any_builds_running()
+        finally:
+            server.stop()
+        # A new session, as a kept-open connection is still served after the server stopped
+        client.disconnect()
+        client.connect()
+        with self.assertRaises(IOError):
+            client.any_builds_running()
+        client.disconnect()
+        lines = registry.render().splitlines()
+
+        # Test
+        labels = 'endpoint="/httpAuth/app/rest/builds/?locator=personal:false,canceled:false,running:true",kind="builds"'
+        self.assertIn('whatsthatlight_requests_total{' + labels + ',status="500"} 1', lines)
+        self.assertIn('whatsthatlight_requests_total{' + labels + ',status="error"} 1', lines)
+        self.assertIn('whatsthatlight_response_size_bytes_count{' + labels + '} 2', lines)
+
+    def test_serve_metrics(self):
+        """
+        Test that the metrics are served over HTTP, and only at their path.
+        """
+        # Setup
+        histogram = metrics.Histogram(buckets=(1.0,))
+        histogram.observe(0.5)
+        registry = metrics.MetricsRegistry()
+        registry.add_histogram('test_seconds', 'A test histogram.', histogram)
+        registry.add_gauge('test_value', 'A test gauge.', lambda: 1.5, {'name': 'a "quoted" name'})
+        metrics_server = metrics.MetricsServer(registry=registry, port=0, host='127.0.0.1')
+
+        # Execute
+        metrics_server.start()
+        try:
+            url = 'http://127.0.0.1:{0}'.format(metrics_server.get_port())
+            response = urllib2.urlopen(url + '/metrics')
+            content_type = response.info().getheader('Content-Type')
+            text = response.read()
+            with self.assertRaises(urllib2.HTTPError) as context:
+                urllib2.urlopen(url + '/')
+        finally:
+            metrics_server.stop()
+
+        # Test
+        self.assertTrue(content_type.startswith('text/plain; version=0.0.4'))
+        self.assertEqual(404, context.exception.code)
+        self.assertEqual('# HELP test_seconds A test histogram.\n'
+                         '# TYPE test_seconds histogram\n'
+                         'test_seconds_bucket{le="1.0"} 1\n'
+                         'test_seconds_bucket{le="+Inf"} 1\n'
+                         'test_seconds_sum 0.5\n'
+                         'test_seconds_count 1\n'
+                         '# HELP test_value A test gauge.\n'
+                         '# TYPE test_value gauge\n'
+                         'test_value{name="a \\"quoted\\" name"} 1.5\n',
+                         text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -27,6 +27,7 @@ Tests for various monitors.
 
 # System imports
 import logging.config
+import Queue
 import threading
 import unittest
 
@@ -124,6 +125,203 @@ class TestDeviceMonitor(unittest.TestCase):
         self.assertTrue(wait_event.is_set(), 'The expected number of events were not triggered')
         self.assertListEqual(expected_events, actual_events, 'Unexpected events or events order')
 
+    def test_probe_by_enumeration(self):
+        """
+        Test that the device is never opened when probing by enumeration.
+        """
+        # Test parameters
+        nr_of_events = 3
+        actual_events = []
+        expected_events = ['added', 'removed', 'added']
+        polling_interval = 0.05
+
+        # Mocks
+        device = mock(devices.BaseDevice)
+        when(device).probe().thenReturn(False).thenReturn(True).thenReturn(False).thenReturn(True)
+        when(device).open().thenRaise(AssertionError('The device must not be opened'))
+
+        # Setup
+        wait_event = threading.Event()
+        device_monitor = monitors.DeviceMonitor(device=device,
+                                                polling_interval=polling_interval,
+                                                probe_by_enumeration=True)
+
+        # Handlers
+        def handler(name):
+            """
+            Create a device event handler.
+
+            :param name: The event name.
+            :return: The handler.
+            """
+            def _handler():
+                """
+                A device event handler.
+                """
+                actual_events.append(name)
+                if len(actual_events) == nr_of_events:
+                    wait_event.set()
+            return _handler
+
+        # Execute
+        device_monitor.set_added_handler(handler('added'))
+        device_monitor.set_removed_handler(handler('removed'))
+        device_monitor.start()
+        wait_event.wait(20 * polling_interval)
+        device_monitor.stop()
+
+        # Test
+        self.assertTrue(wait_event.is_set(), 'The expected number of events were not triggered')
+        self.assertListEqual(expected_events, actual_events, 'Unexpected events or events order')
+
+    def test_back_off(self):
+        """
+        Test that polling backs off while the device is absent.
+        """
+        # Test parameters
+        polling_interval = 0.02
+        max_polling_interval = 0.16
+        duration = 0.5
+        probes = []
+
+        # Mocks
+        device = mock(devices.BaseDevice)
+
+        def probe():
+            """
+            Record a probe for an absent device.
+
+            :return: False.
+            """
+            probes.append(None)
+            return False
+        device.probe = probe
+
+        # Execute
+        device_monitor = monitors.DeviceMonitor(device=device,
+                                                polling_interval=polling_interval,
+                                                probe_by_enumeration=True,
+                                                max_polling_interval=max_polling_interval)
+        device_monitor.start()
+        threading.Event().wait(duration)
+        device_monitor.stop()
+
+        # Test: 0.04 + 0.08 + 0.16 + 0.16 + ... means about 5 probes, versus 25 without back-off
+        self.assertLess(len(probes), 8)
+        self.assertGreater(len(probes), 2)
+
+
+class TestHotplugDeviceMonitor(unittest.TestCase):
+    """
+    Hotplug device monitor tests.
+    """
+
+    def setUp(self):
+        """
+        Test setup.
+        """
+        logging.config.fileConfig('../conf/build_light.ini')
+
+    @staticmethod
+    def _create_device():
+        """
+        Create a mock device that is not plugged in initially.
+
+        :return: A mock device.
+        """
+        device = mock(devices.BaseDevice)
+        when(device).get_vendor_id().thenReturn(0x27b8)
+        when(device).get_product_id().thenReturn(0x01ed)
+        when(device).open().thenRaise(IOError()).thenReturn(None)
+        return device
+
+    def test_added_removed(self):
+        """
+        Test that only matching add and remove events trigger the handlers.
+        """
+        # Test parameters
+        nr_of_events = 3
+        actual_events = []
+        expected_events = ['added', 'removed', 'added']
+        hidraw_path = '/devices/pci0000:00/0000:00:14.0/usb1/1-1/1-1:1.0/0003:27B8:01ED.0001/hidraw/hidraw0'
+        other_hidraw_path = '/devices/pci0000:00/0000:00:14.0/usb1/1-2/1-2:1.0/0003:046D:C52B.0002/hidraw/hidraw1'
+
+        # Setup
+        wait_event = threading.Event()
+        event_source = _FakeEventSource()
+        device_monitor = monitors.HotplugDeviceMonitor(device=self._create_device(), event_source=event_source)
+
+        # Handlers
+        def added():
+            """
+            A device added handler.
+            """
+            actual_events.append('added')
+            if len(actual_events) == nr_of_events:
+                wait_event.set()
+
+        def removed():
+            """
+            A device removed handler.
+            """
+            actual_events.append('removed')
+            if len(actual_events) == nr_of_events:
+                wait_event.set()
+
+        # Execute
+        device_monitor.set_added_handler(added)
+        device_monitor.set_removed_handler(removed)
+        device_monitor.start()
+        event_source.put({'ACTION': 'add', 'SUBSYSTEM': 'hidraw', 'DEVPATH': other_hidraw_path})
+        event_source.put({'ACTION': 'add', 'SUBSYSTEM': 'hidraw', 'DEVPATH': hidraw_path})
+        event_source.put({'ACTION': 'add', 'SUBSYSTEM': 'hidraw', 'DEVPATH': hidraw_path})
+        event_source.put({'ACTION': 'remove', 'SUBSYSTEM': 'hidraw', 'DEVPATH': other_hidraw_path})
+        event_source.put({'ACTION': 'remove', 'SUBSYSTEM': 'hidraw', 'DEVPATH': hidraw_path})
+        event_source.put({'ACTION': 'add', 'SUBSYSTEM': 'hidraw', 'DEVPATH': hidraw_path})
+        wait_event.wait(1)
+        device_monitor.stop()
+
+        # Test
+        self.assertTrue(wait_event.is_set(), 'The expected number of events were not triggered')
+        self.assertListEqual(expected_events, actual_events, 'Unexpected events or events order')
+        self.assertTrue(event_source.closed)
+
+    def test_usb_subsystem(self):
+        """
+        Test matching USB device events for the libusb backend.
+        """
+        # Setup
+        wait_event = threading.Event()
+        event_source = _FakeEventSource()
+        device_monitor = monitors.HotplugDeviceMonitor(device=self._create_device(),
+                                                       event_source=event_source,
+                                                       subsystem=monitors.HotplugDeviceMonitor.USB_SUBSYSTEM)
+
+        # Execute
+        device_monitor.set_added_handler(wait_event.set)
+        device_monitor.start()
+        event_source.put({'ACTION': 'add', 'SUBSYSTEM': 'usb', 'DEVTYPE': 'usb_interface', 'PRODUCT': '27b8/1ed/2'})
+        event_source.put({'ACTION': 'add', 'SUBSYSTEM': 'usb', 'DEVTYPE': 'usb_device', 'PRODUCT': '46d/c52b/1201'})
+        self.assertFalse(wait_event.wait(0.2))
+        event_source.put({'ACTION': 'add', 'SUBSYSTEM': 'usb', 'DEVTYPE': 'usb_device', 'PRODUCT': '27b8/1ed/2'})
+        wait_event.wait(1)
+        device_monitor.stop()
+
+        # Test
+        self.assertTrue(wait_event.is_set(), 'The added event was not triggered')
+
+    def test_parse(self):
+        """
+        Test parsing kernel uevent messages.
+        """
+        # Test parameters
+        message = 'add@/devices/hidraw/hidraw0\0ACTION=add\0DEVPATH=/devices/hidraw/hidraw0\0SUBSYSTEM=hidraw\0SEQNUM=1\0'
+        expected_event = {'ACTION': 'add', 'DEVPATH': '/devices/hidraw/hidraw0', 'SUBSYSTEM': 'hidraw', 'SEQNUM': '1'}
+
+        # Test
+        self.assertDictEqual(expected_event, monitors.NetlinkEventSource.parse(message))
+        self.assertIsNone(monitors.NetlinkEventSource.parse('libudev\0\xfe\xed'))
+
 
 class TestServerMonitor(unittest.TestCase):
     """
@@ -228,6 +426,107 @@ class TestServerMonitor(unittest.TestCase):
         self.assertEqual(actual_any_builds_running, expected_any_builds_running)
         self.assertEqual(actual_any_build_failures, expected_any_build_failures)
 
+    def test_connect_exception(self):
+        """
+        Test that a failed connection is retried with an unknown state meanwhile, and that a failing handler doesn't
+        stop the monitor.
+        """
+        # Test parameters
+        polling_interval = 0.02
+        nr_of_failed_connections = 2
+
+        # Callback closure
+        server_events = []
+        event = threading.Event()
+        connections = []
+
+        def connect():
+            """
+            Connect, failing the first few times.
+            """
+            connections.append(True)
+            if len(connections) <= nr_of_failed_connections:
+                raise IOError('Name or service not known')
+
+        def handler(any_builds_running, any_build_failures):
+            """
+            Test handler, which fails once the server is checked.
+
+            :param any_builds_running: True if any builds running. None if unknown or undefined.
+            :param any_build_failures: True if any builds failing or failed. None if unknown or undefined.
+            """
+            server_events.append((any_builds_running, any_build_failures))
+            if server_events.count((False, True)) == 2:
+                event.set()
+            if any_build_failures is not None:
+                raise ValueError('Test exception')
+
+        # Mocks
+        client = mock(clients.TeamCityClient)
+        client.connect = connect
+        when(client).any_builds_running().thenReturn(False)
+        when(client).any_build_failures().thenReturn(True)
+
+        # Execute
+        server_monitor = monitors.ServerMonitor(client=client,
+                                                polling_interval=polling_interval)
+        server_monitor.set_handler(handler)
+        server_monitor.start()
+        event.wait(50 * polling_interval)
+        server_monitor.stop()
+
+        # Test
+        self.assertTrue(event.is_set(), 'Timeout')
+        self.assertEqual(nr_of_failed_connections + 1, len(connections))
+        self.assertListEqual([(None, None)] * nr_of_failed_connections + [(False, True)] * 2, server_events[:4])
+
+
+class _FakeEventSource(object):
+    """
+    A uevent source that is fed by the test.
+    """
+
+    def __init__(self):
+        """
+        Constructor.
+        """
+        self._events = Queue.Queue()
+        self.closed = False
+
+    def put(self, event):
+        """
+        Queue an event.
+
+        :param event: A dictionary of uevent properties.
+        """
+        self._events.put(event)
+
+    def open(self):
+        """
+        Open the source.
+        """
+        self.closed = False
+
+    def wait(self):
+        """
+        Block until an event is queued.
+
+        :return: The event, or None if interrupted.
+        """
+        return self._events.get()
+
+    def interrupt(self):
+        """
+        Interrupt a blocking wait.
+        """
+        self._events.put(None)
+
+    def close(self):
+        """
+        Close the source.
+        """
+        self.closed = True
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,180 @@
+# Copyright 2013 Pieter Rautenbach
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=too-many-locals
+# pylint: disable=invalid-name
+# pylint: disable=too-many-statements
+# pylint: disable=too-many-public-methods
+# pylint: disable=too-many-instance-attributes
+# pylint: disable=duplicate-code
+# pylint: disable=too-many-public-methods
+
+"""
+Profiling tests.
+"""
+
+# System imports
+import logging.config
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import threading
+import unittest
+
+# Local imports
+from whatsthatlight import profiling
+
+
+class TestStartupProfiler(unittest.TestCase):
+    """
+    Startup profiler tests.
+    """
+
+    def setUp(self):
+        """
+        Test setup.
+        """
+        logging.config.fileConfig('../conf/build_light.ini')
+
+    def test_imports_and_phases(self):
+        """
+        Test that new imports and phases are timed and reported, and that repeated imports aren't.
+        """
+        # Test parameters
+        times = iter([0.0, 1.0, 1.5, 2.0, 2.25, 3.0, 3.5])
+        stream = StringIO.StringIO()
+        sys.modules.pop('colorsys', None)
+
+        # Execute
+        profiler = profiling.StartupProfiler(clock=lambda: next(times))
+        profiler.install()
+        try:
+            # pylint: disable=unused-variable
+            import colorsys
+            import logging
+            # pylint: enable=unused-variable
+        finally:
+            profiler.uninstall()
+        profiler.mark('imports')
+        profiler.mark('start')
+        profiler.report(stream)
+
+        # Test
+        self.assertListEqual([(0, 'colorsys', 0.5, 0.5)], profiler.get_imports())
+        self.assertListEqual([('imports', 0.0, 3.0), ('start', 3.0, 0.5)], profiler.get_phases())
+        self.assertIn('import time:    500000 |     500000 | colorsys', stream.getvalue())
+
+
+class TestCycleProfiler(unittest.TestCase):
+    """
+    Cycle profiler and thread stack tests.
+    """
+
+    def setUp(self):
+        """
+        Test setup.
+        """
+        logging.config.fileConfig('../conf/build_light.ini')
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Test teardown.
+        """
+        shutil.rmtree(self._directory)
+
+    def test_profile_requested_cycles(self):
+        """
+        Test that only the requested checks are profiled, and that the profile is written once they are done.
+        """
+        # Setup
+        profiler = profiling.CycleProfiler(directory=self._directory)
+
+        # Execute
+        profiler.begin_cycle()
+        _check()
+        unrequested_paths = profiler.end_cycle()
+        self.assertTrue(profiler.request(2))
+        self.assertFalse(profiler.request(2))
+        results = []
+        for _ in range(2):
+            profiler.begin_cycle()
+            _check()
+            results.append(profiler.end_cycle())
+
+        # Test
+        self.assertIsNone(unrequested_paths)
+        self.assertIsNone(results[0])
+        (stats_path, summary_path) = results[1]
+        self.assertTrue(os.path.isfile(stats_path))
+        with open(summary_path) as summary_file:
+            summary = summary_file.read()
+        self.assertIn('2 checks', summary)
+        self.assertIn('_check', summary)
+        self.assertTrue(profiler.request(1))
+
+    def test_profile_directory_missing(self):
+        """
+        Test that a profile that can't be written is dropped, and that checks can be profiled again.
+        """
+        # Setup
+        profiler = profiling.CycleProfiler(directory=os.path.join(self._directory, 'missing'))
+
+        # Execute
+        profiler.request(1)
+        profiler.begin_cycle()
+        _check()
+        paths = profiler.end_cycle()
+
+        # Test
+        self.assertIsNone(paths)
+        self.assertTrue(profiler.request(1))
+
+    def test_dump_thread_stacks(self):
+        """
+        Test that the stack of every thread is written.
+        """
+        # Test parameters
+        started_event = threading.Event()
+        event = threading.Event()
+        thread = threading.Thread(target=lambda: started_event.set() or event.wait(), name='Waiter')
+
+        # Execute
+        thread.start()
+        started_event.wait(1)
+        try:
+            path = profiling.dump_thread_stacks(self._directory)
+        finally:
+            event.set()
+            thread.join()
+
+        # Test
+        with open(path) as stacks_file:
+            stacks = stacks_file.read()
+        self.assertIn('Thread Waiter', stacks)
+        self.assertIn('Thread MainThread', stacks)
+        self.assertIn('event.wait()', stacks)
+
+
+def _check():
+    """
+    A stand-in for a check of the build server, to find in a profile.
+    """
+    return sum(range(1000))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# Copyright 2013 Pieter Rautenbach
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=too-many-locals
+# pylint: disable=invalid-name
+# pylint: disable=too-many-statements
+# pylint: disable=too-many-public-methods
+# pylint: disable=too-many-instance-attributes
+# pylint: disable=duplicate-code
+# pylint: disable=too-many-public-methods
+
+"""
+Routing rules tests.
+"""
+
+# System imports
+import logging.config
+import unittest
+
+# Local imports
+from whatsthatlight import clients
+from whatsthatlight import routing
+
+
+class TestRoutingRules(unittest.TestCase):
+    """
+    Routing rules tests.
+    """
+
+    def setUp(self):
+        """
+        Test setup.
+        """
+        logging.config.fileConfig('../conf/build_light.ini')
+
+    def test_include_exclude(self):
+        """
+        Test including and excluding by project, build type glob and tag.
+        """
+        rules = routing.RoutingRules.create({'include': ['project:Backend', 'build_type:Frontend_*'],
+                                             'exclude': ['build_type:Backend_Nightly', 'tag:experimental']})
+
+        # Build types
+        self.assertTrue(rules.matches_build_type('Backend_Test', 'Backend'))
+        self.assertTrue(rules.matches_build_type('Frontend_Test', 'Frontend'))
+        self.assertFalse(rules.matches_build_type('Backend_Nightly', 'Backend'))
+        self.assertFalse(rules.matches_build_type('Docs_Build', 'Docs'))
+
+        # Builds
+        self.assertTrue(rules.matches_build('Backend_Test', 'Backend', frozenset(['release'])))
+        self.assertFalse(rules.matches_build('Backend_Test', 'Backend', frozenset(['experimental'])))
+        self.assertFalse(rules.matches_build('Docs_Build', 'Docs'))
+
+    def test_include_tags(self):
+        """
+        Test that build types aren't pruned when builds may be included by their tags.
+        """
+        rules = routing.RoutingRules(include=['project:Backend', 'tag:release'])
+        self.assertTrue(rules.matches_build_type('Docs_Build', 'Docs'))
+        self.assertTrue(rules.matches_build('Docs_Build', 'Docs', frozenset(['release'])))
+        self.assertFalse(rules.matches_build('Docs_Build', 'Docs', frozenset(['nightly'])))
+
+    def test_invalid(self):
+        """
+        Test that invalid rules are rejected, and that no rules route everything.
+        """
+        self.assertIsNone(routing.RoutingRules.create(None))
+        self.assertRaises(ValueError, routing.RoutingRules.create, {'include': ['branch:master']})
+        self.assertRaises(ValueError, routing.RoutingRules.create, {'include': ['project']})
+        self.assertRaises(ValueError, routing.RoutingRules.create, {'only': ['project:Backend']})
+
+    def test_client_prunes_build_types(self):
+        """
+        Test that the client never requests the failed builds of excluded build types.
+        """
+        # Test parameters
+        resources = {
+            '/buildTypes': {'count': 2, 'buildType': [{'id': 'Backend_Test', 'projectId': 'Backend'},
+                                                      {'id': 'Docs_Build', 'projectId': 'Docs'}]},
+            '/failed/Backend_Test': {'count': 0},
+        }
+        requested_resources = []
+
+        # Mocks
+        client = clients.TeamCityClient(server_url=None, username='alice', password=None)
+        client._BUILD_TYPES_RESOURCE = '/buildTypes'
+        client._BUILD_TYPE_RESOURCE_TEMPLATE = '/failed/{build_type_id}'
+        client._get_resource = lambda resource: requested_resources.append(resource) or resources[resource]
+        client.set_rules(routing.RoutingRules(include=['project:Backend']))
+
+        # Execute
+        any_build_failures = client.any_build_failures()
+
+        # Test
+        self.assertFalse(any_build_failures)
+        self.assertListEqual(['/buildTypes', '/failed/Backend_Test'], requested_resources)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+# Copyright 2013 Pieter Rautenbach
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=too-many-locals
+# pylint: disable=invalid-name
+# pylint: disable=too-many-statements
+# pylint: disable=too-many-public-methods
+# pylint: disable=too-many-instance-attributes
+# pylint: disable=duplicate-code
+# pylint: disable=too-many-public-methods
+
+"""
+Tracing tests.
+"""
+
+# System imports
+import datetime
+import json
+import logging.config
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+# Local imports
+from whatsthatlight import clients
+from whatsthatlight import monitors
+from whatsthatlight import tracing
+
+
+class _Response(object):
+    """
+    A response of the fake session.
+    """
+
+    def __init__(self, data):
+        """
+        Constructor.
+
+        :param data: The JSON data.
+        """
+        self._data = data
+        self.content = json.dumps(data)
+        self.status_code = 200
+        self.elapsed = datetime.timedelta(milliseconds=1)
+
+    def json(self):
+        """
+        Get the JSON data.
+
+        :return: The data.
+        """
+        return self._data
+
+
+class _Session(object):
+    """
+    A fake session, which serves resources from a dictionary.
+    """
+
+    def __init__(self, resources):
+        """
+        Constructor.
+
+        :param resources: A dictionary of JSON data by resource.
+        """
+        self._resources = resources
+
+    def get(self, url):
+        """
+        Get a resource.
+
+        :param url: The URL of the resource.
+        :return: A response.
+        """
+        return _Response(self._resources[url[len('http://localhost'):]])
+
+
+class TestTracing(unittest.TestCase):
+    """
+    Tracing tests.
+    """
+
+    def setUp(self):
+        """
+        Test setup.
+        """
+        logging.config.fileConfig('../conf/build_light.ini')
+
+    def test_resource_kinds(self):
+        """
+        Test that resources are told apart by kind.
+        """
+        client = clients.TeamCityClient
+        self.assertEqual(client.BUILD_TYPES_KIND, client.get_resource_kind('/httpAuth/app/rest/buildTypes'))
+        self.assertEqual(client.BUILDS_KIND, client.get_resource_kind('/httpAuth/app/rest/builds/?locator=running:true'))
+        self.assertEqual(client.BUILD_DETAIL_KIND, client.get_resource_kind('/httpAuth/app/rest/builds/id:1'))
+        self.assertEqual(client.CHANGES_KIND, client.get_resource_kind('/httpAuth/app/rest/changes?locator=build:1'))
+        self.assertEqual(client.CHANGES_KIND, client.get_resource_kind('/httpAuth/app/rest/changes/id:2'))
+
+    def test_endpoints(self):
+        """
+        Test that the IDs in resources are normalised.
+        """
+        client = clients.TeamCityClient
+        self.assertEqual('/httpAuth/app/rest/builds/id:{id}', client.get_endpoint('/httpAuth/app/rest/builds/id:1234'))
+        self.assertEqual('/httpAuth/app/rest/changes?locator=build:(id:{id})',
+                         client.get_endpoint('/httpAuth/app/rest/changes?locator=build:(id:1234)'))
+        self.assertEqual('/httpAuth/app/rest/builds/?locator=buildType:{id},status:FAILURE,sinceBuild:status:SUCCESS',
+                         client.get_endpoint('/httpAuth/app/rest/builds/?locator=buildType:Backend_Test,'
+                                             'status:FAILURE,sinceBuild:status:SUCCESS'))
+        self.assertEqual('/httpAuth/app/rest/buildTypes', client.get_endpoint('/httpAuth/app/rest/buildTypes'))
+        self.assertEqual(client.BUILD_DETAIL_KIND,
+                         client.get_resource_kind(client.get_endpoint('/httpAuth/app/rest/builds/id:1234')))
+
+    def test_trace_checks(self):
+        """
+        Test that every check is traced to the file, and that the traces can be analysed.
+        """
+        # Test parameters
+        resources = {
+            '/builds/?locator=running:true': {'count': 0},
+            '/buildTypes': {'count': 1, 'buildType': [{'id': 'Backend_Test', 'projectId': 'Backend'}]},
+            '/builds/?locator=buildType:Backend_Test': {'count': 1, 'build': [{'id': 1, 'href': '/builds/id:1'}]},
+            '/builds/id:1': {'id': 1, 'buildTypeId': 'Backend_Test',
+                             'triggered': {'type': 'user', 'user': {'username': 'alice'}},
+                             'changes': {'href': '/changes?locator=build:1'}},
+            '/changes?locator=build:1': {'count': 0},
+        }
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'trace.jsonl')
+        event = threading.Event()
+        verdicts = []
+
+        # Mocks
+        client = clients.TeamCityClient(server_url='http://localhost/', username='alice', password=None)
+        client._RUNNING_BUILDS_RESOURCE = '/builds/?locator=running:true'
+        client._BUILD_TYPES_RESOURCE = '/buildTypes'
+        client._BUILD_TYPE_RESOURCE_TEMPLATE = '/builds/?locator=buildType:{build_type_id}'
+        client.connect = lambda: setattr(client, '_session', _Session(resources))
+
+        # Setup
+        trace_sink = tracing.TraceSink(path=path)
+        server_monitor = monitors.ServerMonitor(client=client, polling_interval=0.01)
+        server_monitor.set_handler(lambda *verdict: verdicts.append(verdict) or (len(verdicts) == 2 and event.set()))
+        server_monitor.set_trace_sink(trace_sink)
+
+        # Execute
+        try:
+            trace_sink.start()
+            server_monitor.start()
+            event.wait(1)
+            server_monitor.stop()
+            trace_sink.stop()
+            with open(path) as trace_file:
+                records = [json.loads(line) for line in trace_file]
+        finally:
+            shutil.rmtree(directory)
+
+        # Test
+        self.assertTrue(event.is_set(), 'Timeout')
+        self.assertEqual(len(verdicts), len(records))
+        record = records[0]
+        self.assertListEqual([False, True], record['verdict'])
+        self.assertEqual(5, record['nr_of_requests'])
+        self.assertEqual(sum(len(json.dumps(data)) for data in resources.values()), record['nr_of_bytes'])
+        self.assertListEqual(['builds', 'buildTypes', 'builds', 'build detail', 'changes'],
+                             [request[0] for request in record['requests']])
+        self.assertListEqual(['Backend_Test'], [build_type[0] for build_type in record['build_types']])
+        self.assertListEqual([[1, 'Backend_Test']], [build[:2] for build in record['builds']])
+        self.assertListEqual(['/builds/id:{id}', 200, 0.001], record['requests'][3][4:7])
+        analysis = tracing.analyse(records)
+        self.assertEqual(len(records), analysis['checks']['count'])
+        self.assertEqual('Backend_Test', analysis['build_types'][0]['name'])
+        request_counts = dict((kind['name'], kind['count']) for kind in analysis['kinds'])
+        self.assertEqual(2 * len(records), request_counts['builds'])
+        endpoint_counts = dict((endpoint['name'], endpoint['count']) for endpoint in analysis['endpoints'])
+        self.assertEqual(len(records), endpoint_counts['/builds/?locator=buildType:{id}'])
+
+
+if __name__ == '__main__':
+    unittest.main()
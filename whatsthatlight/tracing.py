@@ -0,0 +1,280 @@
+# Copyright 2013 Pieter Rautenbach
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Traces of checks of the build server, written as one JSON line per check, and their analysis.
+"""
+
+# System imports
+import json
+import Queue
+import threading
+import time
+
+
+class CycleTrace(object):
+    """
+    What happened during one check of the build server: The requests made, the build types and builds evaluated, the
+    cache hits and misses, and the verdict.
+    """
+
+    def __init__(self, clock=time.time):
+        """
+        Constructor. The check starts now.
+
+        :param clock: A function returning the current time in seconds.
+        """
+        self._clock = clock
+        self._started_at = clock()
+        self._duration = None
+        # Lists of [kind, resource, seconds, bytes, endpoint, status, first byte seconds, decode seconds]
+        self._requests = []
+        # Lists of [build_type_id, seconds, number of builds]
+        self._build_types = []
+        # Lists of [build_id, build_type_id, seconds]
+        self._builds = []
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._verdict = None
+        self._error = None
+
+    def add_request(self, kind, resource, seconds, nr_of_bytes, endpoint=None, status=None, first_byte_seconds=None,
+                    decode_seconds=None):
+        """
+        Add a request to the build server.
+
+        :param kind: The kind of resource, e.g. builds.
+        :param resource: The resource.
+        :param seconds: The time the request took.
+        :param nr_of_bytes: The size of the response body.
+        :param endpoint: The resource with IDs normalised, if known.
+        :param status: The HTTP status, if known.
+        :param first_byte_seconds: The time until the response's headers were received, if known.
+        :param decode_seconds: The time decoding the response took, if known.
+        """
+        self._requests.append([kind, resource, seconds, nr_of_bytes, endpoint, status, first_byte_seconds,
+                               decode_seconds])
+
+    def add_build_type(self, build_type_id, seconds, nr_of_builds):
+        """
+        Add a build type whose builds were requested.
+
+        :param build_type_id: The build type's ID.
+        :param seconds: The time requesting its builds took.
+        :param nr_of_builds: The number of builds found.
+        """
+        self._build_types.append([build_type_id, seconds, nr_of_builds])
+
+    def add_build(self, build_id, build_type_id, seconds):
+        """
+        Add a build that was evaluated.
+
+        :param build_id: The build's ID.
+        :param build_type_id: The ID of the build's build type, if known.
+        :param seconds: The time evaluating it took, including requests for its details and changes.
+        """
+        self._builds.append([build_id, build_type_id, seconds])
+
+    def add_cache_hit(self):
+        """
+        Count a build whose affected users were cached.
+        """
+        self._cache_hits += 1
+
+    def add_cache_miss(self):
+        """
+        Count a build whose affected users had to be requested.
+        """
+        self._cache_misses += 1
+
+    def set_verdict(self, any_builds_running, any_build_failures):
+        """
+        Set the outcome of the check.
+
+        :param any_builds_running: True if any builds running. None if unknown or undefined.
+        :param any_build_failures: True if any builds failing or failed. None if unknown or undefined.
+        """
+        self._verdict = [any_builds_running, any_build_failures]
+
+    def set_error(self, error):
+        """
+        Set the error the check failed with.
+
+        :param error: The exception.
+        """
+        self._error = str(error)
+
+    def finish(self):
+        """
+        End the check.
+        """
+        self._duration = self._clock() - self._started_at
+
+    def to_dict(self):
+        """
+        Get the trace as a dictionary, to serialise as JSON.
+
+        :return: A dictionary.
+        """
+        return {'start': self._started_at,
+                'duration': self._duration,
+                'nr_of_requests': len(self._requests),
+                'nr_of_bytes': sum(request[3] for request in self._requests),
+                'cache_hits': self._cache_hits,
+                'cache_misses': self._cache_misses,
+                'requests': self._requests,
+                'build_types': self._build_types,
+                'builds': self._builds,
+                'verdict': self._verdict,
+                'error': self._error}
+
+
+class TraceSink(object):
+    """
+    Writes traces to a file as JSON lines, buffered and on a background thread, so that a check is never held up by
+    file I/O. A trace is dropped, and counted, if too many are waiting to be written.
+    """
+
+    _STOP = None
+
+    def __init__(self, path, queue_size=1000, flush_interval=5):
+        """
+        Constructor.
+
+        :param path: The path of the file, which is appended to.
+        :param queue_size: The maximum number of traces waiting to be written.
+        :param flush_interval: The maximum time in seconds a written trace may stay in the file buffer.
+        """
+        self._path = path
+        self._queue = Queue.Queue(queue_size)
+        self._flush_interval = flush_interval
+        self._thread = None
+        self.nr_of_dropped_traces = 0
+
+    def start(self):
+        """
+        Start writing.
+        """
+        self._thread = threading.Thread(target=self._run, args=(open(self._path, 'a'),), name=self.__class__.__name__)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Write the traces waiting to be written, and stop.
+        """
+        if self._thread:
+            self._queue.put(self._STOP)
+            self._thread.join()
+            self._thread = None
+
+    def write(self, trace):
+        """
+        Queue a trace to be written.
+
+        :param trace: A CycleTrace.
+        """
+        try:
+            self._queue.put_nowait(trace.to_dict())
+        except Queue.Full:
+            self.nr_of_dropped_traces += 1
+
+    def _run(self, trace_file):
+        """
+        Writer thread.
+
+        :param trace_file: The open file.
+        """
+        flushed_at = time.time()
+        with trace_file:
+            while True:
+                try:
+                    record = self._queue.get(timeout=self._flush_interval)
+                except Queue.Empty:
+                    pass
+                else:
+                    if record is self._STOP:
+                        break
+                    trace_file.write(json.dumps(record, separators=(',', ':')) + '\n')
+                if time.time() - flushed_at >= self._flush_interval:
+                    trace_file.flush()
+                    flushed_at = time.time()
+
+
+def analyse(records, limit=10):
+    """
+    Analyse traces, for the slowest build types and the requests that took the most time.
+
+    :param records: An iterable of trace dictionaries, as written by a TraceSink.
+    :param limit: The maximum number of build types and resources to report.
+    :return: A dictionary with a summary of the checks, and lists of build types, request kinds, endpoints and
+             resources, each a dictionary with the count, total seconds and maximum seconds, slowest first.
+    """
+    durations = []
+    nr_of_errors = 0
+    cache_hits = 0
+    cache_misses = 0
+    build_types = {}
+    kinds = {}
+    endpoints = {}
+    resources = {}
+    for record in records:
+        if record['duration'] is not None:
+            durations.append(record['duration'])
+        nr_of_errors += 1 if record['error'] else 0
+        cache_hits += record['cache_hits']
+        cache_misses += record['cache_misses']
+        for (build_type_id, seconds, _) in record['build_types']:
+            _add_timing(build_types, build_type_id, seconds)
+        for request in record['requests']:
+            (kind, resource, seconds) = request[:3]
+            _add_timing(kinds, kind, seconds)
+            _add_timing(resources, resource, seconds)
+            # Traces written before endpoints were recorded have none
+            if len(request) > 4 and request[4]:
+                _add_timing(endpoints, request[4], seconds)
+    lookups = cache_hits + cache_misses
+    return {'checks': {'count': len(durations),
+                       'errors': nr_of_errors,
+                       'total': sum(durations),
+                       'max': max(durations) if durations else 0.0,
+                       'cache_hit_ratio': float(cache_hits) / lookups if lookups else None},
+            'build_types': _slowest(build_types, limit),
+            'kinds': _slowest(kinds, limit),
+            'endpoints': _slowest(endpoints, limit),
+            'resources': _slowest(resources, limit)}
+
+
+def _add_timing(timings, key, seconds):
+    """
+    Add a timing to the totals of a key.
+
+    :param timings: A dictionary of timings by key.
+    :param key: The key, e.g. a build type ID.
+    :param seconds: The time taken.
+    """
+    timing = timings.setdefault(key, {'name': key, 'count': 0, 'total': 0.0, 'max': 0.0})
+    timing['count'] += 1
+    timing['total'] += seconds
+    timing['max'] = max(timing['max'], seconds)
+
+
+def _slowest(timings, limit):
+    """
+    Get the keys that took the most time in total.
+
+    :param timings: A dictionary of timings by key.
+    :param limit: The maximum number of keys.
+    :return: A list of timings, slowest first.
+    """
+    return sorted(timings.values(), key=lambda timing: timing['total'], reverse=True)[:limit]